@@ -0,0 +1,146 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Persistent cache of precomputed arrays"""
+
+import os
+import shutil
+import hashlib
+import logging
+
+import numpy
+
+
+_logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = 'MEGARADRP_CACHE_DIR'
+CACHE_SIZE_ENV = 'MEGARADRP_CACHE_SIZE'
+
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+
+
+class ArrayCache(object):
+    """Persistent cache of numpy arrays, with LRU eviction.
+
+    Each entry is a directory named after its key, containing
+    one .npy file per array. Entries are loaded memory-mapped
+    and read-only.
+
+    Parameters
+    ----------
+    directory : str
+        Base directory of the cache
+    max_size : int
+        Maximum size of the cache in bytes. The least recently
+        used entries are removed when this size is exceeded.
+
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts):
+        """Compute a key from the representation of parts"""
+        hasher = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, numpy.ndarray):
+                part = part.tolist()
+            hasher.update(repr(part).encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """Load the arrays stored under key, or None if missing"""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            _logger.debug('cache miss for %s', key)
+            return None
+        _logger.debug('cache hit for %s', key)
+        try:
+            arrays = {}
+            for name in os.listdir(entry):
+                base, ext = os.path.splitext(name)
+                if ext == '.npy':
+                    fname = os.path.join(entry, name)
+                    arrays[base] = numpy.load(fname, mmap_mode='r')
+            # Mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError) as error:
+            # Entry removed by other process or corrupted
+            _logger.warning('unable to load cache entry %s, %s', key, error)
+            return None
+        return arrays
+
+    def store(self, key, arrays):
+        """Store a dictionary of arrays under key"""
+        entry = self._entry(key)
+        tmp_entry = f'{entry}.tmp{os.getpid()}'
+        try:
+            os.makedirs(tmp_entry, exist_ok=True)
+            for name, value in arrays.items():
+                numpy.save(os.path.join(tmp_entry, f'{name}.npy'), value)
+            os.rename(tmp_entry, entry)
+        except OSError as error:
+            # Other process could have stored the same entry
+            _logger.warning('unable to store cache entry %s, %s', key, error)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        _logger.debug('stored cache entry %s', key)
+        self.evict(keep=key)
+
+    def entries(self):
+        """Return (mtime, size, key) of the stored entries"""
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if '.tmp' in key or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+                result.append((os.stat(entry).st_mtime, size, key))
+            except OSError:
+                pass
+        return result
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_size"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            _logger.debug('evicting cache entry %s', key)
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+
+def default_cache():
+    """Return the cache configured in the environment, if any.
+
+    The cache is enabled by setting MEGARADRP_CACHE_DIR to
+    a directory. MEGARADRP_CACHE_SIZE sets its maximum size in bytes.
+    """
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if not directory:
+        return None
+    value = os.environ.get(CACHE_SIZE_ENV, DEFAULT_MAX_SIZE)
+    try:
+        max_size = max(0, int(value))
+    except ValueError:
+        _logger.warning('invalid value %r for %s', value, CACHE_SIZE_ENV)
+        max_size = DEFAULT_MAX_SIZE
+    return ArrayCache(directory, max_size=max_size)
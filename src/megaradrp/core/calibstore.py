@@ -0,0 +1,168 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Store of master calibrations shared by the correctors of a process"""
+
+import os
+import logging
+import threading
+import collections
+
+import numpy
+
+
+_logger = logging.getLogger(__name__)
+
+CALIB_SIZE_ENV = 'MEGARADRP_CALIB_SIZE'
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+
+class CalibrationStore(object):
+    """Master calibration images, memory-mapped and shared, with LRU eviction.
+
+    The data of each master is read once per process, memory-mapped
+    if possible, and identified by the UUID of the image and the
+    resolved path of its file. The correctors receive read-only views
+    of the same data. Masters without UUID are not stored.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum size of the stored data in bytes. The least recently
+        used masters are removed from the store when this size is
+        exceeded, except the last one loaded. The views already
+        handed out remain valid.
+
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        # (path, ext) -> (stat of the file, key in _entries)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def load(self, dframe, datamodel, ext=0):
+        """Return the data of a master calibration and its identifier.
+
+        If the file of `dframe` was already loaded and has not changed
+        since, the stored data is returned without opening the file.
+        Otherwise the file is opened to read its UUID. Images without
+        UUID are not stored, a read-only copy of their data is returned.
+
+        Parameters
+        ----------
+        dframe : DataFrame
+            The master calibration
+        datamodel : numina.datamodel.DataModel
+            Used to obtain the identifier of the image
+        ext : int or str, optional
+            The extension with the data
+
+        Returns
+        -------
+        data : numpy.ndarray
+            Read-only view of the data
+        calibid : str
+            Identifier of the image
+        """
+        path = stat = None
+        if dframe.frame is None and dframe.filename is not None:
+            path = os.path.realpath(dframe.filename)
+            st = os.stat(path)
+            stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+            with self._lock:
+                known = self._files.get((path, ext))
+                if known is not None and known[0] == stat:
+                    entry = self._entries.get(known[1])
+                    if entry is not None:
+                        _logger.debug('calibration %s found in store', entry[1])
+                        self._entries.move_to_end(known[1])
+                        return entry
+
+        with dframe.open() as hdul:
+            calibid = datamodel.get_imgid(hdul)
+            uuid = hdul[0].header.get('UUID')
+            if uuid is None:
+                _logger.debug('calibration %s without UUID, not stored', calibid)
+                data = numpy.array(hdul[ext].data)
+                data.flags.writeable = False
+                return data, calibid
+            key = (uuid, path, ext)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    _logger.debug('calibration %s found in store', calibid)
+                    self._entries.move_to_end(key)
+                    if path is not None:
+                        self._files[(path, ext)] = (stat, key)
+                    return entry
+            _logger.debug('loading calibration %s', calibid)
+            data = hdul[ext].data.view()
+            data.flags.writeable = False
+
+        with self._lock:
+            self._entries[key] = (data, calibid)
+            self._entries.move_to_end(key)
+            if path is not None:
+                self._files[(path, ext)] = (stat, key)
+            self._evict(keep=key)
+        return data, calibid
+
+    def size(self):
+        """Size of the stored data in bytes"""
+        with self._lock:
+            return sum(data.nbytes for data, _ in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def clear(self):
+        """Remove all the stored masters"""
+        with self._lock:
+            self._entries.clear()
+            self._files.clear()
+
+    def _evict(self, keep=None):
+        total = sum(data.nbytes for data, _ in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            _logger.debug('evicting calibration %s', key[0])
+            data, _ = self._entries.pop(key)
+            total -= data.nbytes
+        stored = set(self._entries)
+        self._files = {k: v for k, v in self._files.items() if v[1] in stored}
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    """Return the store of calibrations of this process.
+
+    MEGARADRP_CALIB_SIZE sets its maximum size in bytes.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            value = os.environ.get(CALIB_SIZE_ENV, DEFAULT_MAX_SIZE)
+            try:
+                max_size = max(0, int(value))
+            except ValueError:
+                _logger.warning('invalid value %r for %s', value, CALIB_SIZE_ENV)
+                max_size = DEFAULT_MAX_SIZE
+            _default_store = CalibrationStore(max_size=max_size)
+        return _default_store
@@ -17,9 +17,10 @@ import numina.util.node as node
 import numina.processing as proc
 
 from megaradrp.processing.trimover import OverscanCorrector, TrimImage
-from megaradrp.processing.trimover import GainCorrector
+from megaradrp.processing.trimover import GainCorrector, OverscanTrimCorrector
 from megaradrp.processing.slitflat import SlitFlatCorrector
 from megaradrp.processing.diffuselight import DiffuseLightCorrector
+import megaradrp.core.calibstore as calibstore
 
 
 _logger = logging.getLogger(__name__)
@@ -28,18 +29,16 @@ _logger = logging.getLogger(__name__)
 def get_corrector_bpm(rinput, meta, ins, datamodel):
     bpm_info = meta.get('master_bpm')
     if bpm_info is not None:
-        with rinput.master_bpm.open() as hdul:
-            _logger.info('loading BPM')
-            mbpm = hdul[0].data
-            calibid = datamodel.get_imgid(hdul)
-            _logger.debug('BPM image: %s', calibid)
-            bpm_corrector = proc.BadPixelCorrector(
-                mbpm,
-                datamodel=datamodel,
-                calibid=calibid,
-                hwin=0,
-                wwin=3
-            )
+        _logger.info('loading BPM')
+        mbpm, calibid = calibstore.default_store().load(rinput.master_bpm, datamodel)
+        _logger.debug('BPM image: %s', calibid)
+        bpm_corrector = proc.BadPixelCorrector(
+            mbpm,
+            datamodel=datamodel,
+            calibid=calibid,
+            hwin=0,
+            wwin=3
+        )
     else:
         _logger.info('BPM not provided, ignored')
         bpm_corrector = node.IdNode()
@@ -51,13 +50,11 @@ def get_corrector_super(rinput, meta, key, correctorclass, datamodel):
     info = meta.get(key)
     req = getattr(rinput, key)
     if req is not None:
-        with req.open() as hdul:
-            _logger.info('loading %s', key)
-            _logger.debug('%s info: %s', key, info)
-            datac = hdul['primary'].data
-            calibid = datamodel.get_imgid(hdul)
-            corrector = correctorclass(datac, datamodel=datamodel,
-                                       calibid=calibid)
+        _logger.info('loading %s', key)
+        _logger.debug('%s info: %s', key, info)
+        datac, calibid = calibstore.default_store().load(req, datamodel)
+        corrector = correctorclass(datac, datamodel=datamodel,
+                                   calibid=calibid)
     else:
         _logger.info('%s not provided, ignored', key)
         corrector = node.IdNode()
@@ -82,12 +79,10 @@ def get_corrector_slit_flat(rinput, meta, ins, datamodel):
     info = meta.get(key)
     if info is not None:
         req = getattr(rinput, key)
-        with req.open() as hdul:
-            _logger.info('loading slit flat')
-            _logger.debug('%s image: %s', key, info)
-            mbpm = hdul[0].data
-            calibid = datamodel.get_imgid(hdul)
-            corrector = SlitFlatCorrector(mbpm, datamodel, calibid=calibid)
+        _logger.info('loading slit flat')
+        _logger.debug('%s image: %s', key, info)
+        mbpm, calibid = calibstore.default_store().load(req, datamodel)
+        corrector = SlitFlatCorrector(mbpm, datamodel, calibid=calibid)
     else:
         _logger.info('%s not provided, ignored', key)
         corrector = node.IdNode()
@@ -100,12 +95,10 @@ def get_corrector_diffuse_light(rinput, meta, ins, datamodel):
     info = meta.get(key)
     if info is not None:
         req = getattr(rinput, key)
-        with req.open() as hdul:
-            _logger.info('loading diffuse light image')
-            _logger.debug('%s image: %s', key, info)
-            mbpm = hdul[0].data
-            calibid = datamodel.get_imgid(hdul)
-            corrector = DiffuseLightCorrector(mbpm, datamodel, calibid=calibid)
+        _logger.info('loading diffuse light image')
+        _logger.debug('%s image: %s', key, info)
+        mbpm, calibid = calibstore.default_store().load(req, datamodel)
+        corrector = DiffuseLightCorrector(mbpm, datamodel, calibid=calibid)
     else:
         _logger.info('%s not provided, ignored', key)
         corrector = node.IdNode()
@@ -138,3 +131,22 @@ def get_corrector_gain(rinput, meta, ins, datamodel):
         datamodel=datamodel,
         calibid=str(ins.get_device('detector').origin.uuid)
     )
+
+
+def get_corrector_overscan_trimming(rinput, meta, ins, datamodel):
+    """Correct from overscan and trim in one pass"""
+    return OverscanTrimCorrector(
+        detconf=ins.get_property('detector.scan'),
+        datamodel=datamodel,
+        calibid=str(ins.get_device('detector').origin.uuid)
+    )
+
+
+def get_corrector_overscan_trimming_gain(rinput, meta, ins, datamodel):
+    """Correct from overscan, trim and correct from gain in one pass"""
+    return OverscanTrimCorrector(
+        detconf=ins.get_property('detector.scan'),
+        gain=True,
+        datamodel=datamodel,
+        calibid=str(ins.get_device('detector').origin.uuid)
+    )
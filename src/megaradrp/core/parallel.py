@@ -0,0 +1,190 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Process pool with arrays in shared memory"""
+
+import os
+import logging
+import weakref
+import multiprocessing as mp
+
+import numpy
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+_logger = logging.getLogger(__name__)
+
+PROCESSES_ENV = 'MEGARADRP_PROCESSES'
+
+# Shared memory segments attached in a worker process
+_attached = {}
+
+
+def is_available():
+    """Return True if shared memory is supported"""
+    return shared_memory is not None
+
+
+def default_processes():
+    """Return the number of processes configured in the environment.
+
+    The number is read from MEGARADRP_PROCESSES, 0 (the default)
+    means no worker processes.
+    """
+    value = os.environ.get(PROCESSES_ENV, '0')
+    try:
+        return max(0, int(value))
+    except ValueError:
+        _logger.warning('invalid value %r for %s', value, PROCESSES_ENV)
+        return 0
+
+
+def chunk_slices(size, nchunks):
+    """Split range(size) in at most nchunks contiguous slices"""
+    nchunks = max(1, min(nchunks, size))
+    limits = numpy.linspace(0, size, nchunks + 1).astype('int')
+    return [slice(l1, l2) for l1, l2 in zip(limits[:-1], limits[1:]) if l2 > l1]
+
+
+def _attach(desc):
+    shm_name, shape, dtype = desc
+    if shm_name not in _attached:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _attached[shm_name] = shm
+    shm = _attached[shm_name]
+    return numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _close(shm, unlink=False):
+    try:
+        shm.close()
+    except BufferError:
+        # There are arrays using the memory, it is
+        # released when they are garbage collected
+        pass
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _call_shared(func, descs, args):
+    # Release segments no longer used by the parent
+    current = set(desc[0] for desc in descs.values())
+    for shm_name in list(_attached):
+        if shm_name not in current:
+            _close(_attached.pop(shm_name))
+    arrays = {name: _attach(desc) for name, desc in descs.items()}
+    return func(arrays, *args)
+
+
+def _cleanup(pool, segments):
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    for shm in segments.values():
+        _close(shm, unlink=True)
+    segments.clear()
+
+
+class SharedExecutor(object):
+    """A reusable process pool sharing named arrays with its workers.
+
+    Arrays created with `array` or `share` live in shared memory.
+    Functions passed to `run` receive a dictionary with all the
+    shared arrays, attached in the worker without copies, followed by
+    the arguments of the task. Results are usually written
+    into shared arrays.
+
+    The pool and the shared memory are released by `close`, or
+    when the executor is garbage collected.
+
+    Parameters
+    ----------
+    processes : int
+        Number of worker processes
+
+    """
+    def __init__(self, processes):
+        if shared_memory is None:
+            raise RuntimeError('shared memory requires Python >= 3.8')
+        self.processes = processes
+        self._pool = None
+        self._segments = {}
+        self._arrays = {}
+        self._finalizer = weakref.finalize(self, _cleanup, None, self._segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            _logger.debug('starting pool with %d processes', self.processes)
+            self._pool = mp.Pool(processes=self.processes)
+            self._finalizer.detach()
+            self._finalizer = weakref.finalize(
+                self, _cleanup, self._pool, self._segments
+            )
+        return self._pool
+
+    def array(self, name, shape, dtype='float64'):
+        """Return a shared array, reusing the memory of name if possible"""
+        shape = tuple(shape)
+        dtype = numpy.dtype(dtype)
+        arr = self._arrays.get(name)
+        if arr is not None and arr.shape == shape and arr.dtype == dtype:
+            return arr
+        self.release(name)
+        nbytes = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        arr = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self._segments[name] = shm
+        self._arrays[name] = arr
+        return arr
+
+    def share(self, name, values):
+        """Copy values into the shared array name"""
+        arr = self.array(name, values.shape, values.dtype)
+        if arr is not values:
+            arr[...] = values
+        return arr
+
+    def release(self, name):
+        """Release the memory of the shared array name"""
+        self._arrays.pop(name, None)
+        shm = self._segments.pop(name, None)
+        if shm is not None:
+            _close(shm, unlink=True)
+
+    def run(self, func, tasks):
+        """Run func over the tasks in the pool, return the results in order.
+
+        `func` must be a module level function, called as
+        ``func(arrays, *task)``.
+        """
+        descs = {name: (self._segments[name].name, arr.shape, arr.dtype.str)
+                 for name, arr in self._arrays.items()}
+        args = [(func, descs, task) for task in tasks]
+        return self.pool.starmap(_call_shared, args)
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        self._arrays.clear()
+        self._finalizer()
+        self._pool = None
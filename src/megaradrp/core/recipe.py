@@ -143,7 +143,7 @@ class MegaraBaseRecipe(BaseRecipe):
 
     def init_filters(self, rinput, ins):
         imgtypes1 = [None]
-        getters1 = [[cor.get_corrector_overscan, cor.get_corrector_trimming]]
+        getters1 = [[cor.get_corrector_overscan_trimming]]
         getters_f1 = self.get_filters(imgtypes1, getters1)
         imgtypes2, getters2 = self.types_getter()
         getters_f2 = self.get_filters(imgtypes2, getters2)
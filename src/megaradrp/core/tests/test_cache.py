@@ -0,0 +1,60 @@
+
+import os
+
+import numpy
+
+from ..cache import ArrayCache, default_cache
+
+
+def test_cache_store_load(tmpdir):
+    cache = ArrayCache(str(tmpdir))
+    key = ArrayCache.key('test', (10, 20), numpy.array([1.0, 2.0]))
+    assert cache.load(key) is None
+
+    arrays = {'a': numpy.arange(10), 'b': numpy.ones((3, 4))}
+    cache.store(key, arrays)
+    res = cache.load(key)
+    assert set(res) == {'a', 'b'}
+    for name in arrays:
+        assert numpy.array_equal(res[name], arrays[name])
+
+
+def test_cache_key():
+    key1 = ArrayCache.key('test', numpy.array([1.0, 2.0]))
+    key2 = ArrayCache.key('test', numpy.array([1.0, 2.5]))
+    assert key1 != key2
+    assert key1 == ArrayCache.key('test', [1.0, 2.0])
+
+
+def test_cache_evict(tmpdir):
+    # Room for two entries
+    cache = ArrayCache(str(tmpdir), max_size=2 * 8 * 1000 + 500)
+    data = numpy.zeros((1000,))
+    cache.store('k1', {'a': data})
+    cache.store('k2', {'a': data})
+    os.utime(tmpdir.join('k1'), (1, 1))
+    os.utime(tmpdir.join('k2'), (2, 2))
+    # Using k1 makes k2 the oldest
+    assert cache.load('k1') is not None
+    cache.store('k3', {'a': data})
+    assert cache.load('k2') is None
+    assert cache.load('k1') is not None
+    assert cache.load('k3') is not None
+
+
+def test_default_cache(tmpdir, monkeypatch):
+    monkeypatch.delenv('MEGARADRP_CACHE_DIR', raising=False)
+    assert default_cache() is None
+    monkeypatch.setenv('MEGARADRP_CACHE_DIR', str(tmpdir))
+    cache = default_cache()
+    assert cache.directory == str(tmpdir)
+
+
+def test_default_cache_size(tmpdir, monkeypatch):
+    from ..cache import DEFAULT_MAX_SIZE
+
+    monkeypatch.setenv('MEGARADRP_CACHE_DIR', str(tmpdir))
+    monkeypatch.setenv('MEGARADRP_CACHE_SIZE', '1000')
+    assert default_cache().max_size == 1000
+    monkeypatch.setenv('MEGARADRP_CACHE_SIZE', '2G')
+    assert default_cache().max_size == DEFAULT_MAX_SIZE
@@ -0,0 +1,94 @@
+import os
+
+import numpy
+import pytest
+import astropy.io.fits as fits
+from numina.core import DataFrame
+from numina.datamodel import DataModel
+
+from ..calibstore import CalibrationStore
+
+
+def create_master(tmpdir, name, value, shape=(100, 100)):
+    hdu = fits.PrimaryHDU(numpy.full(shape, value, dtype='float32'))
+    hdu.header['UUID'] = f'uuid-{name}'
+    filename = str(tmpdir.join(f'{name}.fits'))
+    hdu.writeto(filename)
+    return DataFrame(filename=filename)
+
+
+def test_store_shared(tmpdir):
+    store = CalibrationStore()
+    datamodel = DataModel()
+    master = create_master(tmpdir, 'bias', 3.0)
+    data1, calibid1 = store.load(master, datamodel)
+    data2, calibid2 = store.load(DataFrame(filename=master.filename), datamodel)
+    assert calibid1 == calibid2 == 'uuid-bias'
+    assert data1 is data2
+    assert numpy.all(data1 == 3.0)
+    with pytest.raises(ValueError):
+        data1[0, 0] = 1.0
+
+
+def test_store_evict(tmpdir):
+    # Room for two masters
+    nbytes = 100 * 100 * 4
+    store = CalibrationStore(max_size=2 * nbytes)
+    datamodel = DataModel()
+    masters = [create_master(tmpdir, name, idx) for idx, name in enumerate(['m1', 'm2', 'm3'])]
+    data1, _ = store.load(masters[0], datamodel)
+    store.load(masters[1], datamodel)
+    # Using m1 makes m2 the oldest
+    store.load(masters[0], datamodel)
+    store.load(masters[2], datamodel)
+    assert len(store) == 2
+    assert ('uuid-m1', os.path.realpath(masters[0].filename), 0) in store
+    assert ('uuid-m2', os.path.realpath(masters[1].filename), 0) not in store
+    assert store.size() == 2 * nbytes
+    # Evicted data remains valid
+    assert numpy.all(data1 == 0)
+
+
+def test_store_no_reopen(tmpdir, monkeypatch):
+    store = CalibrationStore()
+    datamodel = DataModel()
+    master = create_master(tmpdir, 'bias', 3.0)
+    data1, calibid1 = store.load(master, datamodel)
+
+    def fail(*args, **kwds):
+        raise AssertionError('file opened')
+
+    monkeypatch.setattr(fits, 'open', fail)
+    data2, calibid2 = store.load(DataFrame(filename=master.filename), datamodel)
+    assert data1 is data2
+    assert calibid1 == calibid2
+
+
+def test_store_modified_file(tmpdir):
+    store = CalibrationStore()
+    datamodel = DataModel()
+    master = create_master(tmpdir, 'bias', 3.0)
+    store.load(master, datamodel)
+    # Same path, different master
+    hdu = fits.PrimaryHDU(numpy.full((100, 100), 5.0, dtype='float32'))
+    hdu.header['UUID'] = 'uuid-other'
+    hdu.writeto(master.filename, overwrite=True)
+    data, calibid = store.load(master, datamodel)
+    assert calibid == 'uuid-other'
+    assert numpy.all(data == 5.0)
+
+
+def test_store_no_uuid():
+    store = CalibrationStore()
+    datamodel = DataModel()
+    data1 = numpy.full((10, 10), 1.0)
+    data2 = numpy.full((10, 10), 2.0)
+    master1 = DataFrame(frame=fits.HDUList([fits.PrimaryHDU(data1)]))
+    master2 = DataFrame(frame=fits.HDUList([fits.PrimaryHDU(data2)]))
+    res1, _ = store.load(master1, datamodel)
+    res2, _ = store.load(master2, datamodel)
+    assert len(store) == 0
+    assert numpy.all(res1 == 1.0)
+    assert numpy.all(res2 == 2.0)
+    with pytest.raises(ValueError):
+        res1[0, 0] = 0.0
@@ -0,0 +1,45 @@
+
+import numpy
+import pytest
+
+import megaradrp.core.parallel as parallel
+
+
+def _square_worker(arrays, sl):
+    arrays['out'][sl] = arrays['in'][sl] ** 2
+    return sl.start
+
+
+@pytest.mark.parametrize("size, nchunks", [(10, 3), (4096, 32), (2, 5)])
+def test_chunk_slices(size, nchunks):
+    slices = parallel.chunk_slices(size, nchunks)
+    assert len(slices) == min(size, nchunks)
+    assert slices[0].start == 0
+    assert slices[-1].stop == size
+    for s1, s2 in zip(slices[:-1], slices[1:]):
+        assert s1.stop == s2.start
+
+
+def test_default_processes(monkeypatch):
+    monkeypatch.setenv(parallel.PROCESSES_ENV, '3')
+    assert parallel.default_processes() == 3
+    monkeypatch.setenv(parallel.PROCESSES_ENV, 'many')
+    assert parallel.default_processes() == 0
+    monkeypatch.delenv(parallel.PROCESSES_ENV)
+    assert parallel.default_processes() == 0
+
+
+@pytest.mark.skipif(not parallel.is_available(), reason='requires shared memory')
+def test_shared_executor():
+    data = numpy.arange(100.0)
+    with parallel.SharedExecutor(2) as executor:
+        executor.share('in', data)
+        out = executor.array('out', data.shape)
+        slices = parallel.chunk_slices(len(data), 4)
+        res = executor.run(_square_worker, [(sl,) for sl in slices])
+        assert res == [sl.start for sl in slices]
+        assert numpy.array_equal(out, data ** 2)
+        # New values, same memory
+        executor.share('in', 2 * data)
+        executor.run(_square_worker, [(sl,) for sl in slices])
+        assert numpy.array_equal(out, 4 * data ** 2)
@@ -2,7 +2,9 @@
 import numpy
 import pytest
 
-from ..utils import atleast_2d_last
+import astropy.io.fits as fits
+
+from ..utils import atleast_2d_last, native_data, native_hdu_data
 
 @pytest.mark.parametrize("arr, shape, ndim", [
     ([1, 2, 3], (3, 1), 2),
@@ -30,3 +32,21 @@ def test_utils_atleast2(arrs, shapes, ndims):
     for el, shape, ndim in zip(res, shapes, ndims):
         assert el.shape == shape
         assert el.ndim == ndim
+
+
+def test_native_data():
+    arr = numpy.arange(12, dtype='float32').reshape((3, 4))
+    assert native_data(arr) is arr
+    swapped = arr.astype('>f4')
+    result = native_data(swapped)
+    assert result.dtype.isnative
+    assert numpy.array_equal(result, arr)
+
+
+def test_native_hdu_data():
+    hdu = fits.PrimaryHDU(numpy.arange(12, dtype='>f4').reshape((3, 4)))
+    data = native_hdu_data(hdu)
+    assert data.dtype.isnative
+    assert hdu.data is data
+    # Converted once
+    assert native_hdu_data(hdu) is data
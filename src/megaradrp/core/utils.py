@@ -9,6 +9,9 @@
 
 import numpy
 
+# Size of the FITS blocks
+FITS_BLOCK = 2880
+
 
 def atleast_2d_last(*arys):
     """Equivalent to atleast_2d, adding the newaxis at the end"""
@@ -26,3 +29,111 @@ def atleast_2d_last(*arys):
         return res[0]
     else:
         return res
+
+
+def native_data(data):
+    """Data in the native byte order of the machine.
+
+    The C extensions used in tracing and extraction require data in
+    native byte order. The data written by the reduction flow is
+    already native, and is returned without copies. Data read from
+    FITS files is big-endian, and is converted.
+    """
+    if data.dtype.isnative:
+        return data
+    return data.astype(data.dtype.newbyteorder('='))
+
+
+def native_hdu_data(hdu):
+    """Convert the data of the HDU to the native byte order, once.
+
+    The converted data replaces the data of the HDU, so the
+    next users of the HDU do not convert it again.
+    """
+    data = hdu.data
+    native = native_data(data)
+    if native is not data:
+        hdu.data = native
+    return native
+
+
+def create_fits_primary(filename, header, shape, dtype='float32'):
+    """Create a FITS file with a primary HDU of the given shape
+
+    The data of the HDU is not written, the file is extended to its
+    final size. The data can then be filled in parts through the
+    returned memory map, without holding it in memory.
+
+    Parameters
+    ----------
+    filename : str
+    header : astropy.io.fits.Header
+        Header of the primary HDU. The keywords describing the
+        shape and type of the data are updated
+    shape : tuple
+    dtype : numpy.dtype, optional
+
+    Returns
+    -------
+    numpy.memmap
+        The data of the primary HDU, writable
+
+    """
+    import astropy.io.fits as fits
+
+    return _write_empty_hdu(filename, 'wb', fits.PrimaryHDU, header, shape, dtype)
+
+
+def append_fits_image(filename, header, shape, dtype='float32'):
+    """Append an image extension of the given shape to a FITS file
+
+    As in :func:`create_fits_primary`, the data of the HDU is
+    not written, and can be filled through the returned memory map.
+
+    Parameters
+    ----------
+    filename : str
+    header : astropy.io.fits.Header
+        Header of the extension. The keywords describing the
+        shape and type of the data are updated
+    shape : tuple
+    dtype : numpy.dtype, optional
+
+    Returns
+    -------
+    numpy.memmap
+        The data of the extension, writable
+
+    """
+    import astropy.io.fits as fits
+
+    return _write_empty_hdu(filename, 'ab', fits.ImageHDU, header, shape, dtype)
+
+
+def _write_empty_hdu(filename, mode, hdu_class, header, shape, dtype):
+    import astropy.io.fits as fits
+
+    dtype = numpy.dtype(dtype)
+    shape = tuple(shape)
+    hdu = hdu_class(
+        data=numpy.zeros((1,) * len(shape), dtype=dtype),
+        header=header
+    )
+    hdr = hdu.header
+    for axis, size in enumerate(reversed(shape), 1):
+        hdr[f'NAXIS{axis}'] = size
+    if isinstance(hdu, fits.PrimaryHDU):
+        # Extensions can be appended
+        hdr.set('EXTEND', True, after=f'NAXIS{len(shape)}')
+
+    header_str = hdr.tostring().encode('ascii')
+    header_size = len(header_str)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    data_size = -(-nbytes // FITS_BLOCK) * FITS_BLOCK
+    with open(filename, mode) as fobj:
+        start = fobj.tell()
+        fobj.write(header_str)
+        fobj.truncate(start + header_size + data_size)
+
+    return numpy.memmap(filename, dtype=dtype.newbyteorder('>'), mode='r+',
+                        offset=start + header_size, shape=shape)
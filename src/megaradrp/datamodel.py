@@ -300,7 +300,8 @@ def megara_inferr_datetype_from_image(hdulist):
             sub_datatype = MegaraDataType.IMAGE_DARK
         elif obsmode in ["MegaraSlitFlat"]:
             sub_datatype = MegaraDataType.IMAGE_SLITFLAT
-        elif obsmode in ["MegaraFiberFlatImage", "MegaraTraceMap", "MegaraModelMap"]:
+        elif obsmode in ["MegaraFiberFlatImage", "MegaraTraceMap", "MegaraModelMap",
+                         "MegaraTraceShift", "MegaraModelMapShift"]:
             sub_datatype = MegaraDataType.IMAGE_FLAT
         elif obsmode in ["MegaraArcCalibration"]:
             sub_datatype = MegaraDataType.IMAGE_COMP
@@ -16,6 +16,8 @@ import astropy.io.fits as fits
 import numina.array.trace.extract as extract
 import numina.processing
 
+from megaradrp.core.utils import native_data
+
 
 _logger = logging.getLogger(__name__)
 
@@ -38,6 +40,9 @@ def apextract_tracemap(data, tracemap):
     Consider that the nearest fiber could be far away if there
     are missing fibers.
 
+    The borders of the apertures are computed once for each
+    `global_offset` of the tracemap, see :meth:`TraceMap.extraction_borders`
+
     Parameters
     ----------
 
@@ -45,82 +50,162 @@ def apextract_tracemap(data, tracemap):
     tracemap: TraceMap
 
     """
-
-    existing = [None]
-    for t in tracemap.contents:
-        if t.valid:
-            existing.append(t)
-
-    existing.append(None)
-    # Compute borders
-    borders = []
-    far_dist = 100
-
-    # Handle the first and last using centinels
-    for t1, t2, t3 in zip(existing, existing[1:], existing[2:]):
-        # Distance to contfibers # in box
-        if t1 is None:
-            d21 = far_dist
-        else:
-            d21 = (t2.fibid - t1.fibid) + (t2.boxid - t1.boxid)
-        if t3 is None:
-            d32 = far_dist
-        else:
-            d32 = (t3.fibid - t2.fibid) + (t3.boxid - t2.boxid)
-
-        y2_off = t2.polynomial(tracemap.ref_column)
-        t2_off = tracemap.global_offset(y2_off)
-        t2_pol_off = t2.polynomial + t2_off
-
-        # Right border
-        pix_32 = None
-        if d32 <= 2:
-            y3_off = t3.polynomial(tracemap.ref_column)
-            t3_off = tracemap.global_offset(y3_off)
-            pix_32 = 0.5 * (t2_pol_off + t3.polynomial + t3_off)
-            if d32 == 2:
-                pix_32 = 0.5 * (pix_32 + t2_pol_off)
-        elif d32 > 2:
-            pix_32 = None
-
-        pix_21 = None
-        if d21 <= 2:
-            y1_off = t1.polynomial(tracemap.ref_column)
-            t1_off = tracemap.global_offset(y1_off)
-            pix_21 = 0.5 * (t2_pol_off + t1.polynomial + t1_off)
-            if d21 == 2:
-                pix_21 = 0.5 * (pix_21 + t2_pol_off)
-        elif d21 > 2:
-            pix_21 = None
-
-        if pix_32 is None and pix_21 is None:
-            continue
-
-        if pix_32 is None:
-            # Recompute pix32 using pix_21
-            pix_32 = t2_pol_off + (t2_pol_off - pix_21)
-
-        if pix_21 is None:
-            # Recompute pix21 using pix_32
-            pix_21 = t2_pol_off - (pix_32 - t2_pol_off)
-
-        borders.append((t2.fibid, pix_21, pix_32))
+    fibids, borders = tracemap.extraction_borders(data.shape[1])
 
     nfibers = tracemap.total_fibers
     out = numpy.zeros((nfibers, data.shape[1]), dtype='float')
-    rss = extract_simple_rss2(data, borders, out=out)
+    rss = extract_borders(data, fibids, borders, out=out)
 
     return rss
 
 
+def calc_borders_tracemap(tracemap, ncols, far_dist=100):
+    """Borders of the apertures of a tracemap, in all the columns.
+
+    The border between two consecutive fibers is the middle line
+    of their traces, or the line at one quarter of the distance if
+    there is a missing fiber between them. A fiber without close
+    neighbours in one side uses the same width in both sides,
+    and fibers without close neighbours are not extracted.
+
+    The polynomials of the borders of all the fibers are computed
+    and evaluated together.
+
+    Parameters
+    ----------
+    tracemap : TraceMap
+    ncols : int
+        Number of columns of the image
+    far_dist : int
+        Distance assigned to the sentinels before the first
+        and after the last fibers
+
+    Returns
+    -------
+    fibids : numpy.ndarray
+        Fiber ids of the extracted fibers
+    borders : numpy.ndarray
+        Lower and upper borders of the extracted fibers, in each
+        column, with shape (nfibers, 2, ncols)
+
+    """
+    existing = [t for t in tracemap.contents if t.valid]
+    if not existing:
+        return numpy.zeros((0,), dtype='int'), numpy.zeros((0, 2, ncols))
+
+    fibid = numpy.array([t.fibid for t in existing])
+    boxid = numpy.array([t.boxid for t in existing])
+    # Coefficients of the traces, with shape (ncoeffs, nfibers)
+    ncoeffs = max(len(t.polynomial.coef) for t in existing)
+    coeffs = numpy.zeros((ncoeffs, len(existing)))
+    for idx, t in enumerate(existing):
+        coeffs[:len(t.polynomial.coef), idx] = t.polynomial.coef
+
+    # Offsets computed in the reference column
+    offsets = tracemap.global_offset(nppol.polyval(tracemap.ref_column, coeffs))
+    coeffs_off = coeffs.copy()
+    coeffs_off[0] += offsets
+
+    # Distance to contiguous fibers, in box
+    dist = (fibid[1:] - fibid[:-1]) + (boxid[1:] - boxid[:-1])
+    d21 = numpy.concatenate([[far_dist], dist])
+    d32 = numpy.concatenate([dist, [far_dist]])
+
+    # Right border, between each fiber and the next
+    pix_32 = numpy.zeros_like(coeffs)
+    pix_32[:, :-1] = coeffs_off[:, :-1] + coeffs[:, 1:]
+    pix_32[0, :-1] += offsets[1:]
+    pix_32 *= 0.5
+    pix_32 = numpy.where(d32 == 2, 0.5 * (pix_32 + coeffs_off), pix_32)
+
+    # Left border, between each fiber and the previous
+    pix_21 = numpy.zeros_like(coeffs)
+    pix_21[:, 1:] = coeffs_off[:, 1:] + coeffs[:, :-1]
+    pix_21[0, 1:] += offsets[:-1]
+    pix_21 *= 0.5
+    pix_21 = numpy.where(d21 == 2, 0.5 * (pix_21 + coeffs_off), pix_21)
+
+    has_32 = d32 <= 2
+    has_21 = d21 <= 2
+    # Recompute the missing border using the other
+    pix_32 = numpy.where(has_32, pix_32, coeffs_off + (coeffs_off - pix_21))
+    pix_21 = numpy.where(has_21, pix_21, coeffs_off - (pix_32 - coeffs_off))
+
+    used = has_32 | has_21
+    xx = numpy.arange(ncols)
+    borders = numpy.empty((used.sum(), 2, ncols))
+    borders[:, 0] = nppol.polyval(xx, pix_21[:, used])
+    borders[:, 1] = nppol.polyval(xx, pix_32[:, used])
+    return fibid[used], borders
+
+
+def extract_borders(arr, fibids, borders, out=None, chunk_size=32):
+    """Extract all the apertures between their borders.
+
+    The result of each fiber is the same as extracting it with
+    :func:`numina.array.trace.extract.extract_simple_intl`, but
+    all the fibers are extracted together.
+
+    Parameters
+    ----------
+    arr : numpy.ndarray
+        Image, with the apertures along the columns
+    fibids : numpy.ndarray
+        Fiber ids of the apertures
+    borders : numpy.ndarray
+        Lower and upper borders of the apertures, with
+        shape (nfibers, 2, ncols)
+    out : numpy.ndarray, optional
+        Result, the aperture with fiber id `fibid` is stored in row `fibid - 1`
+    chunk_size : int
+        The apertures are extracted in groups of this size
+
+    Returns
+    -------
+    numpy.ndarray
+
+    """
+    nrows, ncols = arr.shape
+    if out is None:
+        nfibers = fibids.max() if len(fibids) else 0
+        out = numpy.zeros((nfibers, ncols), dtype='float')
+
+    # Pixels are gathered from the flattened image
+    flat = numpy.ravel(arr)
+    xx = numpy.arange(ncols)
+    for beg in range(0, len(fibids), chunk_size):
+        sl = slice(beg, beg + chunk_size)
+        bb1 = numpy.maximum(borders[sl, 0], -0.5)
+        bb2 = numpy.minimum(borders[sl, 1], nrows - 0.5)
+        pa = numpy.maximum(numpy.floor(bb1 + 0.5).astype('int'), 0)
+        pb = numpy.minimum(numpy.floor(bb2 + 0.5).astype('int'), nrows)
+        npix = pb - pa
+        single = npix == 0
+        # Weights of the pixels in the borders, if both borders
+        # are in the same pixel, only the first is used
+        weight_a = numpy.where(single, bb2 - bb1, pa + 0.5 - bb1)
+        weight_b = bb2 - (pb - 0.5)
+        use_a = pa < nrows
+        use_b = (pb >= 0) & (pb < nrows) & ~single
+        idx = pa * ncols + xx
+        # The sums are performed in the same order as in extract_simple_intl
+        acc = numpy.zeros_like(weight_a)
+        numpy.multiply(flat.take(idx, mode='clip'), weight_a, out=acc, where=use_a)
+        value_b = flat.take(idx + npix * ncols, mode='clip') * weight_b
+        numpy.add(acc, value_b, out=acc, where=use_b)
+        # Complete pixels between the borders
+        width = npix.max(initial=0)
+        for k in range(1, width):
+            idx += ncols
+            numpy.add(acc, flat.take(idx, mode='clip'), out=acc, where=(npix > k))
+        out[fibids[sl] - 1] = acc
+    return out
+
+
 def extract_simple_rss(arr, borders2, axis=0, out=None):
 
-    # FIXME, this should be changed in numina
     # If arr is not in native byte order, the C-extension won't work
-    if arr.dtype.byteorder != '=':
-        arr2 = arr.byteswap().newbyteorder()
-    else:
-        arr2 = arr
+    arr2 = native_data(arr)
 
     if axis == 0:
         arr3 = arr2
@@ -149,7 +234,12 @@ extract_simple_rss2 = extract_simple_rss
 
 
 class ApertureExtractor(numina.processing.Corrector):
-    """A Node that extracts apertures."""
+    """A Node that extracts apertures.
+
+    The resources used in the extraction, such as the pool of
+    processes of a ModelMap, are released by `close`. The node
+    can be used as a context manager.
+    """
 
     def __init__(self, trace_repr, datamodel=None, dtype='float32',
                  processes=0, offset=None):
@@ -165,6 +255,18 @@ class ApertureExtractor(numina.processing.Corrector):
             dtype=dtype
         )
 
+    def close(self):
+        """Release the resources used by the extraction"""
+        close = getattr(self.trace_repr, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def run(self, img):
         # workaround
         imgid = self.get_imgid(img)
@@ -0,0 +1,133 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Location of the borders between the boxes of the pseudo-slit"""
+
+import numpy
+import scipy.signal
+from numina.array.wavecalib.crosscorrelation import cosinebell
+from numina.array.wavecalib.crosscorrelation import convolve_comb_lines
+
+
+def filtered_cross_section(cut, cut_frec=0.10, cos_cut=0.10):
+    """Filtered and inverted cross section of a flat image.
+
+    The borders between the boxes are minima of the cross section.
+    They are converted into maxima, and the high frequencies,
+    from the individual fibers, are removed in Fourier space.
+
+    Parameters
+    ----------
+    cut : numpy.ndarray
+        Cross section of the image, along the rows
+    cut_frec : float
+        Frequencies above this value are removed
+    cos_cut : float
+        Fraction of the cosine bell applied to the cross section
+
+    Returns
+    -------
+    numpy.ndarray
+
+    """
+    rr = numpy.array(cut, dtype='float')
+    # standarize and Y flip
+    rr -= numpy.median(rr)
+    rr /= rr.max()
+    rr *= -1
+
+    cb = cosinebell(len(rr), cos_cut)
+    cbr = cb * rr
+
+    xv = numpy.fft.fftfreq(len(cbr))
+    yv = numpy.fft.fft(cbr)
+
+    # Filter freqs in Fourier space
+    yv[abs(xv) > cut_frec] = 0
+
+    res = numpy.fft.ifft(yv)
+    return res.real
+
+
+def comb_template(positions, naxis1, sigma=3, start=0):
+    """Comb of Gaussian lines placed at positions.
+
+    The comb is sampled in naxis1 pixels, with coordinates
+    start + 1, ..., start + naxis1, as in
+    :func:`numina.array.wavecalib.crosscorrelation.convolve_comb_lines`
+    """
+    positions = numpy.asarray(positions)
+    xwave, comb = convolve_comb_lines(
+        lines_wave=positions,
+        lines_flux=numpy.ones_like(positions),
+        sigma=sigma,
+        crpix1=0, crval1=start, cdelt1=1, naxis1=naxis1
+    )
+    return xwave, comb
+
+
+def comb_offset(signal, positions, sigma=3, max_offset=100):
+    """Offset of a comb of lines that best matches signal.
+
+    A comb with Gaussian lines in `positions` is cross-correlated
+    with `signal` for all the integer offsets in
+    [-max_offset, max_offset]. The cross-correlation is computed
+    with FFTs, using one comb, sampled wide enough to contain all
+    the offsets. The offset is refined to a fraction of pixel
+    fitting a parabola to the peak of the cross-correlation.
+
+    Parameters
+    ----------
+    signal : numpy.ndarray
+        Signal with maxima near `positions`, as returned
+        by :func:`filtered_cross_section`
+    positions : array_like
+        Expected positions of the maxima, in pixels
+    sigma : float
+        Width of the lines of the comb
+    max_offset : int
+        Maximum offset searched
+
+    Returns
+    -------
+    offset : float
+        Offset refined to a fraction of pixel
+    offsets : numpy.ndarray
+        The integer offsets
+    correlation : numpy.ndarray
+        The cross-correlation for each integer offset
+
+    """
+    signal = numpy.asarray(signal, dtype='float')
+    naxis1 = len(signal)
+    _, comb = comb_template(positions, naxis1 + 2 * max_offset, sigma=sigma,
+                            start=-max_offset)
+    # The comb shifted by ioffset is comb[max_offset - ioffset:][:naxis1]
+    correlation = scipy.signal.correlate(comb, signal, mode='valid', method='fft')
+    correlation = correlation[::-1]
+    offsets = numpy.arange(-max_offset, max_offset + 1)
+
+    ipeak = correlation.argmax()
+    offset = float(offsets[ipeak])
+    if 0 < ipeak < len(correlation) - 1:
+        ym, y0, yp = correlation[ipeak - 1: ipeak + 2]
+        denom = ym - 2 * y0 + yp
+        if denom < 0:
+            offset += 0.5 * (ym - yp) / denom
+    return offset, offsets, correlation
+
+
+def refine_boxes(signal, expected, nsearch=20, offset=0):
+    """Maxima of signal within nsearch pixels of expected + offset"""
+    refined = []
+    for box in expected:
+        box_ini = max(box - nsearch + offset, 0)
+        box_end = box + nsearch + 1 + offset
+        refined.append(int(signal[box_ini:box_end].argmax()) + box_ini)
+    return refined
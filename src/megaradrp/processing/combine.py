@@ -1,5 +1,5 @@
 #
-# Copyright 2016-2019 Universidad Complutense de Madrid
+# Copyright 2016-2021 Universidad Complutense de Madrid
 #
 # This file is part of Megara DRP
 #
@@ -16,26 +16,49 @@ try:
 except ImportError:
     import contextlib
 
+import os
+import logging
+import datetime
+import uuid
+
+import numpy
+import astropy.io.fits as fits
 from numina.array import combine
+from numina.datamodel import get_imgid
 from numina.processing.combine import combine_imgs
+import numina.util.flow as flowmod
+import numina.util.node as node
+
+import megaradrp.core.parallel as parallel
+from megaradrp.core.utils import create_fits_primary, append_fits_image
+from megaradrp.processing.trimover import OverscanCorrector, TrimImage
+from megaradrp.processing.trimover import OverscanTrimCorrector, promote_uint16
+
+
+_logger = logging.getLogger(__name__)
+
+TILE_ROWS_ENV = 'MEGARADRP_TILE_ROWS'
+# Rows of each block in tiled combination
+TILE_ROWS = 256
 
 
 def basic_processing_with_combination(
         rinput, reduction_flows,
         method=combine.mean, method_kwargs=None,
-        errors=True, prolog=None):
+        errors=True, prolog=None, processes=None, tile_rows=None):
 
     return basic_processing_with_combination_frames(
         rinput.obresult.frames, reduction_flows,
         method=method, method_kwargs=method_kwargs,
-        errors=errors, prolog=prolog
+        errors=errors, prolog=prolog, processes=processes,
+        tile_rows=tile_rows
     )
 
 
 def basic_processing_with_combination_frames(
         frames, reduction_flows,
         method=combine.mean, method_kwargs=None,
-        errors=True, prolog=None):
+        errors=True, prolog=None, processes=None, tile_rows=None):
     """Perform basic reduction on set of DataFrames
 
     The reduction_flows are split in two parts.
@@ -43,9 +66,45 @@ def basic_processing_with_combination_frames(
     Then images are combined according to method and method_kwargs
     The resulting image is then processed with the
     second flow (bias, dark, gain and flat-fielding)
+
+    If `processes` is larger than 1, the first part runs in a pool of
+    worker processes, writing the images in shared memory. The images
+    are combined in the order of `frames`, as in the serial case.
+    If `processes` is None, the number of processes is read
+    from MEGARADRP_PROCESSES.
+
+    If `tile_rows` is larger than 0, and the first part only
+    contains overscan correction and trimming, the images are
+    processed and combined in blocks of `tile_rows` rows, without
+    holding the images in memory. See :func:`combine_frames_tiled`.
+    If `tile_rows` is None, the number of rows is read
+    from MEGARADRP_TILE_ROWS.
     """
     reduction_flow_ot, reduction_flow_1im = reduction_flows
 
+    if tile_rows is None:
+        tile_rows = default_tile_rows()
+
+    if tile_rows > 0:
+        if tiled_correctors(reduction_flow_ot) is not None:
+            hdu_combined = combine_frames_tiled(
+                frames, reduction_flow_ot, method=method, method_kwargs=method_kwargs,
+                errors=errors, prolog=prolog, tile_rows=tile_rows
+            )
+            return reduction_flow_1im(hdu_combined)
+        _logger.debug('the flow cannot be applied by blocks, combining whole images')
+
+    if processes is None:
+        processes = parallel.default_processes()
+
+    if processes > 1 and len(frames) > 1 and parallel.is_available():
+        _logger.debug('processing %d frames with %d processes', len(frames), processes)
+        with parallel.SharedExecutor(processes) as executor:
+            hdul_ot = _parallel_flow(executor, frames, reduction_flow_ot)
+            hdu_combined = combine_imgs(hdul_ot, method=method, method_kwargs=method_kwargs,
+                                        errors=errors, prolog=prolog)
+        return reduction_flow_1im(hdu_combined)
+
     with contextlib.ExitStack() as stack:
         hduls = [stack.enter_context(dframe.open()) for dframe in frames]
 
@@ -56,4 +115,302 @@ def basic_processing_with_combination_frames(
 
         result = reduction_flow_1im(hdu_combined)
 
-    return result
\ No newline at end of file
+    return result
+
+
+def _detach_data(hdul, out=None):
+    # Copy the primary data to out and return the HDUs without it
+    if out is not None:
+        out[...] = hdul[0].data
+    primary = fits.PrimaryHDU(header=hdul[0].header.copy())
+    others = [hdu.copy() for hdu in hdul[1:]]
+    return primary, others
+
+
+def _reduce_frame(arrays, idx, dframe, flow):
+    with dframe.open() as hdul:
+        hdul_ot = flow(hdul)
+        return _detach_data(hdul_ot, arrays['frames'][idx])
+
+
+def _parallel_flow(executor, frames, flow):
+    """Apply flow to the frames in the pool of executor.
+
+    The first frame is processed in this process, to obtain the shape
+    and type of the results. The data of the results is stored in
+    the shared array 'frames' of the executor.
+    """
+    with frames[0].open() as hdul:
+        first = flow(hdul)
+        data = first[0].data
+        arr = executor.array('frames', (len(frames),) + data.shape, data.dtype)
+        headers = [_detach_data(first, arr[0])]
+
+    tasks = [(idx, dframe, flow) for idx, dframe in enumerate(frames[1:], 1)]
+    headers.extend(executor.run(_reduce_frame, tasks))
+
+    hdul_ot = []
+    for idx, (primary, others) in enumerate(headers):
+        primary.data = arr[idx]
+        hdul_ot.append(fits.HDUList([primary] + others))
+    return hdul_ot
+
+
+def default_tile_rows():
+    """Return the rows of the blocks configured in the environment.
+
+    The number is read from MEGARADRP_TILE_ROWS, 0 (the default)
+    means that the images are combined whole.
+    """
+    value = os.environ.get(TILE_ROWS_ENV, '0')
+    try:
+        return max(0, int(value))
+    except ValueError:
+        _logger.warning('invalid value %r for %s', value, TILE_ROWS_ENV)
+        return 0
+
+
+def tiled_correctors(flow):
+    """Overscan and trimming correctors of a flow that can work by blocks.
+
+    Returns a tuple (overscan, trimming), with None in the correctors
+    not present in the flow, or None if the flow contains other
+    nodes and has to be applied to whole images.
+    """
+    nodes = list(flow) if isinstance(flow, flowmod.SerialFlow) else [flow]
+    nodes = [nd for nd in nodes if type(nd) is not node.IdNode]
+    types = [type(nd) for nd in nodes]
+    if not nodes:
+        return None, None
+    if types == [TrimImage]:
+        return None, nodes[0]
+    if types == [OverscanTrimCorrector] and nodes[0].gain is None:
+        return nodes[0].overscan, nodes[0].trimming
+    if types == [OverscanCorrector, TrimImage]:
+        overscan, trimming = nodes
+        # The overscan is subtracted in the regions kept by trimming
+        if [overscan.trim1, overscan.trim2] == trimming.regions():
+            return overscan, trimming
+    return None
+
+
+class _PromotedSection(object):
+    # Read regions of the data of a HDU, promoted as in numina.processing.Corrector
+    # Sections of complete rows are much faster to read, the rows
+    # are read in blocks and then the columns are selected
+    def __init__(self, hdu, block_rows=TILE_ROWS):
+        self.section = hdu.section
+        self.shape = hdu.shape
+        self.block_rows = block_rows
+
+    def __getitem__(self, key):
+        rows, cols = key
+        start, stop, _ = rows.indices(self.shape[0])
+        parts = [self.section[beg:min(beg + self.block_rows, stop)][:, cols]
+                 for beg in range(start, stop, self.block_rows)]
+        data = numpy.concatenate(parts) if len(parts) != 1 else parts[0]
+        return promote_uint16(data)
+
+
+class _MappedRegions(object):
+    # Regions of the raw data of a HDU, memory-mapped, so that only the
+    # pages containing the region are read. The values are scaled and
+    # promoted as in numina.processing.Corrector
+    def __init__(self, data, bzero=0):
+        self.data = data
+        self.shape = data.shape
+        self.bzero = bzero
+
+    def __getitem__(self, key):
+        region = self.data[key]
+        if self.bzero:
+            # Unsigned 16 bits, exact in float32
+            return region.astype('float32') + numpy.float32(self.bzero)
+        return numpy.array(region)
+
+
+def _overscan_regions(stack, dframe, hdul, block_rows=TILE_ROWS):
+    """Regions of a frame, reading only the data required to fit the overscan"""
+    if dframe.frame is not None:
+        # Already in memory
+        return _MappedRegions(hdul[0].data)
+    raw = stack.enter_context(
+        fits.open(dframe.filename, memmap=True, do_not_scale_image_data=True)
+    )
+    header = raw[0].header
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return _MappedRegions(raw[0].data)
+    if bscale == 1 and bzero == 32768 and header['BITPIX'] == 16:
+        return _MappedRegions(raw[0].data, bzero=bzero)
+    # Other scalings are read by blocks of complete rows
+    return _PromotedSection(hdul[0], block_rows)
+
+
+class _TiledFrame(object):
+    """Blocks of rows of a frame, corrected from overscan and trimmed"""
+    def __init__(self, hdul, data, overscan=None, trimming=None, fits_amps=None):
+        self.imgid = get_imgid(hdul)
+        self.header = hdul[0].header.copy()
+        for key in ['BSCALE', 'BZERO', 'BLANK']:
+            self.header.remove(key, ignore_missing=True)
+        self.data = data
+        nrows, ncols = self.data.shape
+        if trimming is None:
+            self.regions = [(slice(0, nrows), slice(0, ncols))]
+        else:
+            self.regions = trimming.regions()
+        self.offsets = None
+        if overscan is not None:
+            self.offsets = overscan.row_offsets(fits_amps, nrows)
+            overscan.update_header(self.header, fits_amps)
+        if trimming is not None:
+            trimming.update_header(self.header)
+        self.shape = (
+            sum(rows.stop - rows.start for rows, _ in self.regions),
+            self.regions[0][1].stop - self.regions[0][1].start
+        )
+
+    def read(self, start, stop):
+        """Rows from start to stop of the processed frame"""
+        result = numpy.empty((stop - start, self.shape[1]), dtype='float32')
+        base = 0
+        for rows, cols in self.regions:
+            size = rows.stop - rows.start
+            beg, end = max(start, base), min(stop, base + size)
+            if beg < end:
+                raw = slice(rows.start + beg - base, rows.start + end - base)
+                block = self.data[raw, cols]
+                if self.offsets is not None:
+                    block -= self.offsets[raw, numpy.newaxis]
+                result[beg - start:end - start] = block
+            base += size
+        return result
+
+
+def combine_frames_tiled(frames, reduction_flow, method=combine.mean, method_kwargs=None,
+                         errors=True, prolog=None, tile_rows=TILE_ROWS, filename=None):
+    """Correct and combine frames in blocks of rows.
+
+    The overscan of all the frames is fitted first, see
+    :meth:`OverscanCorrector.fit_frames`. The raw data of the frames is
+    memory-mapped, so that only the pages containing the overscan columns
+    are read; the images with a scaling other than unsigned 16 bits
+    are read completely. Then, each block of rows is
+    corrected from overscan and trimmed in all the frames, and then
+    combined, so that the memory used is proportional to
+    `tile_rows` times the number of frames. The result is the same
+    as applying `reduction_flow` to the whole frames and combining
+    them with :func:`numina.processing.combine.combine_imgs`.
+
+    Parameters
+    ----------
+    frames : list of DataFrame
+    reduction_flow : numina.util.node.Node
+        A flow with overscan correction and trimming only,
+        see :func:`tiled_correctors`
+    method : callable
+        Combination method, from numina.array.combine
+    method_kwargs : dict, optional
+    errors : bool
+        If True, the VARIANCE and MAP extensions are computed
+    prolog : str, optional
+        Added to the history of the result
+    tile_rows : int
+        Number of rows of each block
+    filename : str, optional
+        If given, the result is written in this file block by block,
+        and returned memory-mapped
+
+    Returns
+    -------
+    fits.HDUList
+
+    """
+    cnum = len(frames)
+    if cnum == 0:
+        raise ValueError('number of frames == 0')
+    correctors = tiled_correctors(reduction_flow)
+    if correctors is None:
+        raise ValueError('the flow cannot be applied by blocks')
+    tile_rows = max(1, tile_rows)
+
+    method_kwargs = dict(method_kwargs or {})
+    method_kwargs.setdefault('dtype', 'float32')
+
+    with contextlib.ExitStack() as stack:
+        hduls = [stack.enter_context(dframe.open()) for dframe in frames]
+        sections = [_PromotedSection(hdul[0], tile_rows) for hdul in hduls]
+        overscan, trimming = correctors
+        if overscan is not None:
+            regions = [_overscan_regions(stack, dframe, hdul, tile_rows)
+                       for dframe, hdul in zip(frames, hduls)]
+            fits_frames = overscan.fit_frames(regions)
+        else:
+            fits_frames = [None] * cnum
+        tiled = [_TiledFrame(hdul, data, overscan, trimming, fits_amps)
+                 for hdul, data, fits_amps in zip(hduls, sections, fits_frames)]
+        shape = tiled[0].shape
+        for idx, frame in enumerate(tiled):
+            if frame.shape != shape:
+                raise ValueError(f'frame {idx} has shape {frame.shape}, expected {shape}')
+
+        header = _combined_header(tiled, method, prolog)
+        extensions = [hdu.copy() for hdu in hduls[0][1:]]
+        outputs = _combined_outputs(filename, header, extensions, shape, errors)
+
+        _logger.info(f"stacking {cnum:d} images using '{method.__name__}' "
+                     f"in blocks of {tile_rows:d} rows")
+        for start in range(0, shape[0], tile_rows):
+            stop = min(start + tile_rows, shape[0])
+            tiles = [frame.read(start, stop) for frame in tiled]
+            combined = method(tiles, **method_kwargs)
+            for out, values in zip(outputs, combined):
+                out[start:stop] = values
+
+    if filename is not None:
+        for out in outputs:
+            out.flush()
+        del outputs
+        return fits.open(filename, memmap=True)
+
+    result = fits.HDUList([fits.PrimaryHDU(outputs[0], header=header)])
+    result.extend(extensions)
+    if errors:
+        result.append(fits.ImageHDU(outputs[1], name='VARIANCE'))
+        result.append(fits.ImageHDU(outputs[2], name='MAP'))
+    return result
+
+
+def _combined_header(tiled, method, prolog):
+    # As in numina.processing.combine.combine_imgs
+    cnum = len(tiled)
+    header = tiled[0].header.copy()
+    if prolog:
+        header['history'] = prolog
+    header['history'] = f"Combined {cnum:d} images using '{method.__name__}'"
+    header['history'] = f'Combination time {datetime.datetime.utcnow().isoformat()}'
+    for frame in tiled:
+        header['history'] = f"Image {frame.imgid}"
+    prevnum = header.get('NUM-NCOM', 1)
+    header['NUM-NCOM'] = prevnum * cnum
+    header['UUID'] = str(uuid.uuid1())
+    return header
+
+
+def _combined_outputs(filename, header, extensions, shape, errors):
+    # Arrays for the combined image, and variance and map if errors
+    dtypes = ['float32', 'float32', 'int16'] if errors else ['float32']
+    if filename is None:
+        return [numpy.empty(shape, dtype=dtype) for dtype in dtypes]
+
+    outputs = [create_fits_primary(filename, header, shape, dtype=dtypes[0])]
+    if extensions:
+        with fits.open(filename, mode='append') as hdul:
+            hdul.extend(extensions)
+    for name, dtype in zip(['VARIANCE', 'MAP'], dtypes[1:]):
+        hdr = fits.Header()
+        hdr['EXTNAME'] = name
+        outputs.append(append_fits_image(filename, hdr, shape, dtype=dtype))
+    return outputs
@@ -15,15 +15,18 @@ van de Ville et al. IEEE Transactions on Image Processing 2004, 13, 6
 
 from __future__ import print_function
 
+import math
+
 import numpy as np
-from scipy import signal
+import scipy.sparse as sparse
 import astropy.units as u
 import astropy.wcs
+import astropy.io.fits as fits
 from numina.frame.utils import copy_img
 
 from megaradrp.instrument.focalplane import FocalPlaneConf
 # from megaradrp.datamodel import MegaraDataModel
-from megaradrp.core.utils import atleast_2d_last
+from megaradrp.core.utils import atleast_2d_last, create_fits_primary
 import megaradrp.processing.fixrss as fixrss
 import megaradrp.processing.hexgrid as hg
 import megaradrp.processing.hexspline as hspline
@@ -34,6 +37,9 @@ GTC_PLATESCALE = u.plate_scale(cons.GTC_FC_A_PLATESCALE)
 # Size scale of the spaxel grid in arcseconds
 HEX_SCALE = cons.SPAXEL_SCALE.to(u.arcsec, GTC_PLATESCALE).value
 
+# Number of channels computed at once when the cube is written to disk
+CUBE_CHUNK = 256
+
 
 def calc_matrix_from_fiberconf(fpconf, refid=614):
     """
@@ -61,6 +67,16 @@ def calc_matrix_from_fiberconf(fpconf, refid=614):
     # FIBER in LOW LEFT corner is 614
     ref_fiber = fpconf.fibers[refid]
     minx, miny = ref_fiber.x, ref_fiber.y
+    ascale = focal_plane_scale(fpconf)
+    ref = minx / ascale, miny / ascale
+    rpos1_x = (spos1_x - minx) / ascale
+    rpos1_y = (spos1_y - miny) / ascale
+    r0l_1 = np.array([rpos1_x, rpos1_y])
+    return r0l_1, ref
+
+
+def focal_plane_scale(fpconf):
+    """Size of the spaxels in the units of the fiber positions"""
     if fpconf.funit == 'arcsec':
         # arcsec
         ascale = HEX_SCALE
@@ -68,11 +84,7 @@ def calc_matrix_from_fiberconf(fpconf, refid=614):
         # mm
         # fpconf.funit == 'mm'
         ascale = cons.SPAXEL_SCALE.to(u.mm).value
-    ref = minx / ascale, miny / ascale
-    rpos1_x = (spos1_x - minx) / ascale
-    rpos1_y = (spos1_y - miny) / ascale
-    r0l_1 = np.array([rpos1_x, rpos1_y])
-    return r0l_1, ref
+    return ascale
 
 
 def create_cube(r0l, zval, p=1, target_scale=1.0):
@@ -88,6 +100,33 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     Returns
     -------
 
+    Raises
+    ------
+    ValueError
+        If `p` > 2
+
+    """
+    weights, shape = calc_cube_weights(r0l, p, target_scale)
+    return reconstruct_cube(weights, shape, zval, p)
+
+
+def calc_cube_weights(r0l, p=1, target_scale=1.0):
+    """Weights of the fibers in the pixels of the cube
+
+    Parameters
+    ----------
+    r0l : np.ndarray
+        Positions of the fibers in the hexagonal grid, with shape (2, nfibers)
+    p : {1, 2}
+    target_scale : float, optional
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Matrix with shape (npixels, nfibers), see :func:`calc_weights`
+    shape : tuple
+        Spatial shape of the cube, (rows, columns)
+
     Raises
     ------
     ValueError
@@ -101,27 +140,14 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     if p > 2:
         raise ValueError('p > 2 not implemented')
 
-    rr1 = target_scale * np.array([[1.0, 0], [0, 1]])  # Unit scale
-
     # compute extremes of hexgrid to rectangular grid
     # with pixel size 'scale'
 
     (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
 
     # Rectangular grid
-    mk1 = np.arange(i1min, i1max + 1)
-    mk2 = np.arange(j1min, j1max + 1)
-    crow = len(mk1)
-    ccol = len(mk2)
-    # Result image
-    # Add third last axis
-    zval2 = atleast_2d_last(zval)
-    # disp axis is last axis...
-    dk = np.zeros((crow, ccol, zval2.shape[-1]))
-    # print('result shape is ', dk.shape)
-    # r1k = rr1 @ sk
-    sk = np.flipud(np.transpose([np.tile(mk1, len(mk2)), np.repeat(mk2, len(mk1))]).T)  # x y
-    r1k = np.dot(rr1, sk)
+    crow = i1max - i1min + 1
+    ccol = j1max - j1min + 1
 
     # Prefiltering
     # For p = 1, prefilter coefficients with p = 1, coeff = 1
@@ -129,12 +155,38 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     # No prefiltering in zval2 is required if p <= 2
 
     rbs = hspline.rescaling_kernel(p, scale=target_scale)
+    support = hspline.rescaling_kernel_support(p, scale=target_scale)
+    weights = calc_weights(r0l, target_scale, rbs, support)
+    return weights, (crow, ccol)
+
+
+def reconstruct_cube(weights, shape, zval, p=1):
+    """Compute the cube from the values of the fibers
+
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        Weights of the fibers, from :func:`calc_cube_weights`
+    shape : tuple
+        Spatial shape of the cube
+    zval : np.ndarray
+        Values of the fibers, with shape (nfibers,) or (nfibers, nwave)
+    p : {1, 2}
+
+    Returns
+    -------
+    np.ndarray
+        Cube with shape (rows, columns, nwave)
+
+    """
+    crow, ccol = shape
+    # Result image
+    # Add third last axis
+    zval2 = atleast_2d_last(zval)
 
-    # Loop to compute integrals...
-    for s, r in zip(sk.T, r1k.T):
-        allpos = -(r0l - r[:, np.newaxis])
-        we = np.abs((rbs.ev(allpos[1], allpos[0])))
-        dk[s[1] - i1min, s[0] - j1min] = np.sum(we[:, np.newaxis] * zval2, axis=0)
+    # Compute the integrals of all the pixels
+    # disp axis is last axis...
+    dk = (weights @ zval2).reshape((crow, ccol, zval2.shape[-1]))
 
     # Postfiltering
     # For p = 1, final image in NN, postfilter coefficients with n = 1
@@ -147,10 +199,7 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
         img = cpk
     elif p == 2:
         # Coefficients post filtering to n = 2 * p - 1 == 3
-        cpk = np.zeros_like(dk)
-        # last axis
-        for k in range(dk.shape[-1]):
-            cpk[..., k] = signal.cspline2d(dk[..., k])
+        cpk = cspline_postfilter(dk)
         # Linear samples equal to coefficients
         img = cpk
     else:
@@ -159,6 +208,121 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     return img
 
 
+def calc_weights(r0l, target_scale, kernel, support):
+    """Sparse matrix with the weights of the fibers in the rectangular grid
+
+    The rectangular grid covers the extremes of the hexagonal grid, as
+    computed by :func:`megaradrp.processing.hexgrid.hexgrid_extremes`.
+    The kernel is evaluated only for the pixels closer than
+    `support` (in both axes) to each fiber.
+
+    Parameters
+    ----------
+    r0l : np.ndarray
+        Positions of the fibers in the hexagonal grid, with shape (2, nfibers)
+    target_scale : float
+        Size of the pixels of the rectangular grid
+    kernel : scipy.interpolate.RectBivariateSpline
+        Rescaling kernel, evaluated as kernel.ev(y, x)
+    support : float
+        Half size of the square outside of which the kernel is 0
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix with shape (npixels, nfibers). The pixels are ordered
+        by rows of the rectangular grid
+    """
+    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
+    crow = i1max - i1min + 1
+    ccol = j1max - j1min + 1
+    nfibers = r0l.shape[1]
+
+    # Pixels around each fiber
+    x0, y0 = r0l
+    jmin = np.ceil((x0 - support) / target_scale).astype('int')
+    imin = np.ceil((y0 - support) / target_scale).astype('int')
+    nstencil = int(math.ceil(2 * support / target_scale)) + 1
+    stencil = np.arange(nstencil)
+    ii = (imin[:, np.newaxis] + stencil)[:, :, np.newaxis]
+    jj = (jmin[:, np.newaxis] + stencil)[:, np.newaxis, :]
+    ii, jj = np.broadcast_arrays(ii, jj)
+    fibers = np.broadcast_to(np.arange(nfibers)[:, np.newaxis, np.newaxis], ii.shape)
+
+    dx = target_scale * jj - x0[:, np.newaxis, np.newaxis]
+    dy = target_scale * ii - y0[:, np.newaxis, np.newaxis]
+    mask = (np.abs(dx) <= support) & (np.abs(dy) <= support)
+    mask &= (ii >= i1min) & (ii <= i1max) & (jj >= j1min) & (jj <= j1max)
+
+    we = np.abs(kernel.ev(dy[mask], dx[mask]))
+    pixels = (ii[mask] - i1min) * ccol + (jj[mask] - j1min)
+    weights = sparse.coo_matrix(
+        (we, (pixels, fibers[mask])), shape=(crow * ccol, nfibers)
+    )
+    return weights.tocsr()
+
+
+# Number of channels post filtered at once
+POSTFILTER_CHUNK = 256
+
+
+def _symiirorder1(arr, c0, z1, precision):
+    # Filter c0 / ((1 - z1 / z) (1 - z1 z)) along the first axis, in place,
+    # with mirror-symmetric boundary conditions, as signal.symiirorder1
+    n = arr.shape[0]
+    nterms = min(n, int(math.ceil(math.log(precision) / math.log(abs(z1)))))
+    powers = z1 ** np.arange(1, nterms + 1)
+    arr[0] += np.tensordot(powers, arr[:nterms], axes=1)
+    for i in range(1, n):
+        arr[i] += z1 * arr[i - 1]
+    arr[-1] *= c0 / (1.0 - z1)
+    for i in range(n - 2, -1, -1):
+        arr[i] *= c0
+        arr[i] += z1 * arr[i + 1]
+    return arr
+
+
+def cspline_postfilter(cube, precision=-1.0):
+    """Cubic B-spline coefficients of each channel of a cube
+
+    The result is equal to calling :func:`scipy.signal.cspline2d` in
+    each channel (the last axis), but the recursive filters are run
+    along both spatial axes for groups of POSTFILTER_CHUNK channels at
+    once. Unlike cspline2d, images smaller than the length of the sum
+    of the boundary conditions are allowed, the sum is truncated.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Array with shape (rows, columns, channels)
+    precision : float
+        Precision of the sum used to compute the mirror-symmetric
+        boundary conditions. If not in (0, 1), it is 1e-3 for single
+        precision arrays and 1e-6 otherwise
+
+    Returns
+    -------
+    np.ndarray
+        Coefficients with the same shape as cube
+    """
+    cube = np.asarray(cube)
+    if cube.dtype not in [np.float32, np.float64]:
+        cube = cube.astype('float64')
+    if precision <= 0.0 or precision >= 1.0:
+        precision = 1e-3 if cube.dtype == np.float32 else 1e-6
+
+    z1 = -2 + math.sqrt(3.0)
+    c0 = -6.0 * z1
+    out = np.empty_like(cube)
+    for k in range(0, cube.shape[-1], POSTFILTER_CHUNK):
+        chunk = out[..., k:k + POSTFILTER_CHUNK]
+        chunk[...] = cube[..., k:k + POSTFILTER_CHUNK]
+        # Columns first, then rows, as cspline2d
+        _symiirorder1(np.moveaxis(chunk, 1, 0), c0, z1, precision)
+        _symiirorder1(chunk, c0, z1, precision)
+    return out
+
+
 def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     """
     Create a cube array from a 2D or 1D array and focal plane configuration
@@ -194,38 +358,74 @@ def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, co
     # Move axis to put WL first
     # so that is last in FITS
     result = np.moveaxis(cube_data, 2, 0)
-    result.astype('float32')
-    return result
+    return result.astype('float32')
 
 
-def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
+def iter_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0,
+                         conserve_flux=True, chunk_size=CUBE_CHUNK):
     """
-    Create a cube HDUlist from a RSS HDUList
+    Create a cube from a 2D array, in groups of `chunk_size` channels
+
+    The weights of the fibers are computed once. Only the
+    channels of one group are converted to float64.
 
     Parameters
     ----------
-    rss : fits.HDUList
+    rss_data
+    fiberconf : megaradrp.instrument.focalplane.FocalPlaneConf
     p : {1, 2}
-    target_scale_arcsec : float, optional
-    conserve_flux : bool, optional
+    target_scale_arcsec : float
+    conserve_flux : bool
+    chunk_size : int
+        Number of channels computed at once
+
+    Yields
+    ------
+    slice
+        The channels of the group
+    np.ndarray
+        float32 array with shape (channels, rows, columns)
 
-    Returns
-    -------
-    fits.HDUList
     """
+    target_scale = target_scale_arcsec / HEX_SCALE
+    conected = fiberconf.connected_fibers()
+    rows = [conf.fibid - 1 for conf in conected]
 
-    fiberconf = FocalPlaneConf.from_img(rss)
-    result_arr = create_cube_from_array(
-        rss[0].data, fiberconf, p=p,
-        target_scale_arcsec=target_scale_arcsec,
-        conserve_flux=conserve_flux
-    )
+    rss_data = atleast_2d_last(rss_data)
+    nwave = rss_data.shape[-1]
+
+    r0l, _ = calc_matrix_from_fiberconf(fiberconf)
+    weights, shape = calc_cube_weights(r0l, p, target_scale)
+
+    for k in range(0, nwave, chunk_size):
+        channels = slice(k, min(k + chunk_size, nwave))
+        region = np.asarray(rss_data[rows, channels], dtype='float64')
+        cube_data = reconstruct_cube(weights, shape, region, p)
+        if conserve_flux:
+            # scale with areas
+            cube_data *= (target_scale ** 2 / hg.HA_HEX)
+        yield channels, np.moveaxis(cube_data, 2, 0).astype('float32')
 
-    cube = copy_img(rss)
-    cube[0].data = result_arr
 
-    sky_header = rss['FIBERS'].header.copy()
-    spec_header = rss[0].header
+def update_cube_header(hdr, fibers_header, spec_header, r0l, ref, target_scale_arcsec):
+    """Add the WCS of a reconstructed cube to hdr
+
+    Parameters
+    ----------
+    hdr : fits.Header
+        Header of the cube
+    fibers_header : fits.Header
+        Header with the sky WCS of the fibers
+    spec_header : fits.Header
+        Header with the spectral WCS
+    r0l : np.ndarray
+        Positions of the fibers in the hexagonal grid
+    ref : tuple
+        Position of the origin of the hexagonal grid, as returned
+        by :func:`calc_matrix_from_fiberconf`
+    target_scale_arcsec : float
+    """
+    sky_header = fibers_header.copy()
     # Update values of sky WCS
     # CRPIX1, CRPIX2
     # CDELT1, CDELT2
@@ -233,7 +433,7 @@ def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     # After shifting the array
     # refpixel is -i1min, -j1min
     target_scale = target_scale_arcsec / HEX_SCALE
-    r0l, (refx, refy) = calc_matrix_from_fiberconf(fiberconf)
+    refx, refy = ref
     (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
     crpix_x = -refx / target_scale - j1min
     crpix_y = -refy / target_scale - i1min
@@ -246,12 +446,89 @@ def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     # Merge headers
     # 2D from FIBERS
     # WL from PRIMARY
-    merge_wcs(sky_header, spec_header, out=cube[0].header)
+    merge_wcs(sky_header, spec_header, out=hdr)
+    return hdr
+
+
+def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
+    """
+    Create a cube HDUlist from a RSS HDUList
+
+    Parameters
+    ----------
+    rss : fits.HDUList
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+
+    Returns
+    -------
+    fits.HDUList
+    """
+
+    fiberconf = FocalPlaneConf.from_img(rss)
+    result_arr = create_cube_from_array(
+        rss[0].data, fiberconf, p=p,
+        target_scale_arcsec=target_scale_arcsec,
+        conserve_flux=conserve_flux
+    )
+
+    cube = copy_img(rss)
+    cube[0].data = result_arr
+    r0l, ref = calc_matrix_from_fiberconf(fiberconf)
+    update_cube_header(cube[0].header, rss['FIBERS'].header, rss[0].header,
+                       r0l, ref, target_scale_arcsec)
 
     # done
     return cube
 
 
+def write_cube_from_rss(rss, filename, p=1, target_scale_arcsec=1.0,
+                        conserve_flux=True, chunk_size=CUBE_CHUNK):
+    """
+    Create a cube from a RSS HDUList, writing it directly in a FITS file
+
+    The file has the same contents as the output of
+    :func:`create_cube_from_rss`. Its primary HDU is created
+    with its final size and filled through a memory map, in groups
+    of `chunk_size` channels, so the full cube is never in memory.
+
+    Parameters
+    ----------
+    rss : fits.HDUList
+    filename : str
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+    chunk_size : int, optional
+        Number of channels computed at once
+    """
+    fiberconf = FocalPlaneConf.from_img(rss)
+    target_scale = target_scale_arcsec / HEX_SCALE
+    r0l, ref = calc_matrix_from_fiberconf(fiberconf)
+    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
+    nwave = atleast_2d_last(rss[0].data).shape[-1]
+    shape = (nwave, i1max - i1min + 1, j1max - j1min + 1)
+
+    hdr = rss[0].header.copy()
+    update_cube_header(hdr, rss['FIBERS'].header, rss[0].header,
+                       r0l, ref, target_scale_arcsec)
+    data = create_fits_primary(filename, hdr, shape, dtype='float32')
+    try:
+        for channels, planes in iter_cube_from_array(
+                rss[0].data, fiberconf, p=p,
+                target_scale_arcsec=target_scale_arcsec,
+                conserve_flux=conserve_flux, chunk_size=chunk_size):
+            data[channels] = planes
+        data.flush()
+    finally:
+        del data
+
+    # The other extensions are copied
+    for hdu in rss[1:]:
+        fits.append(filename, hdu.data, hdu.header)
+
+
 def merge_wcs(hdr_sky, hdr_spec, out=None):
     """Merge sky WCS with spectral WCS
 
@@ -362,7 +639,6 @@ def merge_wcs_alt(hdr_sky, hdr_spec, out, spec_suffix=' '):
 
 def main(args=None):
     import argparse
-    import astropy.io.fits as fits
 
     # parse command-line options
     parser = argparse.ArgumentParser(prog='convert_rss_cube')
@@ -371,7 +647,7 @@ def main(args=None):
     methods = {'nn': 1, 'linear': 2}
 
     parser.add_argument("rss",
-                        help="RSS file with fiber traces",
+                        help="RSS or multi RSS file with fiber traces",
                         type=argparse.FileType('rb'))
     parser.add_argument('-p', '--pixel-size', type=float, default=0.3,
                         metavar='PIXEL_SIZE',
@@ -386,6 +662,8 @@ def main(args=None):
                         help="Use PA angle from header", dest='pa_from_header')
     parser.add_argument('--fix-missing', action='store_true',
                         help="Interpolate missing fibers")
+    parser.add_argument('--chunk-size', type=int, default=CUBE_CHUNK,
+                        help="Number of channels computed at once")
 
     args = parser.parse_args(args=args)
 
@@ -396,6 +674,28 @@ def main(args=None):
     conserve_flux = not args.disable_scaling
 
     with fits.open(args.rss) as rss:
+        if 'MEG-NRSS' in rss[0].header:
+            from megaradrp.processing.mosaic import write_mosaic_cube_from_rss
+            nrss = rss[0].header['MEG-NRSS']
+            print('reconstruct mosaic of', nrss, 'pointings')
+            nfibers = rss[0].shape[0] // nrss
+            for idx in range(nrss):
+                fibers = rss[f'FIBERS{idx + 1}']
+                if not args.pa_from_header:
+                    # Each pointing has its own IPA, the first one is
+                    # also in the primary header
+                    ipa = fibers.header.get('IPA', rss['PRIMARY'].header['IPA'])
+                    print(f'recompute WCS of pointing {idx + 1} from IPA')
+                    fibers.header = fixrss.recompute_wcs(fibers.header, ipa=ipa)
+                if args.fix_missing:
+                    fibid = 623
+                    print(f'interpolate fiber {fibid} of pointing {idx + 1}')
+                    data = rss[0].data[idx * nfibers:(idx + 1) * nfibers]
+                    fixrss.fix_missing_fiber_data(data, fibers.header, fibid)
+            write_mosaic_cube_from_rss(rss, args.outfile, p, target_scale,
+                                       conserve_flux=conserve_flux,
+                                       chunk_size=args.chunk_size)
+            return
         if not args.pa_from_header:
             # Doing it here so the change is propagated to
             # all alternative coordinates
@@ -407,9 +707,9 @@ def main(args=None):
             print(f'interpolate fiber {fibid}')
             rss = fixrss.fix_missing_fiber(rss, fibid)
 
-        cube = create_cube_from_rss(rss, p, target_scale, conserve_flux=conserve_flux)
-
-    cube.writeto(args.outfile, overwrite=True)
+        write_cube_from_rss(rss, args.outfile, p, target_scale,
+                            conserve_flux=conserve_flux,
+                            chunk_size=args.chunk_size)
 
 
 if __name__ == '__main__':
@@ -42,8 +42,10 @@ class CommonFlatCorrector(Corrector):
         _logger.debug('correct %s in image %s', self.flattag, imgid)
 
         # Avoid nan values when divide
+        # The data can be shared, it is not modified in place
         my_mask = self.corr == 0.0
-        self.corr[my_mask] = 1.0
+        if my_mask.any():
+            self.corr = numpy.where(my_mask, 1.0, self.corr).astype(self.corr.dtype)
 
         img['primary'].data /= self.corr
         hdr = img['primary'].header
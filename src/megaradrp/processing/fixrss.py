@@ -20,13 +20,18 @@ import megaradrp.processing.wcs as mwcs
 
 def fix_missing_fiber(rss, fibid):
     """Interpolate missing fiber fibid"""
-    hdr = rss['FIBERS'].header
-    fp = FocalPlaneConf.from_img(rss)
+    fix_missing_fiber_data(rss[0].data, rss['FIBERS'].header, fibid)
+    return rss
+
+
+def fix_missing_fiber_data(data, hdr, fibid):
+    """Interpolate missing fiber fibid in data, described by the FIBERS header hdr"""
+    fp = FocalPlaneConf.from_header(hdr)
     # Fibers around 623 are
     idxs = fp.nearby_fibers(fibid)
-    avg = np.zeros_like(rss[0].data[fibid - 1])
+    avg = np.zeros_like(data[fibid - 1])
     for idx in idxs:
-        avg += rss[0].data[idx - 1]
+        avg += data[idx - 1]
     avg /= len(idxs)
 
     l1fmt = "FIB{:03d}W1"
@@ -48,8 +53,8 @@ def fix_missing_fiber(rss, fibid):
     except KeyError:
         pass
 
-    rss[0].data[fibid - 1] = avg
-    return rss
+    data[fibid - 1] = avg
+    return data
 
 
 def recompute_wcs(hdr, ipa):
@@ -16,7 +16,12 @@ van de Ville et al. IEEE Transactions on Image Processing 2004, 13, 6
 from __future__ import division
 
 import math
+import threading
+from collections import OrderedDict
+
 import numpy as np
+
+from megaradrp.core.cache import ArrayCache, default_cache
 from megaradrp.simulation.convolution import hex_c
 
 # Hexagon constants
@@ -380,6 +385,16 @@ def hexspline_bbox(p):
     return (-x1, x1), (-y1, y1)
 
 
+def rescaling_kernel_support(p, scale=1):
+    """Half size of the square containing the support of the rescaling kernel
+
+    The support of the kernel is the support of the hexspline
+    of order p, enlarged with the support of the rectangular B-spline
+    of order p and size `scale`.
+    """
+    return p / M_SQRT3 + 0.5 * p * scale
+
+
 def hexspline_gauss(xx, yy, p):
     """Approximation of the p-order hexspline by a bivariate normal
 
@@ -432,33 +447,107 @@ def sincH(x, y):
     return 4 * ts / xx
 
 
-# Convolution, compute kernel
-def rescaling_kernel(p, scale=1):
-    """Rescaling kernel from hexgrid to rectangular grid"""
-    from megaradrp.simulation.convolution import setup_grid
+def bspline(x, n):
+    """Centered B-spline of degree n, for n = 0, 1, 2"""
+    ax = np.abs(np.asanyarray(x, dtype='float'))
+    if n == 0:
+        return np.where(ax < 0.5, 1.0, np.where(ax == 0.5, 0.5, 0.0))
+    elif n == 1:
+        return np.clip(1 - ax, 0, None)
+    elif n == 2:
+        return np.where(ax < 0.5, 0.75 - ax ** 2,
+                        np.where(ax < 1.5, 0.5 * (ax - 1.5) ** 2, 0.0))
+    else:
+        raise ValueError('n>2 not implemented')
+
+
+def hexagon_square_overlap(x, y, scale):
+    """Area of the intersection of the unit hexagon and a square
+
+    The hexagon is the support of the hexspline of order 1,
+    the square has side `scale` and is centered in (x, y).
+    The area is computed exactly, integrating along x the length of the
+    vertical intersection, which is linear between the breakpoints.
+    """
+    x = np.asanyarray(x, dtype='float')
+    y = np.asanyarray(y, dtype='float')
+    half = 0.5 * scale
+    ya = y - half
+    yb = y + half
+    # Breakpoints: kinks of the border of the hexagon,
+    # and points where the border crosses the sides of the square.
+    # They only depend on y, clipping them preserves the order
+    fixed = [0.0, 0.5 / M_SQRT3, -0.5 / M_SQRT3, 1 / M_SQRT3, -1 / M_SQRT3]
+    knots = [np.full_like(y, val) for val in fixed]
+    for c in [np.abs(ya), np.abs(yb)]:
+        u = (1 - c) / M_SQRT3
+        knots.extend([u, -u])
+    knots = np.sort(np.stack(knots, axis=-1), axis=-1)
+    x1 = (x - half)[..., np.newaxis]
+    x2 = (x + half)[..., np.newaxis]
+    shape = np.broadcast(x1, knots).shape
+    points = np.concatenate([
+        np.broadcast_to(x1, shape[:-1] + (1,)),
+        np.clip(knots, x1, x2),
+        np.broadcast_to(x2, shape[:-1] + (1,))
+    ], axis=-1)
+    # Half height of the hexagon
+    hh = np.clip(np.minimum(0.5, 1 - M_SQRT3 * np.abs(points)), 0, None)
+    length = np.minimum(hh, yb[..., np.newaxis]) - np.maximum(-hh, ya[..., np.newaxis])
+    length = np.clip(length, 0, None)
+    area = 0.5 * (length[..., 1:] + length[..., :-1]) * np.diff(points, axis=-1)
+    return area.sum(axis=-1)
+
+
+# Rescaling kernels already computed, by (p, scale)
+KERNEL_CACHE_SIZE = 8
+# Version of the arrays of the kernel stored in the persistent cache
+KERNEL_CACHE_VERSION = 3
+_kernels = OrderedDict()
+_kernels_lock = threading.Lock()
+
+
+def _rescaling_kernel_grid(p, scale):
+    """Samples of the rescaling kernel in a regular grid
+
+    The grid contains the support of the kernel, with a margin of
+    zeros, so that the spline is 0 outside of the support. It has
+    an odd number of samples, centered in 0, as required by the
+    convolutions.
+    """
     from scipy import signal
-    from scipy.interpolate import RectBivariateSpline
 
     Dx = 0.005
     Dy = 0.005
     DA = Dx * Dy
-    # TODO: the support should be computed from the scale and p
-    xsize = ysize = 3.0
-    xx, yy, xs, ys, xl, yl = setup_grid(xsize, ysize, Dx, Dy)
+    margin = 0.1
+    npoints = int(math.ceil((rescaling_kernel_support(p, scale) + margin) / Dx))
+    xs = Dx * np.arange(-npoints, npoints + 1)
+    ys = Dy * np.arange(-npoints, npoints + 1)
+    xx, yy = np.meshgrid(xs, ys)
 
     detR0 = M_SQRT3 / 2
     detR1 = scale * scale
 
+    if p == 1:
+        # Closed form, the overlap of the hexagon and the pixel,
+        # only computed inside of the support
+        kernel = np.zeros_like(xx)
+        cols = np.abs(xs) < 1 / M_SQRT3 + 0.5 * scale
+        rows = np.abs(ys) < 0.5 + 0.5 * scale
+        kernel[np.ix_(rows, cols)] = hexagon_square_overlap(
+            xs[cols], ys[rows, np.newaxis], scale
+        ) / detR1
+        return ys, xs, kernel
+
     # index of bspline
     n = p - 1
 
-    rect_kernel = signal.bspline(xx / scale, n) * signal.bspline(yy / scale, n) / detR1
+    rect_kernel = bspline(xx / scale, n) * bspline(yy / scale, n) / detR1
 
     hex1 = hexspline1(xx, yy)
 
-    if p == 1:
-        hex_kernel = hex1
-    elif p == 2:
+    if p == 2:
         hex2 = signal.fftconvolve(hex1, hex1, mode='same') * DA / detR0
         hex_kernel = hex2
     elif p == 3:
@@ -469,5 +558,64 @@ def rescaling_kernel(p, scale=1):
         raise ValueError('p>3 not implemented')
 
     kernel = signal.fftconvolve(rect_kernel, hex_kernel, mode='same') * DA
-    rbs = RectBivariateSpline(xs, ys, kernel)
+    return ys, xs, kernel
+
+
+# Convolution, compute kernel
+def rescaling_kernel(p, scale=1, cache=None):
+    """Rescaling kernel from hexgrid to rectangular grid
+
+    The kernel is a spline fitted to samples of the convolution
+    of the hexspline of order p and the rectangular B-spline of
+    size `scale`. For p = 1, the samples are computed in closed form.
+
+    Kernels are memoized by (p, scale), the last KERNEL_CACHE_SIZE
+    are kept in memory. The coefficients of the spline are also
+    stored in `cache`, so they can be reused by other processes.
+
+    Parameters
+    ----------
+    p : int
+        Order of the hexspline
+    scale : float
+        Size of the pixels of the rectangular grid
+    cache : megaradrp.core.cache.ArrayCache, optional
+        Persistent cache of the samples.
+        If None, the cache configured in the environment is used
+
+    Returns
+    -------
+    scipy.interpolate.RectBivariateSpline
+        The kernel, evaluated as kernel.ev(y, x)
+    """
+    from scipy.interpolate import RectBivariateSpline
+
+    if p not in [1, 2, 3]:
+        raise ValueError('p>3 not implemented')
+
+    mkey = (p, float(scale))
+    with _kernels_lock:
+        rbs = _kernels.get(mkey)
+        if rbs is not None:
+            _kernels.move_to_end(mkey)
+            return rbs
+
+    if cache is None:
+        cache = default_cache()
+
+    key = ArrayCache.key('rescaling_kernel', KERNEL_CACHE_VERSION, p, float(scale))
+    arrays = cache.load(key) if cache is not None else None
+    if arrays is not None:
+        ys, xs, kernel = arrays['ys'], arrays['xs'], arrays['kernel']
+    else:
+        ys, xs, kernel = _rescaling_kernel_grid(p, scale)
+        if cache is not None:
+            cache.store(key, {'ys': ys, 'xs': xs, 'kernel': kernel})
+    # Fitting the spline is fast compared with sampling the kernel
+    rbs = RectBivariateSpline(ys, xs, kernel)
+
+    with _kernels_lock:
+        _kernels[mkey] = rbs
+        while len(_kernels) > KERNEL_CACHE_SIZE:
+            _kernels.popitem(last=False)
     return rbs
@@ -0,0 +1,289 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Reconstruction of a cube from several LCB pointings"""
+
+import logging
+
+import numpy as np
+import scipy.sparse as sparse
+import astropy.io.fits as fits
+import astropy.wcs
+
+from megaradrp.instrument.focalplane import FocalPlaneConf
+from megaradrp.core.utils import atleast_2d_last, create_fits_primary
+import megaradrp.processing.cube as cube
+import megaradrp.processing.hexgrid as hg
+from megaradrp.processing.multirss import MultiRSS
+
+
+_logger = logging.getLogger(__name__)
+
+
+def split_multi_rss(rss):
+    """Data and FIBERS headers of a multi RSS or a list of RSS
+
+    Parameters
+    ----------
+    rss : fits.HDUList, MultiRSS or list of fits.HDUList
+        A multi RSS, as created by
+        :func:`megaradrp.processing.multirss.generate_multi_rss`
+        or :func:`megaradrp.processing.multirss.write_multi_rss`,
+        or a list of RSS images
+
+    Returns
+    -------
+    data : np.ndarray
+        The RSS of all the pointings, stacked
+    headers : list of fits.Header
+        The FIBERS header of each pointing
+    spec_header : fits.Header
+        The primary header of the first pointing
+    """
+    if isinstance(rss, MultiRSS):
+        rss = rss.hdulist
+    if isinstance(rss, fits.HDUList):
+        nrss = rss[0].header.get('MEG-NRSS')
+        if nrss is None:
+            # A single RSS
+            return rss[0].data, [rss['FIBERS'].header], rss[0].header
+        headers = [rss[f'FIBERS{idx}'].header for idx in range(1, nrss + 1)]
+        return rss[0].data, headers, rss[0].header
+
+    if len(rss) == 0:
+        raise ValueError('need at least 1 image')
+    shapes = set(img[0].shape[1:] for img in rss)
+    if len(shapes) > 1:
+        raise ValueError('the RSS images have different shapes')
+    data = np.concatenate([img[0].data for img in rss])
+    headers = [img['FIBERS'].header for img in rss]
+    return data, headers, rss[0][0].header
+
+
+def sky_wcs(fibers_header):
+    """Celestial WCS of a FIBERS header"""
+    # The description of the fibers is not needed, and
+    # makes parsing the header slow
+    cards = [card for card in fibers_header.cards
+             if not card.keyword.startswith(('FIB', 'BUN'))]
+    return astropy.wcs.WCS(fits.Header(cards)).celestial
+
+
+def mosaic_fiber_positions(fibers_headers, refid=614):
+    """Positions of the fibers of several pointings
+
+    The positions of the fibers in each pointing are converted to
+    sky coordinates using the WCS of its FIBERS header, and then to
+    the focal plane of the first pointing. All the pointings are
+    assumed to have the same position angle.
+
+    Parameters
+    ----------
+    fibers_headers : list of fits.Header
+        The FIBERS header of each pointing
+    refid : int
+        fiber ID of reference fiber for grid coordinates
+
+    Returns
+    -------
+    r0l : np.ndarray
+        Positions of the connected fibers of all the pointings in the
+        hexagonal grid of the first pointing, with shape (2, nfibers)
+    ref : tuple
+        Position of the origin of the hexagonal grid
+    rows : np.ndarray
+        Row of each fiber in the stacked RSS
+    pointing : np.ndarray
+        Index of the pointing of each fiber
+    """
+    # The pointings usually share the configuration of the fibers
+    fpconfs = {}
+    for hdr in fibers_headers:
+        confid = hdr.get('CONFID')
+        if confid not in fpconfs:
+            fpconfs[confid] = FocalPlaneConf.from_header(hdr)
+
+    fpconf0 = fpconfs[fibers_headers[0].get('CONFID')]
+    ascale = cube.focal_plane_scale(fpconf0)
+    r0l0, ref = cube.calc_matrix_from_fiberconf(fpconf0, refid=refid)
+    wcs0 = sky_wcs(fibers_headers[0])
+
+    all_r0l = []
+    all_rows = []
+    all_pointing = []
+    offset = 0
+    for idx, hdr in enumerate(fibers_headers):
+        fpconf = fpconfs[hdr.get('CONFID')]
+        conected = fpconf.connected_fibers()
+        all_rows.append([offset + conf.fibid - 1 for conf in conected])
+        all_pointing.append(np.full(len(conected), idx))
+        offset += fpconf.nfibers
+        if idx == 0:
+            all_r0l.append(r0l0)
+            continue
+        # Positions in the focal plane of the first pointing
+        x = np.array([conf.x for conf in conected])
+        y = np.array([conf.y for conf in conected])
+        wcs = sky_wcs(hdr)
+        sky = wcs.all_pix2world(x, y, 1)
+        x0, y0 = wcs0.all_world2pix(sky[0], sky[1], 1)
+        all_r0l.append(np.array([x0 / ascale - ref[0], y0 / ascale - ref[1]]))
+
+    r0l = np.concatenate(all_r0l, axis=1)
+    rows = np.concatenate(all_rows)
+    pointing = np.concatenate(all_pointing)
+    return r0l, ref, rows, pointing
+
+
+def calc_mosaic_weights(r0l, pointing, p=1, target_scale=1.0):
+    """Weights of the fibers of several pointings in the pixels of the cube
+
+    The weights are those of :func:`megaradrp.processing.cube.calc_cube_weights`
+    for all the fibers, normalized in the pixels covered by several
+    pointings. The value of those pixels is the average of the
+    pointings, weighted by their coverage of the pixel.
+
+    Parameters
+    ----------
+    r0l : np.ndarray
+        Positions of the fibers in the hexagonal grid, with shape (2, nfibers)
+    pointing : np.ndarray
+        Index of the pointing of each fiber
+    p : {1, 2}
+    target_scale : float
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Matrix with shape (npixels, nfibers)
+    shape : tuple
+        Spatial shape of the cube, (rows, columns)
+    """
+    weights, shape = cube.calc_cube_weights(r0l, p, target_scale)
+    npointings = pointing.max() + 1
+    # Coverage of each pixel by each pointing
+    selector = sparse.csr_matrix(
+        (np.ones_like(pointing, dtype='float'), (np.arange(len(pointing)), pointing)),
+        shape=(len(pointing), npointings)
+    )
+    coverage = (weights @ selector).toarray()
+    maxcov = coverage.max(axis=1)
+    norm = np.ones_like(maxcov)
+    covered = maxcov > 0
+    norm[covered] = coverage[covered].sum(axis=1) / maxcov[covered]
+    weights = sparse.diags(1.0 / norm) @ weights
+    return weights.tocsr(), shape
+
+
+def _mosaic_headers(fibers_headers, spec_header, r0l, ref, target_scale_arcsec):
+    # Primary header of the cube, followed by the FIBERS headers of the pointings
+    hdr = spec_header.copy()
+    hdr.remove('MEG-NRSS', ignore_missing=True)
+    cube.update_cube_header(hdr, fibers_headers[0], spec_header,
+                            r0l, ref, target_scale_arcsec)
+    headers = []
+    for idx, fibers_hdr in enumerate(fibers_headers, 1):
+        fibers_hdr = fibers_hdr.copy()
+        fibers_hdr['EXTNAME'] = f'FIBERS{idx}'
+        headers.append(fibers_hdr)
+    return hdr, headers
+
+
+def create_mosaic_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
+    """
+    Create a cube HDUList from several LCB pointings
+
+    Parameters
+    ----------
+    rss : fits.HDUList, MultiRSS or list of fits.HDUList
+        A multi RSS or a list of RSS images, with a
+        common wavelength calibration
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+
+    Returns
+    -------
+    fits.HDUList
+        The cube, with the WCS of the first pointing, followed by
+        the FIBERS headers of the pointings
+    """
+    data, fibers_headers, spec_header = split_multi_rss(rss)
+    target_scale = target_scale_arcsec / cube.HEX_SCALE
+    r0l, ref, rows, pointing = mosaic_fiber_positions(fibers_headers)
+    _logger.debug('reconstruct %d fibers from %d pointings',
+                  len(rows), len(fibers_headers))
+
+    weights, shape = calc_mosaic_weights(r0l, pointing, p, target_scale)
+    region = atleast_2d_last(data)[rows, :]
+    cube_data = cube.reconstruct_cube(weights, shape, region, p)
+    if conserve_flux:
+        # scale with areas
+        cube_data *= (target_scale ** 2 / hg.HA_HEX)
+    # Move axis to put WL first
+    # so that is last in FITS
+    result = np.moveaxis(cube_data, 2, 0).astype('float32')
+
+    hdr, headers = _mosaic_headers(fibers_headers, spec_header,
+                                   r0l, ref, target_scale_arcsec)
+    allhdus = [fits.PrimaryHDU(data=result, header=hdr)]
+    allhdus.extend(fits.ImageHDU(header=fibers_hdr) for fibers_hdr in headers)
+    return fits.HDUList(allhdus)
+
+
+def write_mosaic_cube_from_rss(rss, filename, p=1, target_scale_arcsec=1.0,
+                               conserve_flux=True, chunk_size=cube.CUBE_CHUNK):
+    """
+    Create a cube from several LCB pointings, writing it directly in a FITS file
+
+    The file has the same contents as the output of
+    :func:`create_mosaic_cube_from_rss`. As in
+    :func:`megaradrp.processing.cube.write_cube_from_rss`, the
+    cube is computed and written in groups of `chunk_size` channels.
+
+    Parameters
+    ----------
+    rss : fits.HDUList, MultiRSS or list of fits.HDUList
+        A multi RSS or a list of RSS images, with a
+        common wavelength calibration
+    filename : str
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+    chunk_size : int, optional
+        Number of channels computed at once
+    """
+    data, fibers_headers, spec_header = split_multi_rss(rss)
+    target_scale = target_scale_arcsec / cube.HEX_SCALE
+    r0l, ref, rows, pointing = mosaic_fiber_positions(fibers_headers)
+    _logger.debug('reconstruct %d fibers from %d pointings',
+                  len(rows), len(fibers_headers))
+
+    weights, shape = calc_mosaic_weights(r0l, pointing, p, target_scale)
+    data = atleast_2d_last(data)
+    nwave = data.shape[-1]
+
+    hdr, headers = _mosaic_headers(fibers_headers, spec_header,
+                                   r0l, ref, target_scale_arcsec)
+    result = create_fits_primary(filename, hdr, (nwave,) + shape, dtype='float32')
+    try:
+        for k in range(0, nwave, chunk_size):
+            channels = slice(k, min(k + chunk_size, nwave))
+            region = np.asarray(data[rows, channels], dtype='float64')
+            cube_data = cube.reconstruct_cube(weights, shape, region, p)
+            if conserve_flux:
+                # scale with areas
+                cube_data *= (target_scale ** 2 / hg.HA_HEX)
+            result[channels] = np.moveaxis(cube_data, 2, 0)
+        result.flush()
+    finally:
+        del result
+
+    for fibers_hdr in headers:
+        fits.append(filename, None, fibers_hdr)
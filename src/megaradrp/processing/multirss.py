@@ -7,13 +7,55 @@
 # License-Filename: LICENSE.txt
 #
 
+import contextlib
+
 import numpy
 import astropy.io.fits as fits
 import uuid
 
+from megaradrp.core.utils import create_fits_primary
+
+
+def _multi_rss_header(refimg, nimages):
+    header = refimg[0].header.copy()
+    header['MEG-NRSS'] = nimages
+    # Generate a new UUID
+    header['UUID'] = str(uuid.uuid1())
+    return header
+
+
+def _fibers_hdu(img, idx):
+    fibers = img['FIBERS'].copy()
+    fibers.header['EXTNAME'] = f'FIBERS{idx}'
+    # The primary header of the multi RSS only keeps the IPA of the first image
+    ipa = img[0].header.get('IPA')
+    if ipa is not None:
+        fibers.header['IPA'] = ipa
+    return fibers
+
+
+@contextlib.contextmanager
+def _open_frame(frame):
+    # Accept HDUList or objects with an open method, as DataFrame.
+    # Only the files opened here are closed
+    if isinstance(frame, fits.HDUList):
+        yield frame
+        return
+    img = frame.open()
+    try:
+        yield img
+    finally:
+        if img is not getattr(frame, 'frame', None):
+            img.close()
+
 
 def generate_multi_rss(imgs):
+    """Stack several RSS images in a multi RSS.
 
+    The data keeps the type of the first image. Use
+    :func:`write_multi_rss` to avoid holding all the
+    images in memory.
+    """
     nimages = len(imgs)
     if nimages == 0:
         raise ValueError('need at least 1 image')
@@ -21,20 +63,121 @@ def generate_multi_rss(imgs):
 
     dim0 = refimg[0].shape[0]
     multishape = (dim0 * nimages, refimg[0].shape[1])
-    fdata = numpy.empty(multishape)
+    fdata = numpy.empty(multishape, dtype=refimg[0].data.dtype)
 
     for idx, img in enumerate(imgs):
         fdata[idx*dim0: (idx+1)*dim0] = img[0].data
 
-    hdu = fits.PrimaryHDU(data=fdata, header=refimg[0].header)
-    hdu.header['MEG-NRSS'] = nimages
-    # Generate a new UUID
-    hdu.header['UUID'] = str(uuid.uuid1())
+    hdu = fits.PrimaryHDU(data=fdata, header=_multi_rss_header(refimg, nimages))
 
     allhdus = [hdu]
     for idx, img in enumerate(imgs, 1):
-        fibers = img['FIBERS']
-        fibers.header['EXTNAME'] = f'FIBERS{idx}'
-        allhdus.append(fibers)
+        allhdus.append(_fibers_hdu(img, idx))
     result = fits.HDUList(allhdus)
     return result
+
+
+def write_multi_rss(frames, filename, dtype='float32'):
+    """Stack several RSS images in a multi RSS file.
+
+    The frames are opened one at a time, and their data is written
+    directly in the file, so only one image is held in memory.
+
+    Parameters
+    ----------
+    frames : sequence of HDUList or DataFrame
+        The RSS images
+    filename : str
+        Name of the output file
+    dtype : numpy.dtype, optional
+        Type of the data in the file
+
+    Returns
+    -------
+    MultiRSS
+        The multi RSS in the file, opened memory-mapped
+
+    """
+    nimages = len(frames)
+    if nimages == 0:
+        raise ValueError('need at least 1 image')
+
+    data = None
+    allfibers = []
+    try:
+        for idx, frame in enumerate(frames):
+            with _open_frame(frame) as img:
+                if data is None:
+                    dim0, dim1 = img[0].shape
+                    data = create_fits_primary(
+                        filename, _multi_rss_header(img, nimages),
+                        (dim0 * nimages, dim1), dtype=dtype
+                    )
+                if img[0].shape != (dim0, dim1):
+                    raise ValueError(f'image {idx} has shape {img[0].shape}, '
+                                     f'expected {(dim0, dim1)}')
+                data[idx*dim0: (idx+1)*dim0] = img[0].data
+                allfibers.append(_fibers_hdu(img, idx + 1))
+        data.flush()
+    finally:
+        del data
+
+    with fits.open(filename, mode='append') as hdul:
+        hdul.extend(allfibers)
+    return MultiRSS.open(filename)
+
+
+class MultiRSS(object):
+    """Access to the pointings of a multi RSS.
+
+    If the multi RSS is opened from a file with `open`, the data
+    is memory-mapped, and the data of each pointing is read
+    only when it is used.
+
+    Parameters
+    ----------
+    hdulist : fits.HDUList
+        A multi RSS, as created by :func:`generate_multi_rss`
+
+    """
+    def __init__(self, hdulist):
+        self.hdulist = hdulist
+        self.nrss = hdulist[0].header['MEG-NRSS']
+        self.nfibers = hdulist[0].shape[0] // self.nrss
+
+    @classmethod
+    def open(cls, filename):
+        """Open a multi RSS file, memory-mapped"""
+        return cls(fits.open(filename, memmap=True))
+
+    def __len__(self):
+        return self.nrss
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.hdulist.close()
+
+    def data(self, idx):
+        """Data of the pointing idx"""
+        if not 0 <= idx < self.nrss:
+            raise IndexError(f'pointing {idx} out of range')
+        return self.hdulist[0].data[idx * self.nfibers: (idx + 1) * self.nfibers]
+
+    def fibers(self, idx):
+        """FIBERS extension of the pointing idx"""
+        if not 0 <= idx < self.nrss:
+            raise IndexError(f'pointing {idx} out of range')
+        return self.hdulist[f'FIBERS{idx + 1}']
+
+    def __getitem__(self, idx):
+        """The pointing idx, as a RSS image sharing the data"""
+        header = self.hdulist[0].header.copy()
+        del header['MEG-NRSS']
+        fibers = self.fibers(idx).copy()
+        fibers.header['EXTNAME'] = 'FIBERS'
+        return fits.HDUList([fits.PrimaryHDU(data=self.data(idx), header=header), fibers])
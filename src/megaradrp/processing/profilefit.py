@@ -0,0 +1,250 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Simultaneous fitting of the fiber profiles in a column"""
+
+import math
+
+import numpy
+from scipy.special import ndtr
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
+
+
+M_SQRT_2_PI = math.sqrt(2 * math.pi)
+
+
+class ColumnProfiles(object):
+    """Profiles of a group of fibers in a column of the image.
+
+    Each fiber is sampled in a fixed window of `2 * extra` rows around
+    its initial center. The profiles are Gaussians integrated in each
+    pixel, as in :func:`numina.modeling.gaussbox.gauss_box_model`, with
+    parameters amplitude, mean and stddev.
+
+    The Jacobian of the sum of the profiles is a sparse matrix with
+    one column per parameter, ordered as (amplitude, mean, stddev) for
+    each fiber, and nonzero values only in the window of the fiber.
+    """
+    def __init__(self, nrow, mean, extra=10, hpix=0.5):
+        self.nrow = nrow
+        self.nfib = len(mean)
+        self.hpix = hpix
+        nband = 2 * extra
+        begpix = numpy.ceil(numpy.asarray(mean) - 0.5).astype('int') - extra
+        rows = begpix[:, numpy.newaxis] + numpy.arange(nband)
+        self.inside = (rows >= 0) & (rows < nrow)
+        self.rows = numpy.clip(rows, 0, nrow - 1)
+        # Borders of the pixels, centered in the rows
+        self.borders = begpix[:, numpy.newaxis] + numpy.arange(nband + 1) - hpix
+        # Rows with any profile
+        self.covered = numpy.zeros((nrow,), dtype='bool')
+        self.covered[self.rows[self.inside]] = True
+
+        nparams = 3 * self.nfib
+        self._indices = numpy.repeat(self.rows, 3, axis=0).ravel()
+        self._indptr = numpy.arange(0, nparams * nband + 1, nband)
+
+    def evaluate(self, amplitude, mean, stddev):
+        """Evaluate the profiles and their derivatives.
+
+        Returns the sum of the profiles in the column and the values
+        of the derivatives, with shape (nfib, 3, 2 * extra).
+        """
+        mean = numpy.asarray(mean)[:, numpy.newaxis]
+        stddev = numpy.asarray(stddev)[:, numpy.newaxis]
+        amplitude = numpy.asarray(amplitude)[:, numpy.newaxis]
+        z = (self.borders - mean) / stddev
+        cdf = ndtr(z)
+        pdf = numpy.exp(-0.5 * z * z) / M_SQRT_2_PI
+        zpdf = z * pdf
+        prof = (cdf[:, 1:] - cdf[:, :-1]) * self.inside
+        dmean = -amplitude / stddev * (pdf[:, 1:] - pdf[:, :-1])
+        dstd = -amplitude / stddev * (zpdf[:, 1:] - zpdf[:, :-1])
+        deriv = numpy.stack([prof, dmean * self.inside, dstd * self.inside], axis=1)
+        model = numpy.bincount(
+            self.rows.ravel(), weights=(amplitude * prof).ravel(),
+            minlength=self.nrow
+        )
+        return model, deriv
+
+    def jacobian(self, deriv):
+        """Sparse Jacobian from the derivatives returned by evaluate"""
+        shape = (self.nrow, 3 * self.nfib)
+        return sparse.csc_matrix((deriv.ravel(), self._indices, self._indptr), shape=shape)
+
+    def fit_amplitude(self, column, mean, stddev):
+        """Linear least squares fit of the amplitudes, with fixed centers and widths"""
+        ones = numpy.ones((self.nfib,))
+        _, deriv = self.evaluate(ones, mean, stddev)
+        jac = self.jacobian(deriv)[:, 0::3]
+        return _solve_normal(jac.T @ jac, jac.T @ column)
+
+
+def _solve_normal(jtj, rhs, damping=0.0):
+    # Solve (JtJ + damping * diag(JtJ)) x = rhs
+    diag = jtj.diagonal()
+    # Parameters without influence in the column are not changed
+    fixed = diag <= 0
+    diag = numpy.where(fixed, 1.0, diag)
+    extra = numpy.where(fixed, 1.0, damping * diag)
+    matrix = (jtj + sparse.diags(extra)).tocsc()
+    return spsolve(matrix, rhs)
+
+
+def fit_column(column, mean, stddev, amplitude=None, mean_range=0.5, std_range=0.5,
+               extra=10, maxiter=100, rtol=1e-10, start=None):
+    """Fit the profiles of all the fibers in a column simultaneously.
+
+    The sum of the Gaussian-box profiles of the fibers is fitted to
+    the column with the Levenberg-Marquardt method. As each fiber only
+    overlaps its neighbours, the normal equations are sparse and banded,
+    and are solved for all the fibers at once, using the analytic
+    derivatives of the profiles.
+
+    Parameters
+    ----------
+    column : numpy.ndarray
+        Values of the column
+    mean : array_like
+        Expected center of each fiber, in pixels
+    stddev : array_like
+        Expected width of each fiber, in pixels
+    amplitude : array_like, optional
+        Initial amplitude of each fiber. If None, it is computed
+        by linear least squares using the initial centers and widths
+    mean_range : float
+        The center can move up to this distance from `mean`
+    std_range : float
+        The width can change up to this value from `stddev`
+    extra : int
+        Each profile is sampled in 2 * extra rows around its center
+    maxiter : int
+        Maximum number of iterations
+    rtol : float
+        Relative change of the cost function to stop the iterations
+    start : tuple of array_like, optional
+        Initial (center, width) of the fibers, clipped into the
+        bounds. If None, `mean` and `stddev` are used
+
+    Returns
+    -------
+    amplitude, mean, stddev : numpy.ndarray
+        Fitted parameters of the fibers
+    niter : int
+        Number of iterations performed
+
+    """
+    column = numpy.asarray(column, dtype='float')
+    mean0 = numpy.asarray(mean, dtype='float')
+    std0 = numpy.broadcast_to(numpy.asarray(stddev, dtype='float'), mean0.shape)
+
+    # The bounds are always relative to the expected values
+    if start is None:
+        mean1, std1 = mean0, std0
+    else:
+        mean1 = numpy.broadcast_to(numpy.asarray(start[0], dtype='float'), mean0.shape)
+        std1 = numpy.broadcast_to(numpy.asarray(start[1], dtype='float'), mean0.shape)
+
+    profiles = ColumnProfiles(len(column), mean1, extra=extra)
+
+    if amplitude is None:
+        amplitude = profiles.fit_amplitude(column, mean1, std1)
+    else:
+        amplitude = numpy.broadcast_to(numpy.asarray(amplitude, dtype='float'), mean0.shape)
+
+    # Parameters are interleaved, (amplitude, mean, stddev) per fiber
+    params = numpy.stack([amplitude, mean1, std1], axis=1)
+    lower = numpy.stack(
+        [numpy.full_like(mean0, -numpy.inf), mean0 - mean_range,
+         numpy.maximum(std0 - std_range, 0.1 * std0)], axis=1
+    ).ravel()
+    upper = numpy.stack(
+        [numpy.full_like(mean0, numpy.inf), mean0 + mean_range, std0 + std_range], axis=1
+    ).ravel()
+    params = numpy.clip(params.ravel(), lower, upper)
+
+    def residuals(pars):
+        a, m, s = pars.reshape((-1, 3)).T
+        model, deriv = profiles.evaluate(a, m, s)
+        res = numpy.where(profiles.covered, column - model, 0.0)
+        return res, deriv
+
+    res, deriv = residuals(params)
+    cost = res @ res
+    damping = 1e-3
+    niter = 0
+    for niter in range(1, maxiter + 1):
+        jac = profiles.jacobian(deriv)
+        jtj = jac.T @ jac
+        grad = jac.T @ res
+        while True:
+            step = _solve_normal(jtj, grad, damping)
+            new_params = numpy.clip(params + step, lower, upper)
+            new_res, new_deriv = residuals(new_params)
+            new_cost = new_res @ new_res
+            if new_cost <= cost:
+                damping = max(damping / 3, 1e-10)
+                break
+            damping *= 4
+            if damping > 1e10:
+                break
+
+        if new_cost > cost:
+            # No further improvement
+            break
+        decrease = cost - new_cost
+        params, res, deriv, cost = new_params, new_res, new_deriv, new_cost
+        if decrease <= rtol * cost:
+            break
+
+    amplitude, mean, stddev = params.reshape((-1, 3)).T
+    return amplitude.copy(), mean.copy(), stddev.copy(), niter
+
+
+def fit_columns(columns, centers, sigma, warm_start=True, **kwds):
+    """Fit the profiles in a sequence of columns.
+
+    Parameters
+    ----------
+    columns : sequence of numpy.ndarray
+        Values of each column
+    centers : sequence of numpy.ndarray
+        Expected center of the fibers in each column
+    sigma : float
+        Initial width of the profiles
+    warm_start : bool
+        If True, the fit of a column is used as initial value
+        of the next one. The fitted offsets of the centers with
+        respect to `centers` are kept, and the widths and
+        amplitudes are reused. The bounds of the fit are always
+        relative to `centers` and `sigma`.
+    **kwds
+        Extra arguments passed to :func:`fit_column`
+
+    Returns
+    -------
+    list of tuple
+        (amplitude, mean, stddev) of the fibers in each column
+
+    """
+    results = []
+    previous = None
+    for column, center in zip(columns, centers):
+        if warm_start and previous is not None:
+            amplitude, offset, stddev = previous
+            start = (center + offset, stddev)
+        else:
+            amplitude, start = None, None
+        amplitude, mean, stddev, _ = fit_column(
+            column, center, sigma, amplitude=amplitude, start=start, **kwds
+        )
+        previous = (amplitude, mean - center, stddev)
+        results.append((amplitude, mean, stddev))
+    return results
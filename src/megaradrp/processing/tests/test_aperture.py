@@ -20,3 +20,91 @@
 #
 # if __name__ == "__main__":
 #     test_Aperture_Extractor()
+
+import numpy
+import numpy.polynomial.polynomial as nppol
+import pytest
+from numina.array.trace.extract import extract_simple_intl
+
+import megaradrp.products.tracemap as tm
+from megaradrp.processing.aperture import apextract_tracemap, calc_borders_tracemap, extract_borders
+
+
+def create_tracemap(nfibers=30, missing=(4, 11, 12)):
+    tracemap = tm.TraceMap()
+    tracemap.total_fibers = nfibers
+    tracemap.ref_column = 100
+    tracemap.global_offset = nppol.Polynomial([0.2, 1e-4])
+    pos = -4.0
+    for fibid in range(1, nfibers + 1):
+        # Boxes of 10 fibers
+        boxid = (fibid - 1) // 10 + 1
+        pos += 3.7 + (1.2 if (fibid - 1) % 10 == 0 else 0.0)
+        fitparms = [] if fibid in missing else [pos, 2e-3, -1e-5]
+        tracemap.contents.append(tm.GeometricTrace(fibid, boxid, 1, 200, fitparms))
+    return tracemap
+
+
+def test_calc_borders_tracemap():
+    tracemap = create_tracemap()
+    fibids, borders = calc_borders_tracemap(tracemap, 200)
+    assert borders.shape == (len(fibids), 2, 200)
+    assert 4 not in fibids
+    assert numpy.all(borders[:, 0] < borders[:, 1])
+    # Consecutive fibers share the border
+    idx = numpy.searchsorted(fibids, 2)
+    assert numpy.array_equal(borders[idx - 1, 1], borders[idx, 0])
+
+
+@pytest.mark.parametrize("dtype", ['float32', '>f4', 'float64'])
+def test_extract_borders(dtype):
+    # The first fiber is partially outside the image
+    nrows, ncols = 114, 200
+    tracemap = create_tracemap()
+    rng = numpy.random.default_rng(1234)
+    data = rng.normal(100, 10, size=(nrows, ncols)).astype(dtype)
+
+    fibids, borders = calc_borders_tracemap(tracemap, ncols)
+    result = extract_borders(data, fibids, borders, chunk_size=7)
+
+    native = data.astype(data.dtype.newbyteorder('='))
+    xx = numpy.arange(ncols)
+    expected = numpy.zeros((tracemap.total_fibers, ncols))
+    for fibid, (bb1, bb2) in zip(fibids, borders):
+        bb1 = numpy.maximum(bb1, -0.5)
+        bb2 = numpy.minimum(bb2, nrows - 0.5)
+        extract_simple_intl(native, xx, bb1, bb2, expected[fibid - 1])
+
+    assert result.shape == expected.shape
+    assert numpy.array_equal(result, expected)
+    assert numpy.array_equal(apextract_tracemap(data, tracemap), expected)
+
+
+def test_extract_borders_outside():
+    # Apertures above the image are zero
+    data = numpy.ones((50, 60))
+    borders = numpy.empty((3, 2, 60))
+    borders[:, 0] = [[20.2], [48.7], [52.0]]
+    borders[:, 1] = [[24.7], [53.0], [56.0]]
+    result = extract_borders(data, numpy.array([1, 2, 3]), borders)
+    assert numpy.allclose(result, [[4.5], [0.8], [0.0]])
+
+
+def test_aperture_extractor_close():
+    import astropy.io.fits as fits
+    from megaradrp.processing.aperture import ApertureExtractor
+    from megaradrp.products.tests.test_modelmap import create_test_modelmap, create_test_image
+
+    shape = (300, 60)
+    model_map = create_test_modelmap(ncols=shape[1])
+    amplitude = numpy.linspace(100, 200, model_map.total_fibers)
+    img = fits.HDUList([
+        fits.PrimaryHDU(create_test_image(model_map, shape, amplitude)),
+        fits.ImageHDU(name='FIBERS')
+    ])
+    with ApertureExtractor(model_map, processes=2) as calibrator_aper:
+        result = calibrator_aper(img)
+    # The pool of processes is released
+    assert model_map._executor is None
+    assert result[0].data.shape == (model_map.total_fibers, shape[1])
+    assert numpy.allclose(result[0].data[0], amplitude[0], rtol=1e-3)
@@ -0,0 +1,51 @@
+import numpy
+import pytest
+
+from numina.array.wavecalib.crosscorrelation import convolve_comb_lines
+
+from ..boxes import filtered_cross_section, comb_offset, refine_boxes
+
+
+EXPECTED = [6, 209, 414, 620, 825, 1031, 1236, 1441, 1646, 1851, 2056,
+            2261, 2466, 2671, 2876, 3081, 3286, 3491, 3696, 3901, 4106]
+
+
+def create_cross_section(shift, n=4112):
+    # Flat with minima between the boxes
+    rng = numpy.random.default_rng(4321)
+    rows = numpy.arange(n)
+    cut = numpy.full(n, 1000.0)
+    for box in EXPECTED:
+        cut -= 900 * numpy.exp(-0.5 * ((rows - box - shift) / 4.0) ** 2)
+    cut += 300 * numpy.sin(rows / 2.0) ** 2 + rng.normal(0, 10, n)
+    return cut
+
+
+def comb_offset_direct(signal, positions, max_offset):
+    # One comb for each offset
+    positions = numpy.asarray(positions)
+    result = []
+    for ioffset in range(-max_offset, max_offset + 1):
+        _, comb = convolve_comb_lines(positions + ioffset, numpy.ones_like(positions),
+                                      3, 0, 0, 1, len(signal))
+        result.append(numpy.dot(comb, signal))
+    return numpy.array(result)
+
+
+def test_comb_offset_direct():
+    signal = filtered_cross_section(create_cross_section(13.0))
+    _, offsets, correlation = comb_offset(signal, EXPECTED, max_offset=20)
+    assert numpy.array_equal(offsets, numpy.arange(-20, 21))
+    expected = comb_offset_direct(signal, EXPECTED, 20)
+    assert numpy.allclose(correlation, expected, rtol=0, atol=1e-9 * abs(expected).max())
+
+
+@pytest.mark.parametrize("shift", [-37.3, 0.0, 55.5, 98.2, 150.2])
+def test_comb_offset(shift):
+    signal = filtered_cross_section(create_cross_section(shift))
+    offset, offsets, correlation = comb_offset(signal, EXPECTED, max_offset=160)
+    # The comb is sampled from pixel 1
+    assert abs(offset - (shift + 1)) < 0.3
+    ioffset = offsets[correlation.argmax()]
+    refined = refine_boxes(signal, EXPECTED[1:-1], nsearch=5, offset=ioffset)
+    assert numpy.allclose(refined, numpy.array(EXPECTED[1:-1]) + shift, atol=1)
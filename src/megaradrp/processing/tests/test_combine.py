@@ -0,0 +1,158 @@
+
+import numpy
+import pytest
+import astropy.io.fits as fits
+from numina.core import DataFrame
+from numina.array import combine
+import numina.util.flow as flowmod
+import numina.util.node as node
+
+import megaradrp.core.parallel as parallel
+from megaradrp.processing.trimover import OverscanCorrector, TrimImage
+from megaradrp.processing.trimover import OverscanTrimCorrector
+from ..combine import basic_processing_with_combination_frames
+from ..combine import combine_frames_tiled, tiled_correctors
+
+
+DETCONF = {
+    'trim1': [[0, 2056], [50, 4146]],
+    'trim2': [[2156, 4212], [50, 4146]],
+    'bng': [1, 1],
+    'overscan1': [[0, 2056], [4146, 4196]],
+    'overscan2': [[2156, 4212], [0, 50]],
+    'prescan1': [[0, 2056], [0, 50]],
+    'prescan2': [[2156, 4212], [4146, 4196]],
+    'middle1': [[2056, 2106], [50, 4146]],
+    'middle2': [[2106, 2156], [50, 4146]],
+    'gain1': 1.73,
+    'gain2': 1.6
+}
+
+
+class OffsetNode(node.Node):
+    """Subtract the first column and remove it"""
+    def run(self, img):
+        data = img[0].data.astype('float32')
+        img[0].data = data[:, 1:] - data[:, :1]
+        img[0].header['OFFSET'] = True
+        return img
+
+
+def create_frames(tmpdir, nframes):
+    rng = numpy.random.default_rng(4321)
+    frames = []
+    for idx in range(nframes):
+        data = rng.integers(1000, 1100, size=(30, 41)).astype('uint16')
+        hdul = fits.HDUList([fits.PrimaryHDU(data), fits.ImageHDU(name='OTHER')])
+        hdul[0].header['FRAMEID'] = idx
+        filename = str(tmpdir.join(f'frame{idx}.fits'))
+        hdul.writeto(filename)
+        frames.append(DataFrame(filename=filename))
+    return frames
+
+
+@pytest.mark.skipif(not parallel.is_available(), reason='requires shared memory')
+@pytest.mark.parametrize("method", [combine.mean, combine.median])
+def test_combination_frames_parallel(tmpdir, method):
+    frames = create_frames(tmpdir, 5)
+    flows = flowmod.SerialFlow([OffsetNode()]), node.IdNode()
+    expected = basic_processing_with_combination_frames(
+        frames, flows, method=method, processes=0
+    )
+    result = basic_processing_with_combination_frames(
+        frames, flows, method=method, processes=2
+    )
+    assert len(result) == len(expected)
+    for hdu1, hdu2 in zip(result, expected):
+        assert numpy.array_equal(hdu1.data, hdu2.data)
+    assert result[0].data.shape == (30, 40)
+    assert result[0].header['OFFSET']
+    # The first frame provides the header
+    assert result[0].header['FRAMEID'] == 0
+
+
+def create_raw_frames(tmpdir, nframes):
+    rng = numpy.random.default_rng(1234)
+    rows = numpy.arange(4212)[:, numpy.newaxis]
+    frames = []
+    for idx in range(nframes):
+        data = rng.integers(1000, 1100, size=(4212, 4196)) + rows // 100
+        hdul = fits.HDUList([fits.PrimaryHDU(data.astype('uint16'))])
+        hdul[0].header['FRAMEID'] = idx
+        filename = str(tmpdir.join(f'raw{idx}.fits'))
+        hdul.writeto(filename)
+        frames.append(DataFrame(filename=filename))
+    return frames
+
+
+def test_tiled_correctors():
+    overscan = OverscanCorrector(DETCONF)
+    trimming = TrimImage(DETCONF)
+    flow = flowmod.SerialFlow([overscan, trimming])
+    assert tiled_correctors(flow) == (overscan, trimming)
+    assert tiled_correctors(flowmod.SerialFlow([node.IdNode(), trimming])) == (None, trimming)
+    assert tiled_correctors(node.IdNode()) == (None, None)
+    assert tiled_correctors(flowmod.SerialFlow([overscan])) is None
+    fused = OverscanTrimCorrector(DETCONF)
+    assert tiled_correctors(fused) == (fused.overscan, fused.trimming)
+    assert tiled_correctors(OverscanTrimCorrector(DETCONF, gain=True)) is None
+    assert tiled_correctors(flowmod.SerialFlow([trimming, OffsetNode()])) is None
+
+
+@pytest.mark.parametrize("method", [combine.mean, combine.median])
+def test_combination_frames_tiled(tmpdir, method):
+    frames = create_raw_frames(tmpdir, 3)
+    flows = flowmod.SerialFlow([OverscanCorrector(DETCONF), TrimImage(DETCONF)]), node.IdNode()
+    expected = basic_processing_with_combination_frames(
+        frames, flows, method=method, tile_rows=0
+    )
+    result = basic_processing_with_combination_frames(
+        frames, flows, method=method, tile_rows=1000
+    )
+    assert len(result) == len(expected)
+    for hdu1, hdu2 in zip(result, expected):
+        assert hdu1.data.dtype == hdu2.data.dtype
+        assert numpy.array_equal(hdu1.data, hdu2.data)
+    assert result[0].data.shape == (4112, 4096)
+    assert result[0].header['NUM-NCOM'] == 3
+    assert result[0].header['FRAMEID'] == 0
+    assert 'BZERO' not in result[0].header
+    for key in ['NUM-OVPE', 'NUM-TRIM']:
+        assert result[0].header[key] == expected[0].header[key]
+
+
+def test_overscan_regions(tmpdir):
+    import contextlib
+    from ..combine import _overscan_regions, _MappedRegions, _PromotedSection
+
+    frames = create_raw_frames(tmpdir, 1)
+    frames.append(DataFrame(filename=str(tmpdir.join('scaled.fits'))))
+    data = numpy.arange(40.0).reshape((5, 8))
+    hdu = fits.PrimaryHDU(data)
+    hdu.scale('int16', bscale=0.5)
+    hdu.writeto(frames[1].filename)
+    region = (slice(1, 4000), slice(4100, 4150))
+    with contextlib.ExitStack() as stack:
+        hdul = stack.enter_context(frames[0].open())
+        regions = _overscan_regions(stack, frames[0], hdul)
+        assert isinstance(regions, _MappedRegions)
+        values = regions[region]
+        assert values.dtype == numpy.float32
+        assert numpy.array_equal(values, hdul[0].data[region].astype('float32'))
+        # Other scalings are read completely
+        hdul = stack.enter_context(frames[1].open())
+        regions = _overscan_regions(stack, frames[1], hdul)
+        assert isinstance(regions, _PromotedSection)
+        assert numpy.array_equal(regions[1:3, 2:4], data[1:3, 2:4])
+
+
+def test_combination_frames_tiled_file(tmpdir):
+    frames = create_raw_frames(tmpdir, 2)
+    flow = flowmod.SerialFlow([OverscanCorrector(DETCONF), TrimImage(DETCONF)])
+    expected = combine_frames_tiled(frames, flow, tile_rows=500)
+    filename = str(tmpdir.join('combined.fits'))
+    with combine_frames_tiled(frames, flow, tile_rows=500, filename=filename) as result:
+        result.verify('exception')
+        assert [hdu.name for hdu in result] == ['PRIMARY', 'VARIANCE', 'MAP']
+        for hdu1, hdu2 in zip(result, expected):
+            assert numpy.array_equal(hdu1.data, hdu2.data)
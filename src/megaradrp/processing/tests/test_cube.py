@@ -6,7 +6,9 @@ import astropy.wcs
 from megaradrp.tests.simpleobj import create_spec_header2, create_sky_header2
 from megaradrp.processing.wavecalibration import header_add_barycentric_correction
 
-from ..cube import create_cube, merge_wcs
+import megaradrp.processing.hexgrid as hg
+from ..cube import create_cube, merge_wcs, calc_weights, cspline_postfilter
+from ..cube import calc_cube_weights, HEX_SCALE
 
 
 def test_create_cube_raise():
@@ -14,6 +16,114 @@ def test_create_cube_raise():
         create_cube(None, None, 3)
 
 
+def create_test_kernel(support):
+    from scipy.interpolate import RectBivariateSpline
+
+    xs = np.linspace(-1.5, 1.5, 301)
+    xx, yy = np.meshgrid(xs, xs)
+    # asymmetric, to check the order of the axes
+    kernel = (np.clip(1 - (xx / support) ** 2, 0, None) *
+              np.clip(1 - (yy / (0.8 * support)) ** 2, 0, None)) ** 3
+    return RectBivariateSpline(xs, xs, kernel)
+
+
+def create_cube_loop(r0l, zval, target_scale, kernel):
+    # Reference implementation, one pixel at a time
+    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
+    dk = np.zeros((i1max - i1min + 1, j1max - j1min + 1, zval.shape[-1]))
+    for i in range(i1min, i1max + 1):
+        for j in range(j1min, j1max + 1):
+            r = target_scale * np.array([j, i])
+            allpos = -(r0l - r[:, np.newaxis])
+            we = np.abs(kernel.ev(allpos[1], allpos[0]))
+            dk[i - i1min, j - j1min] = np.sum(we[:, np.newaxis] * zval, axis=0)
+    return dk
+
+
+@pytest.mark.parametrize("target_scale", [0.3, 0.7, 1.0])
+def test_calc_weights(target_scale):
+    support = 0.9
+    kernel = create_test_kernel(support)
+    r0l = hg.calc_matrix(5, 6)
+    rng = np.random.default_rng(1234)
+    zval = rng.uniform(size=(r0l.shape[1], 4))
+    expected = create_cube_loop(r0l, zval, target_scale, kernel)
+
+    weights = calc_weights(r0l, target_scale, kernel, support)
+    assert weights.shape == (expected.shape[0] * expected.shape[1], r0l.shape[1])
+    result = (weights @ zval).reshape(expected.shape)
+    assert np.allclose(result, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("p", [1, 2])
+@pytest.mark.parametrize("target_scale_arcsec", [0.3, 0.6])
+def test_calc_cube_weights(p, target_scale_arcsec):
+    from ..hexspline import rescaling_kernel
+
+    # The real kernel, its tails must be inside the support
+    target_scale = target_scale_arcsec / HEX_SCALE
+    kernel = rescaling_kernel(p, scale=target_scale)
+    r0l = hg.calc_matrix(5, 6)
+    rng = np.random.default_rng(1234)
+    zval = rng.uniform(size=(r0l.shape[1], 3))
+    expected = create_cube_loop(r0l, zval, target_scale, kernel)
+
+    weights, shape = calc_cube_weights(r0l, p, target_scale)
+    result = (weights @ zval).reshape(shape + (zval.shape[-1],))
+    assert np.allclose(result, expected, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", ['float32', 'float64'])
+def test_cspline_postfilter(dtype):
+    from scipy import signal
+    rng = np.random.default_rng(1234)
+    cube = rng.normal(size=(23, 17, 300)).astype(dtype)
+    expected = np.zeros_like(cube)
+    for k in range(cube.shape[-1]):
+        expected[..., k] = signal.cspline2d(cube[..., k])
+    result = cspline_postfilter(cube)
+    assert result.dtype == cube.dtype
+    rtol = 1e-5 if dtype == 'float32' else 1e-12
+    assert np.allclose(result, expected, rtol=rtol, atol=rtol)
+
+
+def create_test_rss(nwave):
+    import astropy.io.fits as fits
+    from megaradrp.datamodel import create_default_fiber_header
+
+    hdr = create_spec_header2()
+    hdr['INSMODE'] = 'LCB'
+    fibers_hdr = create_default_fiber_header('LCB')
+    fibers_hdr.update(create_sky_header2())
+    rng = np.random.default_rng(1234)
+    data = rng.uniform(size=(623, nwave)).astype('float32')
+    return fits.HDUList([
+        fits.PrimaryHDU(data, header=hdr),
+        fits.ImageHDU(header=fibers_hdr, name='FIBERS')
+    ])
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_write_cube_from_rss(tmpdir, p):
+    import astropy.io.fits as fits
+    from ..cube import create_cube_from_rss, write_cube_from_rss
+
+    rss = create_test_rss(nwave=40)
+    cube = create_cube_from_rss(rss, p, target_scale_arcsec=0.5)
+    assert cube[0].data.dtype == np.float32
+
+    filename = str(tmpdir.join('cube.fits'))
+    write_cube_from_rss(rss, filename, p, target_scale_arcsec=0.5, chunk_size=15)
+    with fits.open(filename) as result:
+        assert len(result) == len(cube)
+        assert np.array_equal(result[0].data, cube[0].data)
+        # Values are rounded when written
+        assert list(result[0].header) == list(cube[0].header)
+        for key in ['CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2', 'CRVAL3', 'CDELT3']:
+            assert np.isclose(result[0].header[key], cube[0].header[key])
+        assert result['FIBERS'].header == cube['FIBERS'].header
+
+
 def test_sub_wcs():
     hdr_sky = create_sky_header2()
     hdr_spec = create_spec_header2()
@@ -19,4 +19,57 @@ def test_hexspline2():
     expected_res = [5.60769515e-02, 5.78341925e-01, 6.40987562e-16, 1.00000000e+00,
        2.11842907e-01, 7.69185075e-16]
     res = hexspline2(x, y)
-    assert np.allclose(res, expected_res, rtol=1e-2)
\ No newline at end of file
+    assert np.allclose(res, expected_res, rtol=1e-2)
+
+@pytest.mark.parametrize("scale", [0.3, 0.5, 1])
+def test_rescaling_kernel_closed_form(scale):
+    from megaradrp.simulation.convolution import setup_grid
+    from scipy import signal
+    from ..hexspline import bspline, hexspline1, hexagon_square_overlap
+
+    # Square inside the hexagon
+    assert np.allclose(hexagon_square_overlap(0.1, 0.05, 0.4), 0.16)
+    # Square containing the hexagon
+    assert np.allclose(hexagon_square_overlap(0.0, 0.0, 2.5), math.sqrt(3) / 2)
+    # Symmetric
+    assert np.allclose(hexagon_square_overlap([0.4, -0.4], [0.3, -0.3], scale),
+                       hexagon_square_overlap([-0.4, 0.4], [0.3, 0.3], scale))
+
+    # Compare with the numerical convolution
+    dx = 0.005
+    xx, yy, xs, ys, _, _ = setup_grid(3.0, 3.0, dx, dx)
+    rect = bspline(xx / scale, 0) * bspline(yy / scale, 0) / scale ** 2
+    kernel = signal.fftconvolve(rect, hexspline1(xx, yy), mode='same') * dx * dx
+    rbs = rescaling_kernel(1, scale=scale)
+    values = rbs.ev(yy, xx)
+    assert np.allclose(values, kernel, atol=dx / scale ** 2 * 5)
+    assert np.allclose(values.sum() * dx * dx, math.sqrt(3) / 2, rtol=1e-4)
+
+
+def test_rescaling_kernel_cache(tmpdir, monkeypatch):
+    from megaradrp.core.cache import ArrayCache
+    import megaradrp.processing.hexspline as hspline
+
+    cache = ArrayCache(str(tmpdir))
+    hspline._kernels.clear()
+    rbs1 = rescaling_kernel(2, scale=0.4, cache=cache)
+    assert rescaling_kernel(2, scale=0.4, cache=cache) is rbs1
+    assert len(cache.entries()) == 1
+
+    # Loaded from disk
+    hspline._kernels.clear()
+    rbs2 = rescaling_kernel(2, scale=0.4, cache=cache)
+    assert rbs2 is not rbs1
+    y, x = np.mgrid[-1:1:21j, -1:1:21j]
+    assert np.array_equal(rbs1.ev(y, x), rbs2.ev(y, x))
+    assert np.allclose(rbs2.integral(-3, 3, -3, 3), math.sqrt(3) / 2, rtol=1e-2)
+
+    rescaling_kernel(1, scale=0.4, cache=cache)
+    assert len(cache.entries()) == 2
+
+    # Entries with other format are not used
+    hspline._kernels.clear()
+    monkeypatch.setattr(hspline, 'KERNEL_CACHE_VERSION', hspline.KERNEL_CACHE_VERSION + 1)
+    rescaling_kernel(2, scale=0.4, cache=cache)
+    assert len(cache.entries()) == 3
+    hspline._kernels.clear()
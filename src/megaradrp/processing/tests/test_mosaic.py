@@ -0,0 +1,135 @@
+
+import pytest
+import numpy as np
+import astropy.io.fits as fits
+import astropy.wcs
+
+from megaradrp.datamodel import create_default_fiber_header
+from megaradrp.tests.simpleobj import create_spec_header2, create_sky_header2
+
+from ..cube import create_cube_from_rss, main
+from ..multirss import generate_multi_rss
+from ..mosaic import create_mosaic_cube_from_rss, write_mosaic_cube_from_rss
+from ..wcs import compute_pa_from_ipa
+from ..fixrss import fix_missing_fiber, recompute_wcs
+
+
+def create_test_pointing(offset_arcsec, nwave=5, value=1.0):
+    hdr = create_spec_header2()
+    hdr['INSMODE'] = 'LCB'
+    fibers_hdr = create_default_fiber_header('LCB')
+    fibers_hdr.update(create_sky_header2())
+    dra, ddec = offset_arcsec
+    fibers_hdr['CRVAL1'] += dra / 3600.0 / np.cos(np.deg2rad(fibers_hdr['CRVAL2']))
+    fibers_hdr['CRVAL2'] += ddec / 3600.0
+    data = np.full((623, nwave), value, dtype='float32')
+    return fits.HDUList([
+        fits.PrimaryHDU(data, header=hdr),
+        fits.ImageHDU(header=fibers_hdr, name='FIBERS')
+    ])
+
+
+def peak_position(cube):
+    wcs = astropy.wcs.WCS(cube[0].header).celestial
+    img = cube[0].data[0]
+    y, x = np.unravel_index(np.argmax(img), img.shape)
+    return wcs.all_pix2world(x, y, 0)
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_mosaic_single(p):
+    rss = create_test_pointing((0, 0))
+    rss[0].data[:] = np.linspace(0, 1, 623)[:, np.newaxis]
+    cube = create_cube_from_rss(rss, p, target_scale_arcsec=0.5)
+    mosaic = create_mosaic_cube_from_rss([rss], p, target_scale_arcsec=0.5)
+    assert np.allclose(mosaic[0].data, cube[0].data)
+    assert mosaic[0].header['CRPIX1'] == cube[0].header['CRPIX1']
+    assert mosaic[0].header['CRPIX2'] == cube[0].header['CRPIX2']
+
+
+def test_mosaic_overlap():
+    offsets = [(0, 0), (6, 0), (0, 5), (6, 5)]
+    imgs = [create_test_pointing(offset) for offset in offsets]
+    mosaic = create_mosaic_cube_from_rss(imgs, 1, target_scale_arcsec=0.5,
+                                         conserve_flux=False)
+    assert len(mosaic) == 1 + len(offsets)
+    single = create_cube_from_rss(imgs[0], 1, target_scale_arcsec=0.5,
+                                  conserve_flux=False)
+    assert mosaic[0].data.shape[1] > single[0].data.shape[1]
+    assert mosaic[0].data.shape[2] > single[0].data.shape[2]
+    # The overlapping pointings are averaged
+    values = mosaic[0].data[0]
+    inside = values > 0.99
+    assert inside.sum() > 0.8 * (values > 0.1).sum()
+    assert np.allclose(values[inside], 1.0, atol=0.01)
+
+
+def test_mosaic_registration():
+    offsets = [(0, 0), (8, -3)]
+    imgs = [create_test_pointing(offset, value=0.0) for offset in offsets]
+    # A point source in one fiber of the second pointing
+    imgs[1][0].data[300] = 10.0
+    single = create_cube_from_rss(imgs[1], 1, target_scale_arcsec=0.4)
+    expected = peak_position(single)
+    crval = imgs[1]['FIBERS'].header['CRVAL1']
+
+    multi = generate_multi_rss(imgs)
+    mosaic = create_mosaic_cube_from_rss(multi, 1, target_scale_arcsec=0.4)
+    assert mosaic['FIBERS2'].header['CRVAL1'] == crval
+    result = peak_position(mosaic)
+    # Less than one pixel
+    assert np.allclose(result, expected, atol=0.4 / 3600)
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_write_mosaic_cube_from_rss(tmpdir, p):
+    offsets = [(0, 0), (6, 0), (0, 5)]
+    imgs = [create_test_pointing(offset, nwave=7) for offset in offsets]
+    for idx, img in enumerate(imgs):
+        img[0].data *= np.linspace(1, 2, 7) * (idx + 1)
+    multi = generate_multi_rss(imgs)
+    expected = create_mosaic_cube_from_rss(multi, p, target_scale_arcsec=0.5)
+    filename = str(tmpdir.join('mosaic.fits'))
+    write_mosaic_cube_from_rss(multi, filename, p, target_scale_arcsec=0.5, chunk_size=3)
+    with fits.open(filename) as result:
+        assert len(result) == len(expected)
+        assert result[0].header['BITPIX'] == -32
+        assert np.allclose(result[0].data, expected[0].data, rtol=1e-6)
+        assert result[0].header['CRPIX1'] == expected[0].header['CRPIX1']
+        assert 'MEG-NRSS' not in result[0].header
+        for idx in range(1, len(offsets) + 1):
+            assert result[f'FIBERS{idx}'].header['CRVAL1'] == expected[f'FIBERS{idx}'].header['CRVAL1']
+
+
+@pytest.mark.parametrize("options", [[], ['--fix-missing'], ['--wcs-pa-from-header']])
+def test_main_mosaic(tmpdir, options):
+    offsets = [(0, 0), (6, 0)]
+    ipas = [10.0, 40.0]
+    imgs = [create_test_pointing(offset, nwave=7) for offset in offsets]
+    for img, ipa in zip(imgs, ipas):
+        img[0].header['IPA'] = ipa
+        img[0].data *= np.linspace(1, 2, 623)[:, np.newaxis]
+        # A missing fiber
+        img[0].data[622] = 0.0
+    multi = generate_multi_rss(imgs)
+    rssname = str(tmpdir.join('multi.fits'))
+    multi.writeto(rssname)
+    outfile = str(tmpdir.join('cube.fits'))
+    main([rssname, '-o', outfile, '-p', '0.5', '--chunk-size', '3'] + options)
+
+    # Each pointing is processed as a single RSS
+    if '--wcs-pa-from-header' not in options:
+        for img, ipa in zip(imgs, ipas):
+            img['FIBERS'].header = recompute_wcs(img['FIBERS'].header, ipa=ipa)
+    if '--fix-missing' in options:
+        for img in imgs:
+            fix_missing_fiber(img, 623)
+    expected = create_mosaic_cube_from_rss(imgs, 1, target_scale_arcsec=0.5)
+    with fits.open(outfile) as result:
+        assert np.allclose(result[0].data, expected[0].data, rtol=1e-6)
+        for idx, ipa in enumerate(ipas, 1):
+            pc11 = result[f'FIBERS{idx}'].header['PC1_1']
+            if '--wcs-pa-from-header' in options:
+                assert pc11 == imgs[idx - 1]['FIBERS'].header['PC1_1']
+            else:
+                assert pc11 == pytest.approx(np.cos(np.deg2rad(compute_pa_from_ipa(ipa))))
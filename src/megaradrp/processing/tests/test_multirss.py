@@ -3,7 +3,7 @@ import pytest
 import astropy.io.fits as fits
 import numpy
 
-from ..multirss import generate_multi_rss
+from ..multirss import generate_multi_rss, write_multi_rss
 
 def generate_imgs(nimages, nfibers, nsamples):
     imgs = []
@@ -45,3 +45,71 @@ def test_multirss_error():
 
     with pytest.raises(ValueError):
         generate_multi_rss(imgs)
+
+
+def test_write_multirss(tmpdir):
+    from numina.types.dataframe import DataFrame
+
+    nimages = 4
+    nfibers = 12
+    nsamples = 300
+    imgs = generate_imgs(nimages, nfibers, nsamples)
+    frames = []
+    for idx, img in enumerate(imgs):
+        img[0].data[...] = idx
+        filename = str(tmpdir.join(f'rss{idx}.fits'))
+        img.writeto(filename)
+        frames.append(DataFrame(filename=filename))
+
+    filename = str(tmpdir.join('multirss.fits'))
+    with write_multi_rss(frames, filename) as result:
+        assert len(result) == nimages
+        primary = result.hdulist[0]
+        assert primary.header['MEG-NRSS'] == nimages
+        assert primary.data.dtype.kind == 'f'
+        assert primary.data.dtype.itemsize == 4
+        assert primary.data.shape == (nimages * nfibers, nsamples)
+        for idx in range(nimages):
+            assert numpy.all(result.data(idx) == idx)
+            assert result.fibers(idx).header['EXTNAME'] == f"FIBERS{idx + 1}"
+            rss = result[idx]
+            assert rss[0].data.shape == (nfibers, nsamples)
+            assert rss['FIBERS'].header['EXTNAME'] == 'FIBERS'
+        with pytest.raises(IndexError):
+            result.data(nimages)
+
+    # Same contents as in memory
+    with fits.open(filename) as hdul:
+        expected = generate_multi_rss(imgs)
+        assert len(hdul) == len(expected)
+        assert numpy.array_equal(hdul[0].data, expected[0].data)
+    # The input is not modified
+    assert imgs[0][1].header['EXTNAME'] == 'FIBERS'
+
+
+def test_fastmapping_recipe(tmpdir, monkeypatch):
+    from numina.core import ObservationResult
+    from numina.types.dataframe import DataFrame
+    from megaradrp.recipes.scientific.lcbfastmapping import LCBFastMappingRecipe
+
+    nimages = 3
+    frames = []
+    for idx, img in enumerate(generate_imgs(nimages, 12, 300)):
+        img[0].data[...] = idx
+        filename = str(tmpdir.join(f'rss{idx}.fits'))
+        img.writeto(filename)
+        frames.append(DataFrame(filename=filename))
+    workdir = tmpdir.mkdir('work')
+    monkeypatch.chdir(workdir)
+
+    ob = ObservationResult()
+    ob.frames = frames
+    recipe = LCBFastMappingRecipe()
+    result = recipe.run(recipe.create_input(obresult=ob))
+    hdulist = result.final_multirss.open()
+    assert hdulist[0].header['MEG-NRSS'] == nimages
+    assert numpy.all(hdulist[0].data[24:] == 2)
+    # The result can be saved
+    hdulist.writeto(str(tmpdir.join('saved.fits')))
+    # No files are left in the working directory
+    assert workdir.listdir() == []
@@ -0,0 +1,69 @@
+
+import numpy
+import pytest
+from numina.modeling.gaussbox import gauss_box_model
+
+from ..profilefit import fit_column, fit_columns
+
+
+def create_column(nrow, amplitude, mean, stddev):
+    rows = numpy.arange(nrow)
+    column = numpy.zeros((nrow,))
+    for a, m, s in zip(amplitude, mean, stddev):
+        column += gauss_box_model(rows, amplitude=a, mean=m, stddev=s)
+    return column
+
+
+@pytest.fixture
+def profile_params():
+    rng = numpy.random.default_rng(1234)
+    nfib = 40
+    mean = 20 + 6.5 * numpy.arange(nfib) + rng.normal(0, 0.1, nfib)
+    stddev = rng.uniform(1.3, 1.8, nfib)
+    amplitude = rng.uniform(500, 2000, nfib)
+    return amplitude, mean, stddev
+
+
+def test_fit_column(profile_params):
+    amplitude, mean, stddev = profile_params
+    column = create_column(300, amplitude, mean, stddev)
+    init = mean + numpy.linspace(-0.3, 0.3, len(mean))
+    a, m, s, niter = fit_column(column, init, 1.53)
+    assert niter > 1
+    assert numpy.allclose(m, mean, atol=1e-3)
+    assert numpy.allclose(s, stddev, atol=1e-3)
+    assert numpy.allclose(a, amplitude, rtol=1e-3)
+
+
+def test_fit_column_bounds(profile_params):
+    amplitude, mean, stddev = profile_params
+    column = create_column(300, amplitude, mean, stddev)
+    init = mean + 0.5
+    _, m, _, _ = fit_column(column, init, 1.53, mean_range=0.2)
+    assert numpy.all(m >= init - 0.2 - 1e-12)
+
+
+def test_fit_columns_warm_start(profile_params):
+    amplitude, mean, stddev = profile_params
+    # traces move 0.3 pixels per column, predicted without offset
+    columns = [create_column(300, amplitude, mean + 0.3 * i, stddev) for i in range(3)]
+    centers = [mean + 0.3 * i - 0.2 for i in range(3)]
+    for warm_start in [True, False]:
+        fits = fit_columns(columns, centers, 1.53, warm_start=warm_start)
+        assert len(fits) == 3
+        for i, (a, m, s) in enumerate(fits):
+            assert numpy.allclose(m, mean + 0.3 * i, atol=1e-3)
+
+
+def test_fit_columns_warm_start_bounds(profile_params):
+    amplitude, mean, stddev = profile_params
+    # traces drift away from the predicted centers and the profiles
+    # widen, 0.4 pixels per column
+    ncols = 10
+    columns = [create_column(300, amplitude, mean + 0.4 * i, stddev + 0.4 * i)
+               for i in range(ncols)]
+    centers = [mean] * ncols
+    fits = fit_columns(columns, centers, 1.53, warm_start=True)
+    for a, m, s in fits:
+        assert numpy.all(numpy.abs(m - mean) <= 0.5 + 1e-12)
+        assert numpy.all(s <= 1.53 + 0.5 + 1e-12)
@@ -0,0 +1,144 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+import numpy
+import numpy.polynomial.polynomial as nppol
+import pytest
+
+import megaradrp.products.tracemap as tm
+import megaradrp.products.modelmap as mm
+from ..traceshift import measure_trace_shift, shifted_apertures
+from ..traceshift import fit_shift
+
+
+SHAPE = (820, 600)
+
+
+def fiber_center(fibid):
+    # Fibers in boxes of 20
+    return 12 + 6.5 * (fibid - 1) + 3 * ((fibid - 1) // 20)
+
+
+def create_tracemap(nfibers=120, missing=(7, 50)):
+    tracemap = tm.TraceMap(instrument='TEST1')
+    tracemap.uuid = '123456789'
+    tracemap.total_fibers = nfibers
+    tracemap.ref_column = SHAPE[1] // 2
+    for fibid in range(1, nfibers + 1):
+        fitparms = [] if fibid in missing else [fiber_center(fibid), 2e-3, -3e-6]
+        boxid = (fibid - 1) // 20 + 1
+        tracemap.contents.append(tm.GeometricTrace(fibid, boxid, 1, SHAPE[1], fitparms))
+    return tracemap
+
+
+def create_modelmap(nfibers=120, missing=(7, 50)):
+    model_map = mm.ModelMap(instrument='TEST1')
+    model_map.uuid = '123456789'
+    model_map.total_fibers = nfibers
+    model_map.ref_column = SHAPE[1] // 2
+    for fibid in range(1, nfibers + 1):
+        if fibid in missing:
+            model = {}
+        else:
+            params = {
+                'mean': nppol.Polynomial([fiber_center(fibid), 2e-3, -3e-6]),
+                'stddev': nppol.Polynomial([1.6])
+            }
+            model = {'model_name': 'gaussbox', 'params': params}
+        model_map.contents.append(mm.GeometricModel(fibid, 1, 1, SHAPE[1], model))
+    return model_map
+
+
+def create_image(trace_repr, shift, seed=2):
+    rows = numpy.arange(SHAPE[0])[:, numpy.newaxis]
+    cols = numpy.arange(SHAPE[1])
+    img = numpy.full(SHAPE, 50.0)
+    for aper in trace_repr.contents:
+        if aper.valid:
+            center = aper.aper_center()
+            pos = center(cols) + shift(center(trace_repr.ref_column))
+            img += 1000 * numpy.exp(-0.5 * ((rows - pos) / 1.6) ** 2)
+    return img + numpy.random.default_rng(seed).normal(0, 5, SHAPE)
+
+
+def test_measure_trace_shift():
+    tracemap = create_tracemap()
+    expected = nppol.Polynomial([0.7, 2e-4])
+    img = create_image(tracemap, expected)
+    shift = measure_trace_shift(img, tracemap)
+    yy = numpy.linspace(10, 800, 5)
+    assert numpy.allclose(shift(yy), expected(yy), atol=0.02)
+
+
+def test_measure_trace_shift_offset():
+    # The measured shift is relative to the current offset
+    tracemap = create_tracemap()
+    expected = nppol.Polynomial([0.7, 2e-4])
+    img = create_image(tracemap, expected)
+    tracemap.global_offset = nppol.Polynomial([0.5])
+    shift = measure_trace_shift(img, tracemap)
+    yy = numpy.linspace(10, 800, 5)
+    assert numpy.allclose(shift(yy) + 0.5, expected(yy), atol=0.02)
+
+
+@pytest.mark.parametrize("value", [-8.3, 4.49, 9.6])
+def test_measure_trace_shift_constant(value):
+    tracemap = create_tracemap()
+    img = create_image(tracemap, nppol.Polynomial([value]))
+    shift = measure_trace_shift(img, tracemap, deg=0)
+    assert shift.degree() == 0
+    assert shift.coef[0] == pytest.approx(value, abs=0.02)
+
+
+@pytest.mark.filterwarnings('error')
+def test_measure_trace_shift_no_peaks():
+    # Fibers outside of the image
+    tracemap = create_tracemap()
+    img = create_image(tracemap, nppol.Polynomial([0.0]))[:500]
+    shift = measure_trace_shift(img, tracemap, deg=0)
+    assert shift.coef[0] == pytest.approx(0.0, abs=0.02)
+
+
+def test_measure_trace_shift_modelmap():
+    model_map = create_modelmap()
+    img = create_image(model_map, nppol.Polynomial([-2.3]))
+    shift = measure_trace_shift(img, model_map, deg=0)
+    assert shift.coef[0] == pytest.approx(-2.3, abs=0.02)
+
+
+@pytest.mark.filterwarnings('error')
+def test_fit_shift_outliers():
+    ref_centers = numpy.linspace(10, 800, 100)
+    shifts = numpy.repeat(1.0 + 1e-3 * ref_centers[:, numpy.newaxis], 3, axis=1)
+    shifts[10] = 5.0
+    shifts[20] = numpy.nan
+    shifts[30, 0] = -5.0
+    shift = fit_shift(ref_centers, shifts, deg=1)
+    assert numpy.allclose(shift.coef, [1.0, 1e-3])
+
+
+@pytest.mark.filterwarnings('error')
+def test_fit_shift_empty():
+    shifts = numpy.full((10, 3), numpy.nan)
+    with pytest.raises(ValueError):
+        fit_shift(numpy.arange(10.0), shifts, deg=1)
+
+
+@pytest.mark.parametrize("create", [create_tracemap, create_modelmap])
+def test_shifted_apertures(create):
+    trace_repr = create()
+    trace_repr.global_offset = nppol.Polynomial([0.5])
+    result = shifted_apertures(trace_repr, nppol.Polynomial([0.2, 1e-3]))
+    assert isinstance(result, trace_repr.__class__)
+    assert result.uuid != trace_repr.uuid
+    assert numpy.allclose(result.global_offset.coef, [0.7, 1e-3])
+    # The original is not modified
+    assert numpy.allclose(trace_repr.global_offset.coef, [0.5])
+    assert result.contents == trace_repr.contents
+    assert result.contents is not trace_repr.contents
@@ -1,5 +1,9 @@
 from megaradrp.processing.trimover import OverscanCorrector
+from megaradrp.processing.trimover import TrimImage, GainCorrector, OverscanTrimCorrector
 import numpy
+import pytest
+import astropy.io.fits as fits
+import numina.util.flow as flowmod
 
 def test_OverscanCorrector():
 
@@ -58,5 +62,82 @@ def test_amp_1():
     assert fit2.shape == (2056,)
 
 
+def test_fit_frames():
+
+    detconf = {
+        'trim1': [[0, 2056], [50, 4146]],
+        'trim2': [[2156, 4212], [50, 4146]],
+        'bng': [1, 1],
+        'overscan1': [[0, 2056], [4149, 4196]],
+        'overscan2': [[2156, 4212], [0, 50]],
+        'prescan1': [[0, 2056], [0, 50]],
+        'prescan2': [[2156, 4212], [4145, 4196]],
+        'middle1': [[2056, 2106], [50, 4146]],
+        'middle2': [[2106, 2156], [50, 4146]]
+    }
+
+    oc = OverscanCorrector(detconf)
+    rng = numpy.random.default_rng(123)
+    rows = numpy.arange(4212)[:, numpy.newaxis]
+    frames = []
+    for level in [1000, 2000, 3000]:
+        data = level + 0.001 * rows + rng.normal(0, 3.0, size=(4212, 4196))
+        frames.append(data.astype('float32'))
+
+    results = oc.fit_frames(frames)
+    assert len(results) == 3
+    for data, fits_amps in zip(frames, results):
+        fit1, spl1 = oc.eval_spline_amp1(data)
+        fit2, spl2 = oc.eval_spline_amp2(data)
+        assert numpy.allclose(fits_amps[0].fitted, fit1, rtol=0, atol=1e-8)
+        assert numpy.allclose(fits_amps[1].fitted, fit2, rtol=0, atol=1e-8)
+        assert numpy.allclose(fits_amps[0].spline.c, spl1.get_coeffs())
+        assert numpy.isclose(fits_amps[0].median, numpy.median(data[oc.ocol1]))
+        assert 0.35 < fits_amps[0].rms < 0.5
+        assert 2.9 < fits_amps[1].std < 3.1
+
+    # The fit of a frame does not depend on the other frames
+    single = oc.fit(frames[1])
+    for amp in range(2):
+        assert numpy.array_equal(single[amp].fitted, results[1][amp].fitted)
+
+
+@pytest.mark.parametrize("gain", [False, True])
+def test_overscan_trim_corrector(gain):
+
+    detconf = {
+        'trim1': [[0, 2056], [50, 4146]],
+        'trim2': [[2156, 4212], [50, 4146]],
+        'bng': [1, 1],
+        'overscan1': [[0, 2056], [4146, 4196]],
+        'overscan2': [[2156, 4212], [0, 50]],
+        'prescan1': [[0, 2056], [0, 50]],
+        'prescan2': [[2156, 4212], [4146, 4196]],
+        'middle1': [[2056, 2106], [50, 4146]],
+        'middle2': [[2106, 2156], [50, 4146]],
+        'gain1': 1.73,
+        'gain2': 1.6
+    }
+
+    rng = numpy.random.default_rng(321)
+    data = rng.integers(1000, 1100, size=(4212, 4196)).astype('uint16')
+
+    nodes = [OverscanCorrector(detconf), TrimImage(detconf)]
+    if gain:
+        nodes.append(GainCorrector(detconf))
+    flow = flowmod.SerialFlow(nodes)
+    expected = flow(fits.HDUList([fits.PrimaryHDU(data.copy())]))
+
+    img = fits.HDUList([fits.PrimaryHDU(data)])
+    result = OverscanTrimCorrector(detconf, gain=gain)(img)
+
+    assert result[0].data.dtype == expected[0].data.dtype
+    assert numpy.array_equal(result[0].data, expected[0].data)
+    assert result[0].header.get('BUNIT') == expected[0].header.get('BUNIT')
+    assert set(result[0].header) == set(expected[0].header)
+    # The input is not modified
+    assert img[0].data is data
+
+
 if __name__ == "__main__":
     test_OverscanCorrector()
@@ -1,4 +1,6 @@
 import pytest
+import numpy
+import numpy.polynomial.polynomial as nppol
 import astropy.io.fits as fits
 
 from megaradrp.tests.simpleobj import create_spec_header
@@ -34,3 +36,166 @@ def test_add_barycentric_missing3():
 
     with pytest.raises(TypeError):
         header_add_barycentric_correction(hdr, key='b')
+
+
+def create_test_solution(nfibers, missing=()):
+    from numina.array.wavecalib.arccalibration import SolutionArcCalibration
+    import megaradrp.products.wavecalibration as wcal
+
+    solutionwl = wcal.WavelengthCalibration(instrument='TEST1')
+    solutionwl.global_offset = nppol.Polynomial([0.5])
+    for fibid in range(1, nfibers + 1):
+        if fibid in missing:
+            continue
+        coeff = [6000.0 + 0.1 * fibid, 0.38 + 1e-4 * fibid, 1.2e-6, -1e-10]
+        solution = SolutionArcCalibration.__new__(SolutionArcCalibration)
+        solution.coeff = coeff
+        solutionwl.contents.append(wcal.FiberSolutionArcCalibration(fibid, solution))
+    return solutionwl
+
+
+def resample_rss_flux_loop(arr, solutionwl, npix, finalwcs):
+    # Reference implementation, one interpolator per fiber
+    from numina.array.interpolation import SteffenInterpolator
+    from numpy.polynomial.polynomial import polyval
+    from ..wavecalibration import pixel_borders
+
+    subwcs = finalwcs.sub(['spectral'])
+    new_wl, = subwcs.all_pix2world(numpy.arange(npix), 0)
+    new_wl_borders = pixel_borders(new_wl)
+    old_x_borders = numpy.arange(-0.5, arr.shape[1]) + 1.0
+    accum_flux = numpy.zeros((arr.shape[0], arr.shape[1] + 1))
+    accum_flux[:, 1:] = numpy.cumsum(arr, axis=1)
+    result = numpy.zeros((arr.shape[0], npix))
+    for fibsol in solutionwl.contents:
+        coeff = numpy.array(fibsol.solution.coeff)
+        coeff[0] -= solutionwl.global_offset(fibsol.fibid)
+        old_wl_borders = polyval(old_x_borders, coeff)
+        interpolator = SteffenInterpolator(old_wl_borders, accum_flux[fibsol.fibid - 1],
+                                           extrapolate='border')
+        fl_borders = interpolator(new_wl_borders)
+        result[fibsol.fibid - 1] = fl_borders[1:] - fl_borders[:-1]
+    return result
+
+
+def test_resample_rss_flux():
+    from ..wavecalibration import SimpleWcs1D, resample_rss_flux
+
+    nfibers, nsamples, npix = 100, 1000, 1100
+    rng = numpy.random.default_rng(1234)
+    arr = rng.uniform(0, 100, size=(nfibers, nsamples))
+    solutionwl = create_test_solution(nfibers, missing=(7,))
+    targetwcs = SimpleWcs1D(crval=6050.0, crpix=1.0, cdelt=0.37)
+    finalwcs = targetwcs.create_internal_wcs_()
+
+    expected = resample_rss_flux_loop(arr, solutionwl, npix, finalwcs)
+    result, limits = resample_rss_flux(arr, solutionwl, npix, finalwcs,
+                                       span=0, dtype='float32')
+    assert result.dtype == numpy.float32
+    assert numpy.allclose(result, expected, rtol=1e-5, atol=1e-3)
+    assert numpy.all(result[6] == 0)
+    assert len(limits) == nfibers - 1
+    # no flux outside the coverage of the fiber
+    fibid, (lower, upper) = limits[0]
+    assert fibid == 1
+    assert lower == 0
+    assert upper < npix - 1
+    assert numpy.all(result[0, upper + 1:] == 0)
+
+
+def test_steffen_interpolate():
+    from numina.array.interpolation import SteffenInterpolator
+    from ..wavecalibration import steffen_interpolate
+
+    rng = numpy.random.default_rng(4321)
+    x = numpy.cumsum(rng.uniform(0.5, 1.5, size=(5, 50)), axis=1)
+    y = rng.normal(size=(5, 50)).cumsum(axis=1)
+    # outside the range of x in both sides, and including x
+    x_new = numpy.sort(numpy.concatenate([numpy.linspace(-5, 80, 200), x[2]]))
+    result = steffen_interpolate(x, y, x_new)
+    for xrow, yrow, rrow in zip(x, y, result):
+        interpolator = SteffenInterpolator(xrow, yrow, extrapolate='border')
+        assert numpy.allclose(rrow, interpolator(x_new), rtol=1e-12, atol=1e-12)
+
+
+def test_get_resampler():
+    from ..wavecalibration import SimpleWcs1D, get_resampler
+
+    nfibers, nsamples, npix = 20, 500, 600
+    rng = numpy.random.default_rng(1234)
+    arr = rng.uniform(0, 100, size=(nfibers, nsamples))
+    solutionwl = create_test_solution(nfibers, missing=(3,))
+    targetwcs = SimpleWcs1D(crval=6050.0, crpix=1.0, cdelt=0.37)
+
+    expected = resample_rss_flux_loop(arr, solutionwl, npix, targetwcs.create_internal_wcs_())
+    resampler = get_resampler(solutionwl, npix, targetwcs, arr.shape)
+    assert get_resampler(solutionwl, npix, targetwcs, arr.shape) is resampler
+    assert get_resampler(solutionwl, npix, targetwcs, arr.shape, span=2) is not resampler
+    assert get_resampler(solutionwl.prepare(), npix, targetwcs, arr.shape) is resampler
+    # Same calibid, different coefficients
+    other = create_test_solution(nfibers, missing=(3,))
+    other.uuid = solutionwl.uuid
+    other.contents[0].solution.coeff = [6000.5, 0.38, 1.2e-6, -1e-10]
+    assert other.calibid == solutionwl.calibid
+    assert get_resampler(other, npix, targetwcs, arr.shape) is not resampler
+
+    assert numpy.allclose(resampler(arr), expected)
+    assert numpy.allclose(resampler(2 * arr), 2 * expected)
+
+    wlmap = resampler.wlmap()
+    assert wlmap.shape == (nfibers, npix)
+    assert numpy.all(wlmap[2] == 0)
+    for fibid, (lower, upper) in resampler.limits:
+        assert numpy.all(wlmap[fibid - 1, lower:upper + 1] == 1)
+        assert wlmap[fibid - 1].sum() == upper - lower + 1
+
+    with pytest.raises(ValueError):
+        resampler(arr[:, 1:])
+
+
+def test_resample_rss_flux_idempotent():
+    from ..wavecalibration import SimpleWcs1D, resample_rss_flux
+
+    nfibers, nsamples, npix = 10, 500, 600
+    arr = numpy.ones((nfibers, nsamples))
+    solutionwl = create_test_solution(nfibers)
+    coeffs = [list(fibsol.solution.coeff) for fibsol in solutionwl.contents]
+    finalwcs = SimpleWcs1D(crval=6050.0, crpix=1.0, cdelt=0.37).create_internal_wcs_()
+
+    result1, limits1 = resample_rss_flux(arr, solutionwl, npix, finalwcs)
+    result2, limits2 = resample_rss_flux(arr, solutionwl, npix, finalwcs)
+    assert [fibsol.solution.coeff for fibsol in solutionwl.contents] == coeffs
+    assert numpy.array_equal(result1, result2)
+    assert limits1 == limits2
+
+    prepared = solutionwl.prepare()
+    result3, limits3 = resample_rss_flux(arr, prepared, npix, finalwcs)
+    assert numpy.array_equal(result1, result3)
+    assert limits1 == limits3
+
+
+@pytest.mark.parametrize("prepare", [False, True])
+def test_calibrate_wl_rss(prepare):
+    from ..wavecalibration import SimpleWcs1D, calibrate_wl_rss
+
+    nfibers, nsamples, npix = 10, 500, 600
+    arr = numpy.ones((nfibers, nsamples))
+    solutionwl = create_test_solution(nfibers, missing=(3,))
+    solutionwl.missing_fibers = [3]
+    solutionwl.error_fitting = [5]
+    if prepare:
+        solutionwl = solutionwl.prepare()
+    targetwcs = SimpleWcs1D(crval=6050.0, crpix=1.0, cdelt=0.37)
+
+    rss = fits.HDUList([
+        fits.PrimaryHDU(arr, header=create_spec_header()),
+        fits.ImageHDU(name='FIBERS')
+    ])
+    result = calibrate_wl_rss(rss, solutionwl, npix, targetwcs)
+    assert result[0].data.shape == (nfibers, npix)
+    fibers_hdr = result['FIBERS'].header
+    assert fibers_hdr['FIB003_V'] is False
+    assert fibers_hdr['FIB005_V'] is False
+    assert 'FIB001_V' not in fibers_hdr
+    assert 'FIB001W1' in fibers_hdr
+    assert result['WLMAP'].data.shape == (nfibers, npix)
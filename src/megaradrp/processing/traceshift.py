@@ -0,0 +1,207 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Registration of existing traces to a new image"""
+
+import copy
+import logging
+import uuid
+
+import numpy
+import numpy.polynomial.polynomial as nppol
+from numina.array.peaks.peakdet import refine_peaks
+
+from megaradrp.processing.boxes import comb_offset
+from megaradrp.products.modelmap import ModelMap
+
+
+_logger = logging.getLogger(__name__)
+
+
+def default_columns(ncols, ncolumns=7, margin=0.1):
+    """Columns used to measure the shift, equally spaced in the image"""
+    limits = [margin * ncols, (1 - margin) * ncols]
+    return numpy.linspace(limits[0], limits[1], ncolumns).astype('int')
+
+
+def predicted_centers(trace_repr, columns):
+    """Centers of the valid apertures in columns.
+
+    The centers include the `global_offset` of `trace_repr`,
+    a TraceMap or a ModelMap.
+
+    Returns
+    -------
+    fibids : numpy.ndarray
+        Fiber ids of the valid apertures
+    ref_centers : numpy.ndarray
+        Center of each aperture in the reference column,
+        without the offset
+    centers : numpy.ndarray
+        Center of each aperture in each column,
+        with shape (nfibers, ncolumns)
+    """
+    columns = numpy.asarray(columns)
+    valid = [aper for aper in trace_repr.contents if aper.valid]
+    fibids = numpy.array([aper.fibid for aper in valid], dtype='int')
+    ref_centers = numpy.array([aper.aper_center()(trace_repr.ref_column) for aper in valid])
+    centers = numpy.array([aper.aper_center()(columns) for aper in valid])
+    centers = centers.reshape((len(valid), len(columns)))
+    centers += trace_repr.global_offset(ref_centers)[:, numpy.newaxis]
+    return fibids, ref_centers, centers
+
+
+def measure_column_shifts(cut, centers, sigma=1.5, max_shift=10, window=3):
+    """Shift of the peaks of the fibers in a cross section.
+
+    The global shift of the cross section is found first, by
+    cross-correlation with a comb of lines in `centers`. The
+    peak of each fiber is then searched near its shifted center, and
+    refined with :func:`numina.array.peaks.peakdet.refine_peaks`.
+
+    Parameters
+    ----------
+    cut : numpy.ndarray
+        Cross section of the image, along the rows
+    centers : numpy.ndarray
+        Expected center of each fiber
+    sigma : float
+        Width of the lines of the comb
+    max_shift : int
+        Maximum global shift searched
+    window : int
+        Width of the window used to refine the peaks
+
+    Returns
+    -------
+    numpy.ndarray
+        Shift of each fiber, NaN if the peak is not in the cross section
+
+    """
+    cut = numpy.asarray(cut, dtype='float')
+    signal = cut - numpy.median(cut)
+    # The first pixel of the comb is 1
+    offset, _, _ = comb_offset(signal, centers + 1, sigma=sigma, max_offset=max_shift)
+
+    step = window // 2
+    nrows = len(cut)
+    ipeaks = numpy.round(centers + offset).astype('int')
+    # Move to the local maximum
+    inside = (ipeaks >= 1) & (ipeaks < nrows - 1)
+    nearby = numpy.clip(ipeaks[:, numpy.newaxis] + numpy.arange(-1, 2), 0, nrows - 1)
+    ipeaks = nearby[numpy.arange(len(ipeaks)), cut[nearby].argmax(axis=1)]
+    inside &= (ipeaks >= step) & (ipeaks < nrows - step)
+
+    shifts = numpy.full(len(centers), numpy.nan)
+    if inside.any():
+        xc, _ = refine_peaks(cut, ipeaks[inside], window)
+        shifts[inside] = xc - centers[inside]
+    return shifts
+
+
+def fit_shift(ref_centers, shifts, deg=1, nsigma=3.0, niter=3):
+    """Fit a polynomial to the shifts of the fibers.
+
+    The shifts, with shape (nfibers, ncolumns), are combined with the
+    median for each fiber, and a polynomial of degree `deg` in the
+    positions of the fibers in the reference column is fitted,
+    rejecting fibers beyond `nsigma` times the robust deviation.
+
+    Returns
+    -------
+    numpy.polynomial.Polynomial
+
+    """
+    # Fibers without any peak are not used
+    fiber_shift = numpy.full(len(shifts), numpy.nan)
+    measured = numpy.isfinite(shifts).any(axis=1)
+    fiber_shift[measured] = numpy.nanmedian(shifts[measured], axis=1)
+    used = measured.copy()
+    if used.sum() <= deg:
+        raise ValueError('not enough fibers to fit the shift')
+    coef = None
+    for _ in range(niter):
+        coef = nppol.polyfit(ref_centers[used], fiber_shift[used], deg)
+        residuals = fiber_shift - nppol.polyval(ref_centers, coef)
+        mad = numpy.median(numpy.abs(residuals[used]))
+        keep = measured & (numpy.abs(residuals) <= nsigma * 1.4826 * mad)
+        if mad == 0 or keep.sum() <= deg or numpy.array_equal(keep, used):
+            break
+        used = keep
+    _logger.debug('shift fitted with %d fibers', used.sum())
+    return nppol.Polynomial(coef)
+
+
+def measure_trace_shift(data, trace_repr, columns=None, hs=3, deg=1,
+                        sigma=1.5, max_shift=10):
+    """Shift of the apertures of trace_repr in the image data.
+
+    The cross section of the image is measured in a few columns,
+    averaging `2 * hs + 1` columns around each. The peaks of the
+    fibers are compared with the positions predicted by `trace_repr`,
+    a TraceMap or a ModelMap, and the differences are fitted with a
+    polynomial in the position of the fibers in the reference column,
+    as the `global_offset` of the apertures.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+    trace_repr : TraceMap or ModelMap
+    columns : array_like, optional
+        Columns where the shift is measured, by default the columns
+        returned by :func:`default_columns`
+    hs : int
+    deg : int
+        Degree of the polynomial
+    sigma : float
+        Width of the profiles of the fibers
+    max_shift : int
+        Maximum shift searched, in pixels
+
+    Returns
+    -------
+    numpy.polynomial.Polynomial
+        The shift, to be added to the `global_offset` of `trace_repr`
+
+    """
+    if columns is None:
+        columns = default_columns(data.shape[1])
+    columns = numpy.asarray(columns)
+    _, ref_centers, centers = predicted_centers(trace_repr, columns)
+
+    shifts = numpy.empty_like(centers)
+    for idx, col in enumerate(columns):
+        cut = data[:, max(col - hs, 0):col + hs + 1].mean(axis=1)
+        shifts[:, idx] = measure_column_shifts(cut, centers[:, idx], sigma=sigma,
+                                               max_shift=max_shift)
+        found = numpy.isfinite(shifts[:, idx])
+        if found.any():
+            _logger.debug('median shift in column %d is %f', col, numpy.median(shifts[found, idx]))
+        else:
+            _logger.debug('no peaks found in column %d', col)
+    return fit_shift(ref_centers, shifts, deg=deg)
+
+
+def shifted_apertures(trace_repr, shift):
+    """A copy of trace_repr, with shift added to its global_offset.
+
+    The copy has a new UUID, and shares the apertures with trace_repr.
+    """
+    # __getstate__ is not used, it serializes the apertures
+    result = trace_repr.__class__.__new__(trace_repr.__class__)
+    result.__dict__.update(trace_repr.__dict__)
+    result.contents = list(trace_repr.contents)
+    result.tags = dict(trace_repr.tags)
+    result.meta_info = copy.deepcopy(trace_repr.meta_info)
+    result.global_offset = trace_repr.global_offset + shift
+    result.uuid = str(uuid.uuid1())
+    if isinstance(result, ModelMap):
+        # The pool of processes belongs to trace_repr
+        result._executor = None
+    return result
@@ -11,10 +11,11 @@ from __future__ import print_function, division
 
 import logging
 import datetime
+import collections
 
 import numpy as np
 import numpy
-from scipy.interpolate import LSQUnivariateSpline
+from scipy.interpolate import LSQUnivariateSpline, BSpline
 from astropy.io import fits
 
 
@@ -23,6 +24,19 @@ from numina.processing import Corrector
 
 _logger = logging.getLogger(__name__)
 
+# Interior knots of the overscan splines of each amplifier
+OVERSCAN_KNOTS = ([1200], [3100])
+
+OverscanFit = collections.namedtuple(
+    'OverscanFit', ['median', 'std', 'rms', 'fitted', 'spline']
+)
+OverscanFit.__doc__ = """Fit of the overscan of an amplifier.
+
+median and std are statistics of the overscan region, rms is the
+RMS of the residuals of the spline fitted to the mean of each row.
+fitted contains the values of the spline in the rows of the region.
+"""
+
 
 _direc = ['normal', 'mirror']
 
@@ -192,6 +206,7 @@ class OverscanCorrector(Corrector):
         self.orow2 = (slice(middleX, middleY), slice(middleZ, middleT))
         self.pcol2 = (slice(prescanX, prescanY), slice(prescanZ, prescanT))
         self.ocol2 = (slice(overscanX, overscanY), slice(overscanZ, overscanT))
+        self._spline_models = {}
 
         # self.test_image()
         super(OverscanCorrector, self).__init__(datamodel=datamodel,
@@ -228,46 +243,105 @@ class OverscanCorrector(Corrector):
 
         fits.writeto('eq_estimado.fits', data, overwrite=True)
 
-    def run(self, img):
-        imgid = self.get_imgid(img)
-        data = img[0].data
+    def fit(self, data):
+        """Fit the overscan of both amplifiers.
 
-        # p1 = data[self.pcol1].mean()
-        # _logger.debug('prescan1 is %f', p1)
-        # or1 = data[self.orow1].mean()
-        # _logger.debug('row overscan1 is %f', or1)
-        oc1 = np.median(data[self.ocol1])
-        _logger.debug('median col overscan1 is %f', oc1)
-        # avg = (p1 + or1 + oc1) / 3.0
+        Only the overscan regions of `data` are read, so it
+        can be a section of an image in a file.
 
-        oc2 = np.median(data[self.ocol2])
-        _logger.debug('median col overscan2 is %f', oc2)
+        Returns
+        -------
+        list of OverscanFit
+            The fit of each amplifier
+        """
+        return self.fit_frames([data])[0]
+
+    def fit_frames(self, frames_data):
+        """Fit the overscan of both amplifiers in several frames.
 
-        _logger.debug('compute spline for overscan1')
-        fit1, spl1 = self.eval_spline_amp1(data)
-        data[self.trim1] -= fit1[:, numpy.newaxis]
+        The overscan regions of all the frames are read, and the splines
+        of all the frames are fitted with a single least squares solution,
+        as the knots are fixed.
 
-        _logger.debug('compute spline for overscan2')
-        fit2, spl2 = self.eval_spline_amp2(data)
-        data[self.trim2] -= fit2[:, numpy.newaxis]
+        Parameters
+        ----------
+        frames_data : sequence of numpy.ndarray
+            The data of each frame, or sections of the images in files
 
-        hdr = img['primary'].header
+        Returns
+        -------
+        list of list of OverscanFit
+            The fit of each amplifier, for each frame
+        """
+        results = [[] for _ in frames_data]
+        regions = [self.ocol1, self.ocol2]
+        for amp, (region, knots) in enumerate(zip(regions, OVERSCAN_KNOTS), 1):
+            overscans = [data[region] for data in frames_data]
+            values = numpy.stack([ovs.mean(axis=1) for ovs in overscans])
+            knots_all, design, projection = self._spline_model(region[0], knots)
+            # The least squares solution is shared by all the frames. The
+            # products are computed per frame, so that the result of a frame
+            # is the same whatever the number of frames
+            coeffs = numpy.stack([projection @ vals for vals in values])
+            fitted = numpy.stack([design @ coef for coef in coeffs])
+            rms = numpy.sqrt(numpy.mean((values - fitted) ** 2, axis=1))
+            for idx, ovs in enumerate(overscans):
+                spl = BSpline(knots_all, coeffs[idx], 3)
+                median = np.median(ovs)
+                _logger.debug('median col overscan%d is %f', amp, median)
+                results[idx].append(
+                    OverscanFit(median, ovs.std(), rms[idx], fitted[idx], spl)
+                )
+        return results
+
+    def _spline_model(self, rows, knots, k=3):
+        # Knots, design matrix and least squares projection
+        # of the spline fitted to the rows
+        key = (rows.start, rows.stop, tuple(knots))
+        cache = self._spline_models
+        if key not in cache:
+            u = numpy.arange(rows.start, rows.stop, dtype='float')
+            knots_all = numpy.concatenate(
+                [[u[0]] * (k + 1), knots, [u[-1]] * (k + 1)]
+            )
+            ncoeffs = len(knots_all) - k - 1
+            design = BSpline(knots_all, numpy.eye(ncoeffs), k)(u)
+            cache[key] = knots_all, design, numpy.linalg.pinv(design)
+        return cache[key]
+
+    def row_offsets(self, fits_amps, nrows):
+        """Overscan of each row of the trimmed regions, from the result of `fit`"""
+        offsets = numpy.zeros((nrows,))
+        for region, result in zip([self.trim1, self.trim2], fits_amps):
+            offsets[region[0]] = result.fitted
+        return offsets
+
+    def update_header(self, hdr, fits_amps):
+        """Record the overscan correction in the header"""
         hdr['NUM-OVPE'] = self.calibid
         hdr['history'] = f'Overscan correction with {self.calibid}'
         hdr['history'] = f'Overscan correction time {datetime.datetime.utcnow().isoformat()}'
-        # hdr['history'] = 'Mean of prescan1 is %f' % p1
-        hdr['history'] = f'Median of col overscan1 is {oc1}'
-        hdr['history'] = "Overscan1 correction is spline3"
-        # hdr['history'] = 'prescan2 is %f' %  p2
-        hdr['history'] = f'Median of col overscan2 is {oc2}'
-        hdr['history'] = "Overscan2 correction is spline3"
-
-        for spl, label in zip([spl1, spl2], ['overscan1', 'overscan2']):
-            k, c, deg = spl._eval_args
-            hdr['history'] = f'{label} deg {deg}'
-            hdr['history'] = f'{label} knots {list(k)}'
-            hdr['history'] = f'{label} coeffs {list(c)}'
+        for label, result in zip(['overscan1', 'overscan2'], fits_amps):
+            hdr['history'] = f'Median of col {label} is {result.median}'
+            hdr['history'] = f'Std of col {label} is {result.std}'
+            hdr['history'] = f"{label.capitalize()} correction is spline3"
+
+        for label, result in zip(['overscan1', 'overscan2'], fits_amps):
+            spl = result.spline
+            hdr['history'] = f'{label} deg {spl.k}'
+            hdr['history'] = f'{label} knots {list(spl.t)}'
+            hdr['history'] = f'{label} coeffs {list(spl.c)}'
+            hdr['history'] = f'{label} fit rms {result.rms}'
+
+    def run(self, img):
+        imgid = self.get_imgid(img)
+        data = img[0].data
+
+        fits_amps = self.fit(data)
+        data[self.trim1] -= fits_amps[0].fitted[:, numpy.newaxis]
+        data[self.trim2] -= fits_amps[1].fitted[:, numpy.newaxis]
 
+        self.update_header(img['primary'].header, fits_amps)
         return img
 
     def fit_spline_amp1(self, data):
@@ -275,7 +349,7 @@ class OverscanCorrector(Corrector):
         region = self.ocol1
         u = numpy.arange(region[0].start, region[0].stop)
         v = data[region].mean(axis=1)
-        knots1 = [1200]
+        knots1 = OVERSCAN_KNOTS[0]
         spl1 = LSQUnivariateSpline(u, v, knots1, k=3)
         return spl1
 
@@ -290,7 +364,7 @@ class OverscanCorrector(Corrector):
         region = self.ocol2
         u = numpy.arange(region[0].start, region[0].stop)
         v = data[region].mean(axis=1)
-        knots2 = [3100]
+        knots2 = OVERSCAN_KNOTS[1]
         spl2 = LSQUnivariateSpline(u, v, knots2, k=3)
         return spl2
 
@@ -318,13 +392,29 @@ class TrimImage(Corrector):
         _logger.debug('trimming image %s', imgid)
 
         img[0] = trimOut(img[0], self.detconf)
-        hdr = img['primary'].header
+        self.update_header(img['primary'].header)
+        return img
+
+    def regions(self):
+        """Regions of the image kept by trimming, in order.
+
+        The trimmed image is formed by the regions stacked
+        along the rows.
+        """
+        bng = get_conf_value(self.detconf, 'bng')
+        result = []
+        for key in ['trim1', 'trim2']:
+            (r1, r2), (c1, c2) = get_conf_value(self.detconf, key)
+            result.append((slice(r1 // bng[0], r2 // bng[0]),
+                           slice(c1 // bng[1], c2 // bng[1])))
+        return result
+
+    def update_header(self, hdr):
+        """Record the trimming in the header"""
         hdr['NUM-TRIM'] = self.calibid
         hdr['history'] = f'Trimming correction with {self.calibid}'
         hdr['history'] = f'Trimming correction time {datetime.datetime.utcnow().isoformat()}'
 
-        return img
-
 
 class GainCorrector(Corrector):
     """A Corrector Node that corrects MEGARA images from different gain."""
@@ -344,17 +434,100 @@ class GainCorrector(Corrector):
         _logger.debug('gain correction in image %s', imgid)
 
         # img[0] = trimOut(img[0], self.detconf)
-        hdr = img['primary'].header
-        hdr['NUM-GAIN'] = self.calibid
-        hdr['BUNIT'] = 'ELECTRON'
-
         part = img[0].data.shape[0] // 2
 
         img[0].data[:part] *= self.gain1
         img[0].data[part:] *= self.gain2
 
+        self.update_header(img['primary'].header)
+        return img
+
+    def update_header(self, hdr):
+        """Record the gain correction in the header"""
+        hdr['NUM-GAIN'] = self.calibid
+        hdr['BUNIT'] = 'ELECTRON'
         hdr['history'] = f'Gain correction with {self.calibid}'
         hdr['history'] = f'Gain correction time {datetime.datetime.utcnow().isoformat()}'
         hdr['history'] = f'Gain1 correction value {self.gain1}'
         hdr['history'] = f'Gain2 correction value {self.gain2}'
-        return img
+
+
+def promote_uint16(data):
+    """Convert data of type uint16 to float32, as numina.processing.Corrector"""
+    if data.dtype in ['<u2', '>u2', '=u2']:
+        return data.astype('float32')
+    return data
+
+
+class _PromotedRegions(object):
+    # Regions of an image, promoted as the whole image in Corrector
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+
+    def __getitem__(self, key):
+        return promote_uint16(self.data[key])
+
+
+class OverscanTrimCorrector(Corrector):
+    """A Corrector Node that corrects from overscan, trims and optionally corrects from gain.
+
+    The result is the same as applying :class:`OverscanCorrector`,
+    :class:`TrimImage` and :class:`GainCorrector` in sequence, but
+    the image is read once, and the corrected regions are written
+    directly in the trimmed image, without intermediate copies.
+    The trimmed image is float32 in native byte order, and can be
+    used by the C extensions without conversion.
+    """
+
+    def __init__(self, detconf, gain=False, datamodel=None, calibid='calibid-unknown', dtype='float32'):
+        self.overscan = OverscanCorrector(detconf, datamodel=datamodel, calibid=calibid, dtype=dtype)
+        self.trimming = TrimImage(detconf, datamodel=datamodel, calibid=calibid, dtype=dtype)
+        if gain:
+            self.gain = GainCorrector(detconf, datamodel=datamodel, calibid=calibid, dtype=dtype)
+        else:
+            self.gain = None
+        super(OverscanTrimCorrector, self).__init__(
+            datamodel=datamodel,
+            calibid=calibid,
+            dtype=dtype
+        )
+
+    def __call__(self, img):
+        # The image is not promoted to float32 here, the
+        # regions are converted when copied to the trimmed image
+        return self.run(img)
+
+    def run(self, img):
+        imgid = self.get_imgid(img)
+        _logger.debug('overscan correction and trimming of image %s', imgid)
+        data = img[0].data
+        fits_amps = self.overscan.fit(_PromotedRegions(data))
+        regions = self.trimming.regions()
+        if self.gain is not None:
+            gains = [self.gain.gain1, self.gain.gain2]
+        else:
+            gains = [None, None]
+
+        nrows = sum(rows.stop - rows.start for rows, _ in regions)
+        ncols = regions[0][1].stop - regions[0][1].start
+        finaldata = numpy.empty((nrows, ncols), dtype='float32')
+        base = 0
+        for (rows, cols), result, gain in zip(regions, fits_amps, gains):
+            part = finaldata[base:base + rows.stop - rows.start]
+            # Computed in double precision, as subtracting in place
+            # from the promoted image
+            numpy.subtract(data[rows, cols], result.fitted[:, numpy.newaxis],
+                           out=part, casting='unsafe')
+            if gain is not None:
+                part *= gain
+            base += rows.stop - rows.start
+
+        hdr = img['primary'].header.copy()
+        for key in ['BSCALE', 'BZERO', 'BLANK']:
+            hdr.remove(key, ignore_missing=True)
+        self.overscan.update_header(hdr, fits_amps)
+        self.trimming.update_header(hdr)
+        if self.gain is not None:
+            self.gain.update_header(hdr)
+        return fits.HDUList([fits.PrimaryHDU(finaldata, header=hdr)] + img[1:])
@@ -11,8 +11,11 @@
 
 import logging
 import datetime
+import collections
+import threading
 import warnings
 import uuid
+import hashlib
 
 import numpy
 from numpy.polynomial.polynomial import polyval
@@ -23,12 +26,19 @@ import numina.datamodel as dm
 import numina.array.utils as utils
 from numina.frame.utils import copy_img
 from numina.processing import Corrector
-from numina.array.interpolation import SteffenInterpolator
 
 from megaradrp.instrument import WLCALIB_PARAMS
 
 _logger = logging.getLogger(__name__)
 
+# Number of fibers resampled together
+RESAMPLE_CHUNK = 16
+# Number of WavelengthResampler kept by get_resampler
+RESAMPLER_CACHE_SIZE = 2
+
+_resamplers = collections.OrderedDict()
+_resamplers_lock = threading.Lock()
+
 
 class SimpleWcs1D(object):
     """Store parameters of a simple 1D WCS"""
@@ -132,7 +142,7 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     rss: astropy.io.fits.HDUList
         A Row stacked Spectra MEGARA image, not WL calibrated
     solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
-        A wavelength calibration solution
+        A wavelength calibration solution, or the result of its `prepare`
     npix: int
         Number of channels of the calibrated RSS
     targetwcs: SimpleWcs1D
@@ -159,16 +169,12 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     _logger.debug('with wavecalib %s', solutionwl.calibid)
     _logger.debug('offsets are %s', solutionwl.global_offset.coef)
 
-    # Target WCS
-    re_wcs = targetwcs.create_internal_wcs_()
-
     _logger.debug('Resample RSS')
-    final, limits = resample_rss_flux(
-        rss[0].data, solutionwl, npix, re_wcs,
-        span=span, fill=0
-    )
+    resampler = get_resampler(solutionwl, npix, targetwcs, rss[0].data.shape, span=span)
+    final = resampler(rss[0].data, dtype=dtype)
+    limits = resampler.limits
 
-    rss[0].data = final.astype(dtype)
+    rss[0].data = final
 
     hdr = rss[0].header
     _logger.debug('Add WCS headers')
@@ -188,16 +194,13 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     hdr['UUID'] = str(uuid.uuid1())
 
     # Update other HDUs if needed
-    # dtype here can be int16 or uint8
-    map_data = numpy.zeros_like(final, dtype='int16')
+    map_data = resampler.wlmap()
 
     fibers_ext = rss['FIBERS']
     fibers_ext_headers = fibers_ext.header
     # Add KEYWORDS
     # FIB%03dW1, FIB%03dW2
     for fibid, (lower, upper) in limits:
-        idx = fibid - 1
-        map_data[idx, lower:upper+1] = 1
         # Update Fibers
         key = f"FIB{fibid:03d}W1"
         fibers_ext_headers[key] =  (lower + 1, "Start of spectral coverage")
@@ -222,6 +225,58 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     return rss
 
 
+def get_resampler(solutionwl, npix, targetwcs, shape, span=0, fill=0):
+    """Return a WavelengthResampler, reusing a previous one if possible.
+
+    The last RESAMPLER_CACHE_SIZE resamplers are kept, identified by
+    the calibid and a hash of the coefficients of the solution, with
+    the global offset applied, the target WCS and the shape of the image.
+    A solution modified under the same calibid gets a new resampler.
+
+    Parameters
+    ----------
+    solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
+        A wavelength calibration solution, or the result of its `prepare`
+    npix: int
+        Number of channels of the calibrated RSS
+    targetwcs: SimpleWcs1D
+        Common WCS solution
+    shape: tuple
+        Shape of the RSS images, not WL calibrated
+    span: int
+        Remove `span` pixels at both sides of the resampled image
+    fill: int
+        Value used to fill the values removed by `span`
+
+    Returns
+    -------
+    WavelengthResampler
+    """
+    prepared = solutionwl.prepare()
+    hasher = hashlib.sha1()
+    hasher.update(prepared.fibids.tobytes())
+    hasher.update(repr(prepared.coeff.shape).encode('utf-8'))
+    hasher.update(prepared.coeff.tobytes())
+    key = (
+        prepared.calibid, hasher.hexdigest(), npix,
+        targetwcs.crval, targetwcs.cdelt, targetwcs.crpix, tuple(shape), span, fill
+    )
+    with _resamplers_lock:
+        resampler = _resamplers.get(key)
+    if resampler is None:
+        _logger.debug('compute resampler for %s', solutionwl.calibid)
+        resampler = WavelengthResampler(
+            prepared, npix, targetwcs.create_internal_wcs_(), shape,
+            span=span, fill=fill
+        )
+    with _resamplers_lock:
+        _resamplers[key] = resampler
+        _resamplers.move_to_end(key)
+        while len(_resamplers) > RESAMPLER_CACHE_SIZE:
+            _resamplers.popitem(last=False)
+    return resampler
+
+
 def rss_add_wcs(hdr, crval, cdelt, crpix):
     """Add MEGARA 2D wavelength calibration headers"""
     c_crpix = 'Pixel coordinate of reference point'
@@ -319,9 +374,14 @@ def header_add_barycentric_correction(hdr, key='B', out=None):
     return out
 
 
-def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0):
+def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0, dtype='float64'):
     """Resample array according to a wavelength calibration solution
 
+    The accumulated flux of each fiber is interpolated in the borders of the
+    new pixels with a monotonic cubic interpolator, as in
+    :class:`numina.array.interpolation.SteffenInterpolator`. All the
+    fibers are resampled together.
+
     Parameters
     ----------
 
@@ -337,6 +397,8 @@ def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0):
         Remove `span` pixels at both sides of the resampled image
     fill: int
         Value used to fill the values removed by `span`
+    dtype: str
+        Convertible to numpy.dtype, type of the resampled array
 
     Returns
     -------
@@ -345,78 +407,261 @@ def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0):
     limits: a list of tuples
         Contains the fiberid and a pair with the first and last valid pixel (0-based)
     """
+    resampler = WavelengthResampler(solutionwl, npix, finalwcs, arr.shape,
+                                    span=span, fill=fill)
+    return resampler(arr, dtype=dtype), resampler.limits
 
-    nfibers = arr.shape[0]
-    nsamples = arr.shape[1]
 
-    # Use only the spectral axis
-    subwcs = finalwcs.sub(['spectral'])
+class WavelengthResampler(object):
+    """Resampling of RSS images according to a wavelength calibration solution
 
-    # wl_max,  = subwcs.all_pix2world([npix], 1)
+    The wavelengths of the pixels of each fiber and the positions of the
+    new pixels are computed once, and reused for every resampled image.
+    Only the interpolation of the accumulated flux depends on the image.
 
-    # 0-based index
-    new_x = numpy.arange(npix)
-    new_wl,  = subwcs.all_pix2world(new_x, 0)
+    Parameters
+    ----------
+    solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
+        A wavelength calibration solution, or the result of its `prepare`
+    npix: int
+        Number of channels of the calibrated RSS
+    finalwcs: astropy.wcs.WCS
+        WCS solution of the final array
+    shape: tuple
+        Shape of the RSS images, not WL calibrated
+    span: int
+        Remove `span` pixels at both sides of the resampled image
+    fill: int
+        Value used to fill the values removed by `span`
 
-    # 0-based left borders
-    old_x_borders_0 = numpy.arange(-0.5, nsamples)
-    # 1-based left borders
-    old_x_borders_1 = old_x_borders_0 + 1.0  # following FITS criterium
+    Attributes
+    ----------
+    limits: a list of tuples
+        Contains the fiberid and a pair with the first and last valid pixel (0-based)
+    """
+    def __init__(self, solutionwl, npix, finalwcs, shape, span=0, fill=0):
+        self.shape = tuple(shape)
+        self.npix = npix
+        self.span = span
+        self.fill = fill
+        self.limits = []
 
-    # In AA
-    new_wl_borders = pixel_borders(new_wl)
+        nsamples = self.shape[1]
 
-    accum_flux = numpy.empty((nfibers, nsamples + 1))
-    accum_flux[:, 1:] = numpy.cumsum(arr, axis=1)
-    accum_flux[:, 0] = 0.0
-    rss_resampled = numpy.zeros((nfibers, npix))
-    limits = []
+        # Use only the spectral axis
+        subwcs = finalwcs.sub(['spectral'])
 
-    for fibsol in solutionwl.contents:
+        # 0-based index
+        new_x = numpy.arange(npix)
+        new_wl,  = subwcs.all_pix2world(new_x, 0)
 
-        fibid = fibsol.fibid
-        idx = fibid - 1
+        # 0-based left borders
+        old_x_borders_0 = numpy.arange(-0.5, nsamples)
+        # 1-based left borders
+        old_x_borders_1 = old_x_borders_0 + 1.0  # following FITS criterium
 
-        # small correction defined in master_wlcalib_XXX_XX-X.json
-        coeff = fibsol.solution.coeff
-        offset_wavelength = solutionwl.global_offset(fibid)
-        coeff[0] -= offset_wavelength
+        # In AA
+        new_wl_borders = pixel_borders(new_wl)
 
-        # Polynomial returns AA
-        old_wl_borders = polyval(old_x_borders_1, coeff)
-        # 0-based, AA
-        ss_vals, = subwcs.all_world2pix(old_wl_borders[[0, -1]], 0)
-        # s1 is the 0-based pixel that contains the lower limit
-        # s2 is the 0-based pixel that contains the upper limit
-        s1, s2 = ss_vals
-        s1 = utils.coor_to_pix_1d(s1)
-        s2 = utils.coor_to_pix_1d(s2)
-        lower = max(0, min(s1, npix - 1))
-        upper = max(0, min(s2, npix - 1))
-
-        if lower > upper:
-            warnings.warn('lower limit is > upper limit', RuntimeWarning)
-
-        # We need a monotonic interpolator
-        # linear would work, we use a cubic interpolator
-        interpolator = SteffenInterpolator(
-            old_wl_borders,
-            accum_flux[idx],
-            extrapolate='border'
-        )
+        self._bounds = []
+        self._chunks = []
+
+        # The solution is not modified
+        prepared = solutionwl.prepare()
+        fibids = prepared.fibids
+        all_coeff = prepared.coeff
 
-        if lower + span > upper - span:
-            warnings.warn('lower limit + span is > upper limit - span', RuntimeWarning)
+        if len(fibids) == 0:
+            return
 
-        fl_borders = interpolator(new_wl_borders)
-        rss_resampled[idx] = fl_borders[1:] - fl_borders[:-1]
-        # Expand the border to remove `span` pixels
-        # in both sides, to avoid high variance
-        rss_resampled[idx, lower:lower + span] = fill
-        rss_resampled[idx, upper + 1 - span:upper + 1] = fill
-        limits.append((fibid, (lower + span, upper - span)))
+        # Polynomial returns AA, limits of all the fibers
+        old_wl_limits = polyval(old_x_borders_1[[0, -1]], all_coeff)
 
-    return rss_resampled, limits
+        # 0-based, AA
+        ss_vals, = subwcs.all_world2pix(old_wl_limits.ravel(), 0)
+        ss_vals = ss_vals.reshape((-1, 2))
+
+        for fibid, (s1, s2) in zip(fibids.tolist(), ss_vals):
+            # s1 is the 0-based pixel that contains the lower limit
+            # s2 is the 0-based pixel that contains the upper limit
+            s1 = utils.coor_to_pix_1d(s1)
+            s2 = utils.coor_to_pix_1d(s2)
+            lower = max(0, min(s1, npix - 1))
+            upper = max(0, min(s2, npix - 1))
+
+            if lower > upper:
+                warnings.warn('lower limit is > upper limit', RuntimeWarning)
+
+            if lower + span > upper - span:
+                warnings.warn('lower limit + span is > upper limit - span', RuntimeWarning)
+
+            self._bounds.append((fibid - 1, lower, upper))
+            self.limits.append((fibid, (lower + span, upper - span)))
+
+        rows = fibids - 1
+        for chunk in range(0, len(rows), RESAMPLE_CHUNK):
+            sl = slice(chunk, chunk + RESAMPLE_CHUNK)
+            # Polynomial returns AA
+            old_wl_borders = polyval(old_x_borders_1, all_coeff[:, sl])
+            grid = _SteffenGrid(old_wl_borders, new_wl_borders)
+            self._chunks.append((rows[sl], grid))
+
+    def __call__(self, arr, dtype='float64'):
+        """Resample the RSS array arr"""
+        if arr.shape != self.shape:
+            raise ValueError(f'shape of array {arr.shape} does not match {self.shape}')
+
+        rss_resampled = numpy.zeros((self.shape[0], self.npix), dtype=dtype)
+        for rows, grid in self._chunks:
+            accum_flux = numpy.zeros((len(rows), self.shape[1] + 1))
+            numpy.cumsum(arr[rows], axis=1, out=accum_flux[:, 1:])
+            # We need a monotonic interpolator
+            # linear would work, we use a cubic interpolator
+            fl_borders = grid.interpolate(accum_flux)
+            rss_resampled[rows] = fl_borders[:, 1:] - fl_borders[:, :-1]
+
+        span = self.span
+        for idx, lower, upper in self._bounds:
+            # Expand the border to remove `span` pixels
+            # in both sides, to avoid high variance
+            rss_resampled[idx, lower:lower + span] = self.fill
+            rss_resampled[idx, upper + 1 - span:upper + 1] = self.fill
+
+        return rss_resampled
+
+    def wlmap(self):
+        """Map of the pixels with spectral coverage (WLMAP)"""
+        # dtype here can be int16 or uint8
+        map_data = numpy.zeros((self.shape[0], self.npix), dtype='int16')
+        for fibid, (lower, upper) in self.limits:
+            map_data[fibid - 1, lower:upper + 1] = 1
+        return map_data
+
+
+def steffen_interpolate(x, y, x_new):
+    """Monotonic cubic interpolation of several functions in the same points.
+
+    Equivalent to evaluating
+    ``SteffenInterpolator(x[i], y[i], extrapolate='border')(x_new)``
+    for each row i, with all the rows computed at once.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        2D array, each row is sorted monotonically increasing
+    y : numpy.ndarray
+        2D array, with the same shape as `x`
+    x_new : numpy.ndarray
+        1D array, sorted monotonically increasing
+
+    Returns
+    -------
+    numpy.ndarray
+        2D array, with shape (x.shape[0], len(x_new))
+    """
+    return _SteffenGrid(x, x_new).interpolate(y)
+
+
+class _SteffenGrid(object):
+    """Part of steffen_interpolate that does not depend on the values"""
+    def __init__(self, x, x_new):
+        nrows, nvals = x.shape
+        rowidx = numpy.arange(nrows)[:, numpy.newaxis]
+        # Steps, the last one repeated
+        h = numpy.empty_like(x)
+        h[:, :-1] = x[:, 1:] - x[:, :-1]
+        h[:, -1] = h[:, -2]
+        self.h = h
+        self.hsum = h[:, 1:-1] + h[:, :-2]
+
+        # Segment of each new point. The old points are located
+        # among the new ones, as these are common to all rows
+        nnew = len(x_new)
+        pos = _locate_sorted(x_new, x)
+        pos += (nnew + 1) * rowidx
+        # number of old points <= each new point
+        count = numpy.bincount(pos.ravel(), minlength=nrows * (nnew + 1))
+        count = count.reshape((nrows, nnew + 1))[:, :-1].cumsum(axis=1)
+        # Outside the range, the value in the border
+        outside = (count == 0) | (count == nvals)
+        ids = count
+        ids -= 1
+        numpy.clip(ids, 0, nvals - 1, out=ids)
+        ids += nvals * rowidx
+        # Flat indices of the segment
+        self.ids = ids
+        # Flat indices of the derivatives, with one more column
+        self.ids_yp = ids + rowidx
+        self.h_i = h.take(ids)
+        # Position inside the segment, in units of the step
+        self.t = x_new - x.take(ids)
+        self.t /= self.h_i
+        self.t[outside] = 0.0
+
+    def interpolate(self, y):
+        """Interpolate the values y, with the shape of x"""
+        nrows, nvals = y.shape
+        h = self.h
+        # Secants, zero after the last point
+        s = numpy.zeros_like(y)
+        numpy.subtract(y[:, 1:], y[:, :-1], out=s[:, :-1])
+        s[:, :-1] /= h[:, :-1]
+        # Derivatives in the points, zero in the borders
+        yp = numpy.zeros((nrows, nvals + 1))
+        inner = yp[:, 1:-2]
+        s0 = s[:, :-2]
+        s1 = s[:, 1:-1]
+        # Parabolic derivative
+        p = s0 * h[:, 1:-1]
+        p += s1 * h[:, :-2]
+        p /= self.hsum
+        numpy.abs(p, out=p)
+        p *= 0.5
+        numpy.minimum(numpy.abs(s0), numpy.abs(s1), out=inner)
+        numpy.minimum(inner, p, out=inner)
+        sign = numpy.sign(s0)
+        sign += numpy.sign(s1)
+        inner *= sign
+
+        t = self.t
+        s_i = s.take(self.ids)
+        yp0 = yp.take(self.ids_yp)
+        yp1 = yp.take(self.ids_yp + 1)
+        # Cubic polynomial in the segment
+        # y0 + h (yp0 t + (3 s - 2 yp0 - yp1) t^2 + (yp0 + yp1 - 2 s) t^3)
+        result = yp0 + yp1
+        result -= 2 * s_i
+        s_i -= yp0
+        s_i -= result
+        result *= t
+        result += s_i
+        result *= t
+        result += yp0
+        result *= t
+        result *= self.h_i
+        result += y.take(self.ids)
+        return result
+
+
+def _locate_sorted(grid, values):
+    """Equivalent to numpy.searchsorted(grid, values, side='left')
+
+    If the sorted array `grid` is uniform, the positions are computed
+    directly, without searching.
+    """
+    ngrid = len(grid)
+    step = (grid[-1] - grid[0]) / (ngrid - 1)
+    if ngrid < 3 or not numpy.allclose(numpy.diff(grid), step, rtol=1e-6, atol=0):
+        return numpy.searchsorted(grid, values, side='left')
+    coor = (values - grid[0]) / step
+    pos = numpy.ceil(coor)
+    numpy.clip(pos, 0, ngrid, out=pos)
+    pos = pos.astype('int')
+    # Values too close to the grid are affected by rounding errors
+    near = numpy.abs(coor - numpy.rint(coor)) < 1e-6
+    if near.any():
+        pos[near] = numpy.searchsorted(grid, values[near], side='left')
+    return pos
 
 
 def pixel_borders(arr):
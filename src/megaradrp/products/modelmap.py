@@ -9,16 +9,23 @@
 
 """Products of the Megara Pipeline"""
 
+import logging
+
 import numpy
 import numpy.polynomial.polynomial as nppol
 
 from numina.util.convertfunc import json_serial_function, convert_function
 
+import megaradrp.core.cache
+import megaradrp.core.parallel as parallel
 from .structured import BaseStructuredCalibration
 from .aperture import GeometricAperture
 from .traces import to_ds9_reg as to_ds9_reg_function
 
 
+_logger = logging.getLogger(__name__)
+
+
 class GeometricModel(GeometricAperture):
     def __init__(self, fibid, boxid, start, stop, model):
         super(GeometricModel, self).__init__(fibid, boxid, start, stop)
@@ -78,6 +85,8 @@ class ModelMap(BaseStructuredCalibration):
         self.global_offset = nppol.Polynomial([0.0])
         self.ref_column = 2000
         self._wcols = None
+        self._wcols_key = None
+        self._executor = None
 
     def __getstate__(self):
         st = super(ModelMap, self).__getstate__()
@@ -99,15 +108,76 @@ class ModelMap(BaseStructuredCalibration):
         self.global_offset = nppol.Polynomial(state.get('global_offset', [0.0]))
         self.ref_column = state.get('ref_column', 2000)
         self._wcols = None
-
-    def calculate_matrices(self, shape, processes=0):
-        if self._wcols is None:
-            self._wcols = calc_matrix_cols(self, shape, processes)
-
-    def aper_extract(self, img, processes=0):
-        if self._wcols is None:
-            self._wcols = calc_matrix_cols(self, img.shape, processes)
-        return aper_extract(self, self._wcols, img)
+        self._wcols_key = None
+        self._executor = None
+
+    def weights_key(self, shape):
+        """Key of the weight matrices for images of this shape"""
+        return megaradrp.core.cache.ArrayCache.key(
+            'modelmap', self.uuid, tuple(shape),
+            self.ref_column, self.global_offset.coef
+        )
+
+    def calculate_matrices(self, shape, processes=0, cache=None):
+        """Compute the weight matrices used in the extraction.
+
+        The matrices are reused while the shape of the image and the
+        `global_offset` do not change. If a cache is provided (or
+        configured with MEGARADRP_CACHE_DIR) the matrices are loaded from
+        it, or stored in it after being computed.
+
+        With `processes` >= 2, the matrices are computed, and later
+        used, by a pool of processes sharing them in shared memory.
+        The pool is reused for every extraction until `close` is called.
+        """
+        executor = self._get_executor(processes)
+
+        key = self.weights_key(shape)
+        if self._wcols is not None and self._wcols_key == key:
+            if executor is not None:
+                self._wcols.share(executor)
+            return
+
+        if cache is None:
+            cache = megaradrp.core.cache.default_cache()
+
+        wcols = None
+        if cache is not None:
+            arrays = cache.load(key)
+            if arrays is not None:
+                wcols = BandedWeights.from_arrays(arrays)
+
+        if wcols is None:
+            wcols = calc_banded_weights(self, shape, executor=executor)
+            wcols.factorize(executor=executor)
+            if cache is not None:
+                cache.store(key, wcols.to_arrays())
+        elif executor is not None:
+            wcols.share(executor)
+
+        self._wcols = wcols
+        self._wcols_key = key
+
+    def aper_extract(self, img, processes=0, cache=None):
+        self.calculate_matrices(img.shape, processes, cache=cache)
+        return self._wcols.extract(img, executor=self._get_executor(processes))
+
+    def _get_executor(self, processes):
+        if processes < 2:
+            return None
+        if not parallel.is_available():
+            _logger.warning('shared memory not available, using 1 process')
+            return None
+        if self._executor is None or self._executor.processes != processes:
+            self.close()
+            self._executor = parallel.SharedExecutor(processes)
+        return self._executor
+
+    def close(self):
+        """Stop the pool of processes used in the extraction, if any"""
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
 
     def to_ds9_reg(self, ds9reg, rawimage=False, numpix=100, fibid_at=0):
         """Transform fiber traces to ds9-region format.
@@ -134,52 +204,51 @@ class ModelMap(BaseStructuredCalibration):
 
 
 # BUILD MATRICES
-def calc_matrix(g_mean, g_std, valid, wshape, clip=1.0e-6, extra=10):
-    from scipy.sparse import lil_matrix
-    from numina.modeling.gaussbox import gauss_box_model
-    # calc w
-    # this is valid for 1 column (there are more broadcasts for N)
+def calc_profiles(g_mean, g_std, clip=1.0e-6, extra=10):
+    """Sample the fiber profiles in one column.
+
+    Returns the first row of each sampled profile and an array
+    of shape (2 * extra, nfibs) with the values of the profiles.
+
+    The profile is the Gaussian integrated in each pixel, as in
+    :func:`numina.modeling.gaussbox.gauss_box_model`. Consecutive
+    pixels share their borders, so the cumulative distribution is
+    evaluated only once per border.
+
+    `g_mean` and `g_std` can have more dimensions, with the fibers
+    in the last axis and a length one axis in the second to last
+    axis, to sample several columns at once.
+    """
+    from scipy.special import ndtr
 
     begpix = numpy.ceil(g_mean - 0.5).astype('int')
 
-    steps = numpy.arange(-extra, extra)
-    # ref is a bidimensional matrix +-10 pixels around the trace
+    steps = numpy.arange(-extra, extra + 1) - 0.5
+    # borders of the pixels +-10 pixels around the trace
     ref = begpix + steps[:, numpy.newaxis]
 
-    rr = gauss_box_model(ref, mean=g_mean, stddev=g_std)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        cdf = ndtr((ref - g_mean) / g_std)
+    rr = numpy.diff(cdf, axis=-2)
     rrb = begpix - extra
 
     # This was sending warnings. Is there a NaN somewhere?
     with numpy.errstate(invalid='ignore'):
         rr[rr < clip] = 0.0
 
-    # Calc Ws matrix
-    block, valid_nfib = rr.shape
-
-    w_init = lil_matrix(wshape)
-    for fibid in valid:
-        idx = fibid - 1
-        w_init[rrb[idx]:rrb[idx] + block, idx] = rr[:, idx, numpy.newaxis]
-
-    wcol = w_init.tocsr()
-    return wcol
-
+    return rrb, rr
 
-def calc_matrix_alt(g_mean, g_std, col, valid, wshape, clip=1.0e-6, extra=10):
 
-    # For parallel processing
-    wcol = calc_matrix(g_mean, g_std, valid, wshape, clip=clip, extra=extra)
-
-    return col, wcol
-
-
-def calc_matrix_cols(model_map, datashape, processes=0):
+def calc_model_arrays(model_map, datashape):
+    """Evaluate the center and width of the profiles in every column.
 
+    The center of the profiles is shifted using the `global_offset`
+    of `model_map`. Invalid fibers have zero center and width.
+    """
     dnrow, dncol = datashape
     nfibs = model_map.total_fibers
 
     shape = (nfibs, dncol)
-    wshape = (dnrow, nfibs)
 
     array_mean = numpy.zeros(shape)
     array_std = numpy.zeros(shape)
@@ -200,40 +269,301 @@ def calc_matrix_cols(model_map, datashape, processes=0):
     mean_at_ref = array_mean[mask, model_map.ref_column]
     offset = model_map.global_offset(mean_at_ref)
     array_mean[mask, :] = array_mean[mask, :] + offset[:, numpy.newaxis]
+    return array_mean, array_std
 
-    wcols = {}
-    valid = [f.fibid for f in model_map.contents if f.valid]
-    if processes < 2:
-        for col in xcol:
-            result = calc_matrix(array_mean[:, col], array_std[:, col],
-                                 valid, wshape, clip=1e-6, extra=10)
-            wcols[col] = result
-    else:
-        import multiprocessing as mp
-        pool = mp.Pool(processes=processes)
 
-        results = [pool.apply_async(
-            calc_matrix_alt,
-            args=(array_mean[:, col], array_std[:, col], col, valid, wshape),
-            kwds={'clip': 1e-6, 'extra': 10}
-        ) for col in xcol]
+def calc_matrix_cols(model_map, datashape, processes=0):
+    """Compute the weight matrices of all the columns in CSR format.
 
-        for p in results:
-            col, wcol = p.get()
-            wcols[col] = wcol
+    The matrices are assembled from the banded weights.
+    `processes` is kept for compatibility.
+    """
+    wcols = calc_banded_weights(model_map, datashape)
+    return {col: wcols.column_matrix(col) for col in range(datashape[1])}
 
-    return wcols
 
+def calc_banded_weights(model_map, datashape, clip=1.0e-6, extra=10, chunk=256,
+                        executor=None):
+    """Compute the weight matrices of all the columns in banded form.
 
-def aper_extract(model_map, wcols, img):
-    from scipy.sparse.linalg import lsqr
+    The profiles are evaluated for all the fibers in blocks of
+    `chunk` columns at once. If `executor` is a
+    :class:`megaradrp.core.parallel.SharedExecutor`, the blocks are
+    distributed among its processes, and the result is stored
+    in shared memory.
+    """
+    dnrow, dncol = datashape
 
-    n0 = model_map.total_fibers
-    n1 = img.shape[1]
-    rss = numpy.zeros((n0, n1))
-    for key, val in wcols.items():
-        yl = img[:, key]
-        res = lsqr(val, yl)
-        rss[:, key] = res[0]
+    array_mean, array_std = calc_model_arrays(model_map, datashape)
+    valid_r = numpy.array([f.fibid - 1 for f in model_map.contents if f.valid], dtype='int')
+    # Sort the fibers by position, so that neighbours are contiguous
+    sort_r = numpy.argsort(array_mean[valid_r].mean(axis=1), kind='stable')
+    order_r = valid_r[sort_r]
+    # Fibers in the last axis
+    array_mean = array_mean[order_r].T
+    array_std = array_std[order_r].T
+
+    rshape = (dncol, len(order_r))
+    pshape = (dncol, 2 * extra, len(order_r))
+    if executor is None:
+        arrays = dict(
+            mean=array_mean, std=array_std,
+            rows=numpy.empty(rshape, dtype='int32'),
+            profiles=numpy.empty(pshape)
+        )
+        for start in range(0, dncol, chunk):
+            sl = slice(start, min(start + chunk, dncol))
+            _profiles_worker(arrays, sl, dnrow, clip, extra)
+    else:
+        executor.share('mean', array_mean)
+        executor.share('std', array_std)
+        arrays = dict(
+            rows=executor.array('rows', rshape, dtype='int32'),
+            profiles=executor.array('profiles', pshape)
+        )
+        tasks = [(sl, dnrow, clip, extra) for sl in _column_chunks(executor, dncol, chunk)]
+        executor.run(_profiles_worker, tasks)
+        executor.release('mean')
+        executor.release('std')
+
+    return BandedWeights(arrays['rows'], arrays['profiles'], order_r + 1,
+                         datashape, model_map.total_fibers)
+
+
+def _column_chunks(executor, ncols, chunk):
+    # Contiguous blocks of columns, at least one per process
+    nchunks = max(executor.processes, -(-ncols // chunk))
+    return parallel.chunk_slices(ncols, nchunks)
+
+
+def _profiles_worker(arrays, sl, nrow, clip, extra):
+    # shape (ncols, 1, nfibs), broadcast to (ncols, 2 * extra, nfibs)
+    g_mean = arrays['mean'][sl, numpy.newaxis, :]
+    g_std = arrays['std'][sl, numpy.newaxis, :]
+    rrb, rr = calc_profiles(g_mean, g_std, clip=clip, extra=extra)
+    # Only pixels inside the image have weights
+    if rrb.min() < 0 or rrb.max() + 2 * extra > nrow:
+        steps = numpy.arange(2 * extra)[:, numpy.newaxis]
+        rr[(rrb + steps < 0) | (rrb + steps >= nrow)] = 0.0
+    arrays['rows'][sl] = rrb[:, 0, :]
+    arrays['profiles'][sl] = rr
+
+
+def _factorize_worker(arrays, sl, bandwidth):
+    from scipy.linalg import cholesky_banded
+
+    normal = calc_normal_band(arrays['rows'][sl], arrays['profiles'][sl], bandwidth)
+    factors = arrays['factors']
+    for col, ab in enumerate(normal, sl.start):
+        factors[col] = cholesky_banded(ab, lower=False)
+
+
+def _extract_worker(arrays, sl, fibrows):
+    from scipy.linalg import cho_solve_banded
+
+    img = arrays['image']
+    factors = arrays['factors']
+    rss = arrays['rss']
+    rhs = calc_normal_rhs(img[:, sl], arrays['rows'][sl], arrays['profiles'][sl])
+    for col, b in enumerate(rhs, sl.start):
+        rss[fibrows, col] = cho_solve_banded(
+            (factors[col], False), b, check_finite=False
+        )
+
+
+class BandedWeights(object):
+    """Weight matrices of all the columns of an image, in banded form.
+
+    The weight matrix of column `col` has the sampled profile of the
+    fiber `fibids[idx]` between rows ``rows[col, idx]`` and
+    ``rows[col, idx] + nband``, and zeros elsewhere. Only valid fibers
+    are stored, sorted by their position in the image.
+
+    The extraction of a column is the least squares solution of the system
+    ``W x = y``. As each fiber only overlaps its neighbours, the normal
+    matrix ``W^T W`` is banded. It is factorized once per column and
+    reused for every image.
+
+    Parameters
+    ----------
+    rows : numpy.ndarray
+        First row of each profile, shape (ncols, nvalid)
+    profiles : numpy.ndarray
+        Values of the profiles, shape (ncols, nband, nvalid). Pixels
+        outside the image must have zero weight.
+    fibids : numpy.ndarray
+        Fibid of each profile, sorted by position
+    shape : tuple
+        Shape of the images to be extracted
+    nfibers : int
+        Total number of fibers
+
+    """
+    def __init__(self, rows, profiles, fibids, shape, nfibers):
+        self.shape = tuple(shape)
+        self.fibids = numpy.asarray(fibids)
+        self.nfibers = nfibers
+        self.rows = rows
+        self.profiles = profiles
+        self.factors = None
+
+    def to_arrays(self):
+        """Return the contents as a dictionary of arrays"""
+        if self.factors is None:
+            self.factorize()
+        return dict(
+            shape=numpy.array(self.shape),
+            nfibers=numpy.array(self.nfibers),
+            fibids=self.fibids,
+            rows=self.rows,
+            profiles=self.profiles,
+            factors=self.factors
+        )
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Create an object from the output of to_arrays"""
+        obj = cls(
+            arrays['rows'], arrays['profiles'], arrays['fibids'],
+            arrays['shape'].tolist(), int(arrays['nfibers'])
+        )
+        obj.factors = arrays['factors']
+        return obj
 
-    return rss
\ No newline at end of file
+    @property
+    def nband(self):
+        return self.profiles.shape[1]
+
+    def _chunks(self, size=256):
+        ncols = self.profiles.shape[0]
+        for start in range(0, ncols, size):
+            yield slice(start, min(start + size, ncols))
+
+    def column_matrix(self, col):
+        """Weight matrix of column col, in CSR format"""
+        from scipy.sparse import csc_matrix
+
+        nvalid = len(self.fibids)
+        nrow = self.shape[0]
+        # Each fiber is a column of the matrix with nband elements
+        data = self.profiles[col].T.ravel()
+        indices = self.rows[col][:, numpy.newaxis] + numpy.arange(self.nband)
+        indices = numpy.clip(indices, 0, nrow - 1).ravel()
+        indptr = numpy.zeros((self.nfibers + 1,), dtype='int')
+        counts = numpy.zeros((self.nfibers,), dtype='int')
+        counts[self.fibids - 1] = self.nband
+        numpy.cumsum(counts, out=indptr[1:])
+        # data in order of fibid
+        perm = numpy.argsort(self.fibids)
+        data = data.reshape((nvalid, -1))[perm].ravel()
+        indices = indices.reshape((nvalid, -1))[perm].ravel()
+        wcol = csc_matrix((data, indices, indptr), shape=(nrow, self.nfibers))
+        wcol.eliminate_zeros()
+        return wcol.tocsr()
+
+    def _arrays(self):
+        return dict(rows=self.rows, profiles=self.profiles, factors=self.factors)
+
+    def share(self, executor):
+        """Move the arrays to the shared memory of executor"""
+        for name, value in self._arrays().items():
+            if value is not None:
+                setattr(self, name, executor.share(name, value))
+
+    def factorize(self, executor=None):
+        """Compute the Cholesky factors of the normal matrices"""
+        bandwidth = calc_bandwidth(self.rows, self.nband)
+        ncols, _, nvalid = self.profiles.shape
+        fshape = (ncols, bandwidth + 1, nvalid)
+        if executor is None:
+            self.factors = numpy.empty(fshape)
+            arrays = self._arrays()
+            for sl in self._chunks():
+                _factorize_worker(arrays, sl, bandwidth)
+        else:
+            self.share(executor)
+            self.factors = executor.array('factors', fshape)
+            tasks = [(sl, bandwidth) for sl in _column_chunks(executor, ncols, 256)]
+            executor.run(_factorize_worker, tasks)
+
+    def extract(self, img, executor=None):
+        """Extract the flux of the fibers in img"""
+        if self.factors is None:
+            self.factorize(executor=executor)
+
+        if img.shape != self.shape:
+            raise ValueError(f'image shape {img.shape} != {self.shape}')
+
+        rss_shape = (self.nfibers, self.shape[1])
+        fibrows = self.fibids - 1
+        if executor is None:
+            arrays = self._arrays()
+            arrays['image'] = img
+            arrays['rss'] = numpy.zeros(rss_shape)
+            for sl in self._chunks():
+                _extract_worker(arrays, sl, fibrows)
+            return arrays['rss']
+        else:
+            self.share(executor)
+            executor.share('image', img)
+            rss = executor.array('rss', rss_shape)
+            rss[...] = 0.0
+            tasks = [(sl, fibrows) for sl in _column_chunks(executor, self.shape[1], 256)]
+            executor.run(_extract_worker, tasks)
+            return rss.copy()
+
+
+def calc_bandwidth(rows, nband):
+    """Number of neighbours of each fiber with overlapping profiles."""
+    nfib = rows.shape[1]
+    for dist in range(1, nfib):
+        shift = rows[:, dist:] - rows[:, :nfib - dist]
+        if numpy.all(numpy.abs(shift) >= nband):
+            return dist - 1
+    return nfib - 1
+
+
+def calc_normal_band(rows, profiles, bandwidth):
+    """Compute the normal matrices W^T W in upper banded form.
+
+    Returns an array of shape (ncols, bandwidth + 1, nfibs), with the
+    layout required by :func:`scipy.linalg.cholesky_banded`.
+    """
+    ncols, nband, nfib = profiles.shape
+
+    normal = numpy.zeros((ncols, bandwidth + 1, nfib))
+    normal[:, bandwidth, :] = numpy.einsum('ijk,ijk->ik', profiles, profiles)
+    for dist in range(1, bandwidth + 1):
+        lprof = profiles[:, :, :nfib - dist]
+        rprof = profiles[:, :, dist:]
+        # row k of the profile of i is row k - shift of the profile of j
+        # shift only takes a few different values for each distance
+        shift = rows[:, dist:] - rows[:, :nfib - dist]
+        diag = normal[:, bandwidth - dist, dist:]
+        for lag in numpy.unique(shift):
+            if abs(lag) >= nband:
+                continue
+            if lag >= 0:
+                prod = numpy.einsum('ijk,ijk->ik', lprof[:, lag:], rprof[:, :nband - lag])
+            else:
+                prod = numpy.einsum('ijk,ijk->ik', lprof[:, :nband + lag], rprof[:, -lag:])
+            mask = shift == lag
+            diag[mask] = prod[mask]
+
+    # Fibers without weights in a column have zero flux
+    main = normal[:, bandwidth, :]
+    main[main <= 0] = 1.0
+    return normal
+
+
+def calc_normal_rhs(img, rows, profiles):
+    """Compute the right hand sides W^T y for all the columns of img."""
+    ncols, nband, _ = profiles.shape
+    nrow = img.shape[0]
+    idx = rows[:, numpy.newaxis, :] + numpy.arange(nband)[:, numpy.newaxis]
+    numpy.clip(idx, 0, nrow - 1, out=idx)
+    idx = idx.reshape((ncols, -1))
+    # Gather along contiguous columns
+    vals = numpy.take_along_axis(numpy.ascontiguousarray(img.T), idx, axis=1)
+    vals = vals.reshape((ncols, nband, -1))
+    return numpy.einsum('ijk,ijk->ik', vals, profiles)
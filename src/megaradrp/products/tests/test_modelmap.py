@@ -0,0 +1,165 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+import numpy
+import numpy.polynomial.polynomial as nppol
+from numina.modeling.gaussbox import gauss_box_model
+
+import megaradrp.products.modelmap as mm
+
+
+def create_test_modelmap(nfibers=40, ncols=60, missing=(5,)):
+    data = mm.ModelMap(instrument='TEST1')
+    data.uuid = '123456789'
+    data.total_fibers = nfibers
+    data.ref_column = ncols // 2
+    data.missing_fibers = list(missing)
+    for fibid in range(1, nfibers + 1):
+        if fibid in missing:
+            model = {}
+        else:
+            params = {
+                'mean': nppol.Polynomial([12 + 6.5 * fibid, 0.01]),
+                'stddev': nppol.Polynomial([1.5 + 0.002 * fibid])
+            }
+            model = {'model_name': 'gaussbox', 'params': params}
+        data.contents.append(mm.GeometricModel(fibid, 1, 1, ncols, model))
+    return data
+
+
+def create_test_image(model_map, shape, amplitude):
+    xcol = numpy.arange(shape[1])
+    yrow = numpy.arange(shape[0])[:, numpy.newaxis]
+    img = numpy.zeros(shape)
+    for aper in model_map.contents:
+        if aper.valid:
+            params = aper.model['params']
+            img += amplitude[aper.fibid - 1] * gauss_box_model(
+                yrow, mean=params['mean'](xcol), stddev=params['stddev'](xcol)
+            )
+    return img
+
+
+def calc_matrix(g_mean, g_std, valid, wshape, clip=1.0e-6, extra=10):
+    # Reference implementation, the weights of one column in a lil matrix
+    from scipy.sparse import lil_matrix
+
+    rrb, rr = mm.calc_profiles(g_mean, g_std, clip=clip, extra=extra)
+    block = rr.shape[0]
+    w_init = lil_matrix(wshape)
+    for fibid in valid:
+        idx = fibid - 1
+        w_init[rrb[idx]:rrb[idx] + block, idx] = rr[:, idx, numpy.newaxis]
+    return w_init.tocsr()
+
+
+def calc_matrix_lil(model_map, shape):
+    array_mean, array_std = mm.calc_model_arrays(model_map, shape)
+    valid = [f.fibid for f in model_map.contents if f.valid]
+    wshape = (shape[0], model_map.total_fibers)
+    wcols = {}
+    for col in range(shape[1]):
+        wcols[col] = calc_matrix(array_mean[:, col], array_std[:, col],
+                                 valid, wshape)
+    return wcols
+
+
+def aper_extract_lsqr(model_map, wcols, img):
+    # Reference implementation, one least squares problem per column
+    from scipy.sparse.linalg import lsqr
+
+    rss = numpy.zeros((model_map.total_fibers, img.shape[1]))
+    for col, wcol in wcols.items():
+        rss[:, col] = lsqr(wcol, img[:, col])[0]
+    return rss
+
+
+def test_calc_matrix_cols():
+    shape = (300, 60)
+    model_map = create_test_modelmap(ncols=shape[1])
+    wcols_lil = calc_matrix_lil(model_map, shape)
+    wcols = mm.calc_matrix_cols(model_map, shape)
+    assert set(wcols) == set(wcols_lil)
+    for col, wcol in wcols.items():
+        assert wcol.shape == wcols_lil[col].shape
+        assert numpy.allclose(wcol.toarray(), wcols_lil[col].toarray(),
+                              rtol=1e-12, atol=1e-15)
+
+
+def test_banded_extract_lsqr():
+    shape = (300, 60)
+    model_map = create_test_modelmap(ncols=shape[1])
+    rng = numpy.random.default_rng(2345)
+    amplitude = rng.uniform(100, 1000, size=model_map.total_fibers)
+    img = create_test_image(model_map, shape, amplitude)
+    img += rng.normal(0, 1.0, size=shape)
+
+    wcols = calc_matrix_lil(model_map, shape)
+    rss_lsqr = aper_extract_lsqr(model_map, wcols, img)
+    rss = model_map.aper_extract(img)
+
+    assert rss.shape == (model_map.total_fibers, shape[1])
+    assert numpy.allclose(rss, rss_lsqr, rtol=1e-5, atol=1e-3)
+    assert numpy.all(rss[4] == 0)
+
+
+def test_banded_extract_reuse():
+    shape = (300, 60)
+    model_map = create_test_modelmap(ncols=shape[1])
+    amplitude = numpy.linspace(100, 200, model_map.total_fibers)
+    img = create_test_image(model_map, shape, amplitude)
+
+    rss1 = model_map.aper_extract(img)
+    rss2 = model_map.aper_extract(2 * img)
+
+    expected = numpy.where(numpy.arange(model_map.total_fibers) == 4, 0, amplitude)
+    assert numpy.allclose(rss1, expected[:, numpy.newaxis], rtol=1e-4)
+    assert numpy.allclose(rss2, 2 * rss1)
+
+
+def test_banded_extract_cache(tmpdir):
+    from megaradrp.core.cache import ArrayCache
+
+    shape = (300, 60)
+    cache = ArrayCache(str(tmpdir))
+    model_map = create_test_modelmap(ncols=shape[1])
+    amplitude = numpy.linspace(100, 200, model_map.total_fibers)
+    img = create_test_image(model_map, shape, amplitude)
+    rss1 = model_map.aper_extract(img, cache=cache)
+    key = model_map.weights_key(shape)
+    assert cache.load(key) is not None
+
+    other = create_test_modelmap(ncols=shape[1])
+    rss2 = other.aper_extract(img, cache=cache)
+    assert isinstance(other._wcols.profiles, numpy.memmap)
+    assert numpy.allclose(rss1, rss2)
+
+    # A new offset requires new matrices
+    other.global_offset = nppol.Polynomial([0.5])
+    assert other.weights_key(shape) != key
+    other.aper_extract(img, cache=cache)
+    assert not isinstance(other._wcols.profiles, numpy.memmap)
+    assert len(cache.entries()) == 2
+
+
+def test_banded_extract_processes():
+    shape = (300, 60)
+    model_map = create_test_modelmap(ncols=shape[1])
+    amplitude = numpy.linspace(100, 200, model_map.total_fibers)
+    img = create_test_image(model_map, shape, amplitude)
+    rss1 = model_map.aper_extract(img)
+
+    other = create_test_modelmap(ncols=shape[1])
+    try:
+        rss2 = other.aper_extract(img, processes=2)
+        rss3 = other.aper_extract(2 * img, processes=2)
+    finally:
+        other.close()
+    assert numpy.allclose(rss1, rss2)
+    assert numpy.allclose(rss3, 2 * rss1)
@@ -216,6 +216,18 @@ def test_query_ds9(tmpdir):
     assert True
 
 
+def test_extraction_borders():
+    data = create_test_tracemap2()
+    fibids, borders = data.extraction_borders(4096)
+    assert len(fibids) == 623
+    assert borders.shape == (623, 2, 4096)
+    # Computed once
+    assert data.extraction_borders(4096)[1] is borders
+    data.global_offset = nppol.Polynomial([1.0])
+    _, borders2 = data.extraction_borders(4096)
+    assert numpy.allclose(borders2, borders + 1.0)
+
+
 if __name__ == "__main__":
     test_load_traceMap()
     test_dump_traceMap()
@@ -12,6 +12,9 @@ from tempfile import NamedTemporaryFile
 import pytest
 import json
 
+import numpy
+import numpy.polynomial.polynomial as nppol
+
 import numina.types.qc
 import numina.types.structured as structured
 from numina.array.wavecalib.arccalibration import SolutionArcCalibration, WavecalFeature, CrLinear
@@ -152,6 +155,27 @@ def test_dump_wavecalib():
     assert (traces == state)
 
 
+def test_prepare_wavecalib():
+    data, state = create_test_wavecalib()
+    data.global_offset = nppol.Polynomial([0.5, 0.01])
+    data.error_fitting = [4]
+    data.missing_fibers = [11]
+    prepared = data.prepare()
+
+    assert prepared.calibid == data.calibid
+    assert prepared.fibids.tolist() == list(range(1, 11)) + [101]
+    assert prepared.coeff.shape == (2, 11)
+    assert prepared.error_fitting == (4,)
+    assert prepared.missing_fibers == (11,)
+    assert numpy.allclose(prepared.coeff[0], 1.0 - 0.5 - 0.01 * prepared.fibids)
+    assert numpy.allclose(prepared.coeff[1], 0.1)
+    # the solution is not modified
+    assert all(fibsol.solution.coeff == orig['coeff'] for fibsol in data.contents)
+    with pytest.raises(ValueError):
+        prepared.coeff[0, 0] = 0.0
+    assert prepared.prepare() is prepared
+
+
 def test_query_fields():
     my_obj = megaradrp.products.WavelengthCalibration()
     assert my_obj.query_expr.fields() == {'insmode', 'vph'}
@@ -11,6 +11,7 @@
 
 import numpy.polynomial.polynomial as nppol
 
+import megaradrp.core.cache
 from megaradrp.datatype import MegaraDataType
 from .structured import BaseStructuredCalibration
 from .aperture import GeometricAperture
@@ -68,6 +69,8 @@ class TraceMap(BaseStructuredCalibration):
         self.global_offset = nppol.Polynomial([0.0])
         self.ref_column = 2000
         self.expected_range = [4, 4092]
+        self._borders = None
+        self._borders_key = None
         #
 
     def __getstate__(self):
@@ -87,8 +90,43 @@ class TraceMap(BaseStructuredCalibration):
         self.global_offset = nppol.Polynomial(state.get('global_offset', [0.0]))
         self.ref_column = state.get('ref_column', 2000)
         self.expected_range = state.get('expected_range', [4, 4092])
+        self._borders = None
+        self._borders_key = None
         return self
 
+    def borders_key(self, ncols):
+        """Key of the borders of the apertures for images with ncols columns"""
+        traces = [(t.fibid, t.boxid, t.fitparms) for t in self.contents]
+        return megaradrp.core.cache.ArrayCache.key(
+            'tracemap', ncols, self.ref_column, self.global_offset.coef, traces
+        )
+
+    def extraction_borders(self, ncols):
+        """Borders of the apertures used in simple extraction.
+
+        The borders are computed once, and reused while the traces
+        and the `global_offset` do not change.
+        See :func:`megaradrp.processing.aperture.calc_borders_tracemap`
+
+        Parameters
+        ----------
+        ncols : int
+            Number of columns of the image
+
+        Returns
+        -------
+        fibids : numpy.ndarray
+        borders : numpy.ndarray
+            Borders of the apertures, with shape (nfibers, 2, ncols)
+        """
+        from megaradrp.processing.aperture import calc_borders_tracemap
+
+        key = self.borders_key(ncols)
+        if self._borders is None or self._borders_key != key:
+            self._borders = calc_borders_tracemap(self, ncols)
+            self._borders_key = key
+        return self._borders
+
     def to_ds9_reg(self, ds9reg, rawimage=False, numpix=100, fibid_at=0):
         """Transform fiber traces to ds9-region format.
 
@@ -10,6 +10,7 @@
 """Products of the Megara Pipeline: Wavelength  Calibration"""
 
 
+import numpy
 from numina.array.wavecalib.arccalibration import SolutionArcCalibration
 import numpy.polynomial.polynomial as nppol
 
@@ -47,6 +48,20 @@ class WavelengthCalibration(BaseStructuredCalibration):
     def tag_names(self):
         return ['insmode', 'vph']
 
+    def prepare(self):
+        """Return the solutions with the global offset applied"""
+        fibids = [fibsol.fibid for fibsol in self.contents]
+        ncoeff = max((len(fibsol.solution.coeff) for fibsol in self.contents), default=1)
+        coeff = numpy.zeros((ncoeff, len(fibids)))
+        for idx, fibsol in enumerate(self.contents):
+            coeff[:len(fibsol.solution.coeff), idx] = fibsol.solution.coeff
+        # small correction defined in master_wlcalib_XXX_XX-X.json
+        coeff[0] -= self.global_offset(numpy.asarray(fibids, dtype='float'))
+        return PreparedWavelengthCalibration(
+            self.calibid, fibids, coeff, self.global_offset,
+            error_fitting=self.error_fitting, missing_fibers=self.missing_fibers
+        )
+
     def __getstate__(self):
         st = super(WavelengthCalibration, self).__getstate__()
 
@@ -70,3 +85,27 @@ class WavelengthCalibration(BaseStructuredCalibration):
             new = FiberSolutionArcCalibration.__new__(FiberSolutionArcCalibration)
             new.__setstate__(val)
             self.contents.append(new)
+
+
+class PreparedWavelengthCalibration(object):
+    """Wavelength solutions of the fibers, with the global offset applied.
+
+    The coefficients of the polynomials are stored in a read-only array
+    with shape (ncoeff, nfibers), padded with zeros. The object is not
+    modified after creation, so it can be shared between frames and threads.
+    The fibers in `error_fitting` and `missing_fibers` of the source
+    solution are kept, as tuples.
+    """
+    def __init__(self, calibid, fibids, coeff, global_offset,
+                 error_fitting=(), missing_fibers=()):
+        self.calibid = calibid
+        self.error_fitting = tuple(error_fitting)
+        self.missing_fibers = tuple(missing_fibers)
+        self.global_offset = nppol.Polynomial(global_offset.coef.copy())
+        self.fibids = numpy.array(fibids, dtype='int')
+        self.coeff = numpy.array(coeff, dtype='float')
+        self.fibids.setflags(write=False)
+        self.coeff.setflags(write=False)
+
+    def prepare(self):
+        return self
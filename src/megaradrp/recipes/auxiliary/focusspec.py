@@ -169,7 +169,8 @@ class FocusSpectrographRecipe(MegaraBaseRecipe):
                 )
 
                 self.save_intermediate_img(img, f'focus2d-{focus}.fits')
-                img1d = calibrator_aper(img)
+                with calibrator_aper:
+                    img1d = calibrator_aper(img)
                 self.save_intermediate_img(img1d, f'focus1d-{focus}.fits')
 
                 self.logger.info('find lines and compute FWHM')
@@ -165,7 +165,8 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
 
         flow2 = SerialFlow([splitter1, calibrator_aper, flipcor])
 
-        reduced_rss = flow2(img)
+        with calibrator_aper:
+            reduced_rss = flow2(img)
         self.save_intermediate_img(reduced_rss, 'reduced_rss.fits')
 
         reduced2d = splitter1.out
@@ -222,7 +222,8 @@ class FiberFlatRecipe(MegaraBaseRecipe):
 
         img = splitter1(img)
         flat2d = splitter1.out # Copy before extraction
-        img = calibrator_aper(img)
+        with calibrator_aper:
+            img = calibrator_aper(img)
         img = splitter2(img)
         rss_base = splitter2.out # Copy before el calibration
         self.logger.debug('Flip RSS left-rigtht, before WL calibration')
@@ -29,6 +29,7 @@ from megaradrp.instrument.focalplane import FocalPlaneConf
 from megaradrp.products.modelmap import ModelMap
 from megaradrp.products.modelmap import GeometricModel
 from megaradrp.processing.aperture import ApertureExtractor
+from megaradrp.processing.profilefit import fit_columns
 from megaradrp.ntypes import ProcessedImage, ProcessedRSS
 from megaradrp.processing.combine import basic_processing_with_combination
 from megaradrp.core.recipe import MegaraBaseRecipe
@@ -66,6 +67,24 @@ class ModelMapRecipe(MegaraBaseRecipe):
     cut in the image is fitted to a sum of fiber profiles, being the profile
     a gaussian convolved with a square.
 
+    With `fit_method` equal to 'banded' (the default), the profiles of all
+    the fibers in a column are fitted simultaneously, solving the sparse
+    banded normal equations of the problem. If `warm_start` is True, the
+    fit of each column is the initial value of the next one, the bounds
+    of the fit are always relative to the traces. With
+    `fit_method` equal to 'iterative', each fiber is fitted together with
+    its neighbours, iterating over the fibers in random order.
+
+    The columns are fitted every `column_step` pixels. With the 'banded'
+    method, if `refine_tolerance` is greater than 0 or `check_accuracy`
+    is True, the accuracy of the interpolation is measured by fitting the
+    columns halfway between the fitted ones, and comparing the fit with
+    the splines. If `refine_tolerance` is greater than 0, the columns
+    where the centers differ more than `refine_tolerance` pixels are
+    added to the fit, and the process is repeated in the neighbouring
+    intervals. The centers and widths of each fiber are interpolated
+    with smoothing splines, allowing an RMS of `spline_rms` pixels.
+
     The fits are made in parallel, being the number of processes controlled
     by the parameter `processes`, with the default value of 0 meaning to use
     the number of cores minus 2 if the number of cores is greater or equal to 4,
@@ -91,6 +110,16 @@ class ModelMapRecipe(MegaraBaseRecipe):
     # from the data
     master_traces = reqs.MasterTraceMapRequirement()
     processes = Parameter(0, 'Number of processes used for fitting')
+    fit_method = Parameter('banded', 'Method used to fit the profiles',
+                           choices=['banded', 'iterative'])
+    warm_start = Parameter(True, 'Use the fit of a column as initial value of the next')
+    column_step = Parameter(100, 'Distance in pixels between fitted columns')
+    refine_tolerance = Parameter(0.0, 'Fit more columns where the interpolated '
+                                      'centers have larger errors (pixels), 0 to disable')
+    check_accuracy = Parameter(False, 'Measure the interpolation error in the '
+                                      'columns between the fitted ones')
+    spline_rms = Parameter(1.0, 'Expected RMS (pixels) of the fitted centers and '
+                                'widths around their splines')
     debug_plot = Parameter(0, 'Save intermediate tracing plots')
     # Results
     reduced_image = Result(ProcessedImage)
@@ -155,13 +184,27 @@ class ModelMapRecipe(MegaraBaseRecipe):
         tracemap = rinput.master_traces
         data = reduced[0].data
         sigma = 1.53
-        cols = range(100, 4100, 100)
-        # cols = range(100, 200, 100)
         valid = [f.fibid for f in tracemap.contents if f.valid]
         ncol = tracemap.total_fibers
         nrow = data.shape[0]
         nfit = data.shape[1]
-        results_get = fit_model(data, tracemap, valid, nrow, ncol, sigma, cols, processes)
+        cols = range(rinput.column_step, nfit, rinput.column_step)
+        if rinput.fit_method == 'banded':
+            results_get, accuracy = fit_model_refined(
+                data, tracemap, valid, sigma, cols, processes,
+                tolerance=rinput.refine_tolerance,
+                spline_rms=rinput.spline_rms,
+                warm_start=rinput.warm_start,
+                check_accuracy=rinput.check_accuracy
+            )
+            self.logger.info('fitted %d columns', len(results_get))
+            if accuracy:
+                self.logger.info('interpolation error in %d columns, '
+                                 'mean: max %.4f rms %.4f, stddev: max %.4f rms %.4f',
+                                 accuracy['columns'], accuracy['mean_max'], accuracy['mean_rms'],
+                                 accuracy['stddev_max'], accuracy['stddev_rms'])
+        else:
+            results_get = fit_model(data, tracemap, valid, nrow, ncol, sigma, cols, processes)
 
         self.logger.info('perform model fitting end')
 
@@ -193,8 +236,9 @@ class ModelMapRecipe(MegaraBaseRecipe):
                 g_mean.append(param['mean'])
                 g_amp.append(param['amplitude'])
 
-            interpol_std = UnivariateSpline(g_col, g_std, k=5)
-            interpol_mean = UnivariateSpline(g_col, g_mean, k=3)
+            interpol_mean, interpol_std = calc_profile_splines(
+                g_col, g_mean, g_std, rms=rinput.spline_rms
+            )
 
             if self.intermediate_results:
                 if dolog:
@@ -236,9 +280,9 @@ class ModelMapRecipe(MegaraBaseRecipe):
 
         # perform extraction with our own calibration
         self.logger.info('perform extraction with computed calibration')
-        calibrator_aper = ApertureExtractor(model_map, self.datamodel)
-        reduced_copy = copy_img(reduced)
-        reduced_rss = calibrator_aper(reduced_copy)
+        with ApertureExtractor(model_map, self.datamodel) as calibrator_aper:
+            reduced_copy = copy_img(reduced)
+            reduced_rss = calibrator_aper(reduced_copy)
 
         if self.intermediate_results:
             with open('ds9.reg', 'w') as ds9reg:
@@ -440,3 +484,130 @@ def fit_model(data, tracemap, valid, nrow, ncol, sigma, cols, processes=20):
 
     results_get = [p.get() for p in results]
     return results_get
+
+
+def fit_model_banded(data, tracemap, valid, sigma, cols, processes=20,
+                     average=2, warm_start=True):
+    """Fit the profiles of all the fibers in each column simultaneously.
+
+    The columns are divided in contiguous groups, one per process. Inside
+    each group, if `warm_start` is True, each fit starts from the
+    previous one.
+
+    The result has the same format as :func:`fit_model`.
+    """
+    cols = list(cols)
+    traces = [f for f in tracemap.contents if f.valid]
+    columns = []
+    centers = []
+    for col in cols:
+        # average of the column and its neighbours, inside the image
+        columns.append(data[:, max(col - average, 0):col + average + 1].mean(axis=1))
+        centers.append(np.array([f.polynomial(col) for f in traces]))
+
+    groups = np.array_split(np.arange(len(cols)), max(1, min(processes, len(cols))))
+    groups = [g for g in groups if len(g) > 0]
+    if len(groups) < 2:
+        fits = fit_columns(columns, centers, sigma, warm_start=warm_start)
+    else:
+        with mp.Pool(processes=len(groups)) as pool:
+            results = [pool.apply_async(
+                fit_columns,
+                args=([columns[i] for i in g], [centers[i] for i in g], sigma),
+                kwds={'warm_start': warm_start}
+            ) for g in groups]
+            fits = [fit for p in results for fit in p.get()]
+
+    results_get = []
+    for col, (amplitude, mean, stddev) in zip(cols, fits):
+        final = {}
+        for fibid, a, m, s in zip(valid, amplitude, mean, stddev):
+            final[fibid] = {'amplitude': a, 'mean': m, 'stddev': s}
+        results_get.append((col, final))
+    return results_get
+
+
+def calc_profile_splines(g_col, g_mean, g_std, rms=1.0):
+    """Splines of the center and width of a fiber along the columns.
+
+    The splines are smoothed, with an expected `rms` (in pixels) of
+    the fitted values around them.
+    """
+    smoothing = len(g_col) * rms ** 2
+    interpol_std = UnivariateSpline(g_col, g_std, k=5, s=smoothing)
+    interpol_mean = UnivariateSpline(g_col, g_mean, k=3, s=smoothing)
+    return interpol_mean, interpol_std
+
+
+def interpolation_error(results_get, checks, valid, rms=1.0):
+    """Difference between the splines of results_get and the fits in checks"""
+    results_get = sorted(results_get, key=lambda x: x[0])
+    g_col = [calc_col for calc_col, _ in results_get]
+    c_col = [calc_col for calc_col, _ in checks]
+    err_mean = np.empty((len(valid), len(checks)))
+    err_std = np.empty_like(err_mean)
+    for idx, fibid in enumerate(valid):
+        g_mean = [vals[fibid]['mean'] for _, vals in results_get]
+        g_std = [vals[fibid]['stddev'] for _, vals in results_get]
+        interpol_mean, interpol_std = calc_profile_splines(g_col, g_mean, g_std, rms=rms)
+        c_mean = [vals[fibid]['mean'] for _, vals in checks]
+        c_std = [vals[fibid]['stddev'] for _, vals in checks]
+        err_mean[idx] = interpol_mean(c_col) - c_mean
+        err_std[idx] = interpol_std(c_col) - c_std
+    return err_mean, err_std
+
+
+def fit_model_refined(data, tracemap, valid, sigma, cols, processes=20,
+                      tolerance=0.0, min_step=10, spline_rms=1.0, warm_start=True,
+                      check_accuracy=False):
+    """Fit the profiles in a sparse set of columns, adding columns where needed.
+
+    If `tolerance` is greater than 0 or `check_accuracy` is True, the
+    columns halfway between the fitted columns are fitted and compared
+    with the interpolation of the fitted columns. If `tolerance` is
+    greater than 0, the columns where the maximum error of the centers is
+    larger than `tolerance` are added, and the two halves of
+    their intervals are checked again, until the distance between columns
+    is less than 2 * `min_step`. The interpolation uses the splines
+    of :func:`calc_profile_splines`, with `spline_rms`.
+
+    Returns the fits, in the format of :func:`fit_model`, sorted by column, and
+    a dictionary with the errors of the interpolation measured in the
+    last set of checked columns, or None if no column was checked.
+    """
+    results_get = fit_model_banded(data, tracemap, valid, sigma, cols, processes,
+                                   warm_start=warm_start)
+    results_get.sort(key=lambda x: x[0])
+    if tolerance <= 0 and not check_accuracy:
+        return results_get, None
+    cols = sorted(cols)
+    intervals = list(zip(cols[:-1], cols[1:]))
+    accuracy = None
+    while intervals:
+        intervals = [(c1, c2) for c1, c2 in intervals if c2 - c1 >= 2 * min_step]
+        if not intervals:
+            break
+        centers = [(c1 + c2) // 2 for c1, c2 in intervals]
+        checks = fit_model_banded(data, tracemap, valid, sigma, centers, processes,
+                                  warm_start=warm_start)
+        err_mean, err_std = interpolation_error(results_get, checks, valid, rms=spline_rms)
+        accuracy = {
+            'columns': len(centers),
+            'mean_max': np.abs(err_mean).max(),
+            'mean_rms': np.sqrt(np.mean(err_mean ** 2)),
+            'stddev_max': np.abs(err_std).max(),
+            'stddev_rms': np.sqrt(np.mean(err_std ** 2))
+        }
+        if tolerance <= 0:
+            break
+        refine = np.abs(err_mean).max(axis=0) > tolerance
+        new_intervals = []
+        for do_refine, check, (c1, c2) in zip(refine, checks, intervals):
+            if do_refine:
+                results_get.append(check)
+                center = check[0]
+                new_intervals.extend([(c1, center), (center, c2)])
+        intervals = new_intervals
+
+    results_get.sort(key=lambda x: x[0])
+    return results_get, accuracy
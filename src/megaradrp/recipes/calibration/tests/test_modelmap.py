@@ -0,0 +1,63 @@
+
+import numpy
+import numpy.polynomial.polynomial as nppol
+from numina.modeling.gaussbox import gauss_box_model
+
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
+from megaradrp.recipes.calibration.modelmap import fit_model_refined, fit_model_banded
+
+
+def create_test_data(nfibers=12, shape=(100, 400)):
+    tracemap = TraceMap(instrument='TEST1')
+    xcol = numpy.arange(shape[1])
+    yrow = numpy.arange(shape[0])[:, numpy.newaxis]
+    img = numpy.zeros(shape)
+    for fibid in range(1, nfibers + 1):
+        # curved traces, with varying width
+        coeff = [10 + 7 * fibid, 0.004, -1e-5]
+        trace = GeometricTrace(fibid, 1, 1, shape[1], fitparms=coeff)
+        tracemap.contents.append(trace)
+        # small oscillation not followed by the trace
+        mean = nppol.polyval(xcol, coeff) + 0.2 * numpy.sin(xcol / 25.0)
+        stddev = 1.5 + 0.3 * numpy.sin(xcol / 60.0)
+        img += 1000 * gauss_box_model(yrow, mean=mean, stddev=stddev)
+    return tracemap, img
+
+
+def test_fit_model_refined():
+    tracemap, img = create_test_data()
+    valid = [f.fibid for f in tracemap.contents if f.valid]
+    cols = range(40, 400, 40)
+    # Without checks, only the columns are fitted
+    results, accuracy = fit_model_refined(img, tracemap, valid, 1.5, cols, processes=1,
+                                          spline_rms=0.001)
+    assert [col for col, _ in results] == list(cols)
+    assert accuracy is None
+
+    results, accuracy = fit_model_refined(img, tracemap, valid, 1.5, cols, processes=1,
+                                          spline_rms=0.001, check_accuracy=True)
+    assert [col for col, _ in results] == list(cols)
+    assert accuracy['columns'] == len(cols) - 1
+    assert accuracy['mean_max'] > 0.002
+
+    results_r, accuracy_r = fit_model_refined(img, tracemap, valid, 1.5, cols, processes=1,
+                                              tolerance=0.002, min_step=10,
+                                              spline_rms=0.001)
+    fitted = [col for col, _ in results_r]
+    assert fitted == sorted(fitted)
+    assert len(fitted) > len(cols)
+    assert set(cols) <= set(fitted)
+    assert accuracy_r['mean_max'] < accuracy['mean_max']
+
+
+def test_fit_model_banded_border():
+    # Columns closer than average to the border of the image
+    tracemap, img = create_test_data()
+    valid = [f.fibid for f in tracemap.contents if f.valid]
+    cols = [0, 1, 399]
+    results = fit_model_banded(img, tracemap, valid, 1.5, cols, processes=1, average=2)
+    assert [col for col, _ in results] == cols
+    for col, final in results:
+        for fibid in valid:
+            expected = tracemap.contents[fibid - 1].polynomial(col) + 0.2 * numpy.sin(col / 25.0)
+            assert abs(final[fibid]['mean'] - expected) < 0.1
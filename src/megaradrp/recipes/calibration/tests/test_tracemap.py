@@ -9,11 +9,14 @@
 
 """Tests for the trace map mode recipe module."""
 
+import numpy
 import pytest
 
 from numina.user.cli import main
 
 from megaradrp.loader import load_drp
+import megaradrp.core.parallel as parallel
+from megaradrp.recipes.calibration.trace import trace_fibers
 
 
 BASE_URL = 'http://guaix.fis.ucm.es/~spr/megara_test/'
@@ -31,3 +34,31 @@ def test_mode_trace_map_set0(drpmocker):
     drpmocker.add_drp('MEGARA', load_drp)
 
     run_recipe()
+
+
+def create_fibers_image(peaks, shape=(200, 400)):
+    rows = numpy.arange(shape[0])[:, numpy.newaxis]
+    cols = numpy.arange(shape[1])
+    image = numpy.zeros(shape)
+    for peak in peaks:
+        center = peak + 2e-3 * (cols - 200) + 1e-5 * (cols - 200) ** 2
+        image += 1000 * numpy.exp(-0.5 * ((rows - center) / 1.2) ** 2)
+    return image
+
+
+@pytest.mark.skipif(not parallel.is_available(), reason='requires shared memory')
+def test_trace_fibers_parallel():
+    peaks = [20.0 + 8 * idx for idx in range(20)]
+    image = create_fibers_image(peaks)
+    kwds = dict(x=200, step=2, hs=3, background=100, maxdis=2.0, poldeg=3)
+    serial = trace_fibers(image, peaks, processes=1, **kwds)
+    result = trace_fibers(image, peaks, processes=2, **kwds)
+    assert len(result) == len(peaks)
+    for (mm1, pfit1), (mm2, pfit2) in zip(serial, result):
+        assert numpy.array_equal(mm1, mm2)
+        assert numpy.array_equal(pfit1, pfit2)
+    # The fibers are traced along the image
+    mm, pfit = serial[5]
+    assert mm[0, 0] < 20 and mm[-1, 0] > 380
+    # Position in column 0
+    assert abs(pfit[0] - peaks[5]) < 0.5
@@ -24,7 +24,6 @@ import matplotlib.pyplot as plt
 import numina.types.qc as qc
 from numina.array import combine
 from numina.array.wavecalib.crosscorrelation import cosinebell
-from numina.array.wavecalib.crosscorrelation import convolve_comb_lines
 from skimage.filters import threshold_otsu
 from skimage.feature import peak_local_max
 from scipy.ndimage.filters import minimum_filter
@@ -36,13 +35,20 @@ from megaradrp.products import TraceMap
 from megaradrp.products.tracemap import GeometricTrace
 from megaradrp.ntypes import ProcessedImage, ProcessedRSS
 from megaradrp.core.recipe import MegaraBaseRecipe
+from megaradrp.core.utils import native_hdu_data
 import megaradrp.requirements as reqs
+import megaradrp.core.parallel as parallel
 import megaradrp.products
 import megaradrp.processing.fibermatch as fibermatch
+from megaradrp.processing.boxes import filtered_cross_section, comb_offset
+from megaradrp.processing.boxes import comb_template, refine_boxes
 from megaradrp.instrument import vph_thr
 from megaradrp.instrument.focalplane import FocalPlaneConf
 
 
+_logger = logging.getLogger(__name__)
+
+
 class TraceMapRecipe(MegaraBaseRecipe):
     """Provides tracing information from continuum flat images.
 
@@ -98,6 +104,8 @@ class TraceMapRecipe(MegaraBaseRecipe):
     polynomial_degree = Parameter(5, 'Polynomial degree of trace fitting')
     relative_threshold = Parameter(0.3, 'Threshold for peak detection')
     debug_plot = Parameter(0, 'Save intermediate tracing plots')
+    processes = Parameter(0, 'Number of processes used for tracing, '
+                             '0 to use the value of MEGARADRP_PROCESSES')
 
     reduced_image = Result(ProcessedImage)
     reduced_rss = Result(ProcessedRSS)
@@ -245,7 +253,8 @@ class TraceMapRecipe(MegaraBaseRecipe):
             hs=hs,
             threshold=threshold,
             poldeg=rinput.polynomial_degree,
-            debug_plot=debug_plot
+            debug_plot=debug_plot,
+            processes=rinput.processes or None
         )
 
         final.contents = contents
@@ -320,7 +329,8 @@ class TraceMapRecipe(MegaraBaseRecipe):
         plt.show()
         return nidxs, col
 
-    def refine_boxes_from_image(self, reduced, expected, cstart=2000, nsearch=20):
+    def refine_boxes_from_image(self, reduced, expected, cstart=2000, nsearch=20,
+                                max_offset=100):
         """Refine boxes using a filtered Fourier image"""
 
         hs = 3
@@ -331,52 +341,15 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
         data = reduced[0].data
         rr = data[:, cstart-hs:cstart+hs].mean(axis=1)
-
-        # standarize and Y flip
-        rr -= numpy.median(rr)
-        rr /= rr.max()
-        rr *= -1
-
-        cb = cosinebell(len(rr), cos_cut)
-        cbr = cb * rr
-
-        xv = numpy.fft.fftfreq(len(cbr))
-        yv = numpy.fft.fft(cbr)
-
-        # Filter freqs in Fourier space
-        yv[abs(xv) > cut_frec] = 0
-
-        res = numpy.fft.ifft(yv)
-        final = res.real
+        final = filtered_cross_section(rr, cut_frec=cut_frec, cos_cut=cos_cut)
 
         # initial determination of global offset (integer number) by
         # cross-correlating an artificial spectrum (with lines placed at
         # the expected locations of the frontiers)
-        expected_arr = numpy.array(expected)
-        comb_lines_flux = numpy.ones_like(expected_arr)
-        naxis1 = len(final)
-        ioffset_max = 100  # pixels
-        xcorr = []
-        ycorr = []
-        xwave = None   # avoid PyCharm warning
-        sp_comb_lines0 = None   # avoid PyCharm warning
-        for ioffset in range(-ioffset_max, ioffset_max + 1):
-            xwave, sp_comb_lines = convolve_comb_lines(
-                lines_wave=expected_arr + ioffset,
-                lines_flux=comb_lines_flux,
-                sigma=3,
-                crpix1=0, crval1=0, cdelt1=1, naxis1=naxis1
-            )
-            factor = max(final) / max(sp_comb_lines)
-            sp_comb_lines = sp_comb_lines * factor
-            fpeak = numpy.sum(sp_comb_lines * final)
-            xcorr.append(ioffset)
-            ycorr.append(fpeak)
-            if ioffset == 0:
-                sp_comb_lines0 = sp_comb_lines.copy()  # store for plot
-
+        offset, xcorr, ycorr = comb_offset(final, expected, sigma=3, max_offset=max_offset)
         # initial offset
-        ioffset = xcorr[ycorr.index(max(ycorr))]
+        ioffset = int(xcorr[ycorr.argmax()])
+        self.logger.debug('offset of the boxes is %f', offset)
 
         # auxiliary plot showing the cross-correlation work
         if self.intermediate_results:
@@ -391,16 +364,13 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
         # using the initial offset, refine the peak search around the new
         # expected location, looking for a maximum in +/- nsearch pixels
-        refined = expected[:]    # initialize list with the same length
-        for ibox, box in enumerate(expected):
-            box_ini = box - nsearch + ioffset
-            box_end = box + nsearch + 1 + ioffset
-            iargmax = final[box_ini:box_end].argmax()
-            refined[ibox] = iargmax + box - nsearch + ioffset
+        refined = refine_boxes(final, expected, nsearch=nsearch, offset=ioffset)
 
         # auxiliary plot showing the initial and final frontier locations
         if self.intermediate_results:
             fig, ax = plt.subplots(ncols=1, nrows=1)
+            xwave, sp_comb_lines0 = comb_template(expected, len(final), sigma=3)
+            sp_comb_lines0 *= final.max() / sp_comb_lines0.max()
             ax.plot(final, label=f'cross section at x={cstart}')
             ax.plot(xwave, sp_comb_lines0, label='expected location of frontiers')
             for idum, item in enumerate(expected):
@@ -419,7 +389,7 @@ class TraceMapRecipe(MegaraBaseRecipe):
         return refined, cstart
 
     def search_traces(self, reduced, boxes, box_borders, inactive_fibers=None, cstart=2000,
-                      threshold=0.3, poldeg=5, step=2, hs=3, debug_plot=0):
+                      threshold=0.3, poldeg=5, step=2, hs=3, debug_plot=0, processes=None):
 
         data = reduced[0].data
         if inactive_fibers is None:
@@ -445,24 +415,30 @@ class TraceMapRecipe(MegaraBaseRecipe):
             debug_plot=debug_plot
         )
 
-        # The byteswapping is required by the cython module
-        if data.dtype.byteorder != '=':
-            self.logger.debug('byteswapping image')
-            image2 = data.byteswap().newbyteorder()
-        else:
-            image2 = data
+        # The native byte order is required by the cython module.
+        # The converted data is kept in the image, for the extraction
+        image2 = native_hdu_data(reduced[0])
 
         maxdis = 2.0
+        # FIXME, for traces, the background must be local
+        # the background in the center is not always good
+        local_trace_background = 300  # background
+
+        # The fibers are traced first, in parallel if possible
+        to_trace = [dtrace for dtrace in central_peaks
+                    if dtrace.start is not None and dtrace.fibid not in inactive_fibers]
+        self.logger.info('trace peaks from references')
+        traced = trace_fibers(
+            image2, [dtrace.start[1] for dtrace in to_trace], x=cstart,
+            step=step, hs=hs, background=local_trace_background,
+            maxdis=maxdis, poldeg=poldeg, processes=processes
+        )
+        traced = {dtrace.fibid: result for dtrace, result in zip(to_trace, traced)}
 
         contents = []
         error_fitting = []
         missing_fibers = []
-        self.logger.info('trace peaks from references')
         for dtrace in central_peaks:
-            # FIXME, for traces, the background must be local
-            # the background in the center is not always good
-            local_trace_background = 300  # background
-
             self.logger.debug('trace fiber %d', dtrace.fibid)
             conf_ok = dtrace.fibid not in inactive_fibers
             peak_ok = dtrace.start is not None
@@ -476,9 +452,7 @@ class TraceMapRecipe(MegaraBaseRecipe):
                     error_fitting.append(dtrace.fibid)
                     self.logger.warning('found fibid %d, expected to be missing', dtrace.fibid)
                 else:
-
-                    mm = trace(image2, x=cstart, y=dtrace.start[1], step=step,
-                               hs=hs, background=local_trace_background, maxdis=maxdis)
+                    mm, pfit = traced[dtrace.fibid]
 
                     if debug_plot:
                         plt.plot(mm[:, 0], mm[:, 1], '.')
@@ -490,9 +464,6 @@ class TraceMapRecipe(MegaraBaseRecipe):
                     if len(mm) < poldeg + 1:
                         self.logger.warning('in fibid %d, only %d points to fit pol of degree %d',
                                             dtrace.fibid, len(mm), poldeg)
-                        pfit = numpy.array([])
-                    else:
-                        pfit = nppol.polyfit(mm[:, 0], mm[:, 1], deg=poldeg)
 
                     start = mm[0, 0]
                     stop = mm[-1, 0]
@@ -517,6 +488,68 @@ class TraceMapRecipe(MegaraBaseRecipe):
         return contents, error_fitting, missing_fibers
 
 
+def trace_fiber(image, x, y, step, hs, background, maxdis, poldeg):
+    """Trace a fiber from its peak in column x and fit a polynomial.
+
+    Returns the points of the trace, computed by
+    :func:`numina.array.trace.traces.trace`, and the coefficients
+    of the fitted polynomial, empty if there are not enough points.
+    """
+    mm = trace(image, x=x, y=y, step=step, hs=hs, background=background, maxdis=maxdis)
+    if len(mm) < poldeg + 1:
+        pfit = numpy.array([])
+    else:
+        pfit = nppol.polyfit(mm[:, 0], mm[:, 1], deg=poldeg)
+    return mm, pfit
+
+
+def _trace_fibers_worker(arrays, peaks, kwds):
+    image = arrays['image']
+    return [trace_fiber(image, y=y, **kwds) for y in peaks]
+
+
+def trace_fibers(image, peaks, processes=None, **kwds):
+    """Trace several fibers, see :func:`trace_fiber`.
+
+    The fibers are independent, and they are traced in a pool of
+    `processes` worker processes if `processes` is larger than 1,
+    with the image in shared memory. The C routine of the tracing
+    holds the GIL, so threads are not used. If `processes` is None,
+    the number of processes is read from MEGARADRP_PROCESSES.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Image in native byte order
+    peaks : sequence of float
+        Position of each fiber in column `x`
+    processes : int, optional
+    **kwds
+        Arguments of :func:`trace_fiber`
+
+    Returns
+    -------
+    list of tuple
+        Points of the trace and fitted polynomial of each fiber,
+        in the order of `peaks`
+
+    """
+    if processes is None:
+        processes = parallel.default_processes()
+
+    if processes > 1 and len(peaks) > 1 and parallel.is_available():
+        _logger.debug('tracing %d fibers with %d processes', len(peaks), processes)
+        # Several tasks per process, to balance the load
+        slices = parallel.chunk_slices(len(peaks), 4 * processes)
+        with parallel.SharedExecutor(processes) as executor:
+            executor.share('image', image)
+            tasks = [(peaks[sl], kwds) for sl in slices]
+            results = executor.run(_trace_fibers_worker, tasks)
+        return [result for chunk in results for result in chunk]
+
+    return [trace_fiber(image, y=y, **kwds) for y in peaks]
+
+
 def estimate_background(image, center, hs, boxref):
     """Estimate background from values in boxes between fibers"""
 
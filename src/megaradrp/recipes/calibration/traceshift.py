@@ -0,0 +1,113 @@
+#
+# Copyright 2021 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""Registration of existing traces to new continuum flat images"""
+
+from numina.core import Result, Parameter
+from numina.array import combine
+
+from megaradrp.processing.combine import basic_processing_with_combination
+from megaradrp.processing.traceshift import measure_trace_shift, shifted_apertures
+from megaradrp.processing.traceshift import default_columns
+from megaradrp.products import TraceMap
+from megaradrp.products.modelmap import ModelMap
+from megaradrp.ntypes import ProcessedImage
+from megaradrp.core.recipe import MegaraBaseRecipe
+import megaradrp.requirements as reqs
+
+
+class BaseShiftRecipe(MegaraBaseRecipe):
+    """Common part of the recipes that shift existing apertures.
+
+    The images in `obresult` are reduced up to dark correction and
+    stacked with the median. The shift of the apertures is measured
+    in `ncolumns` columns of the result, and fitted with a polynomial
+    of degree `offset_degree` in the position of the fibers, that is
+    added to the `global_offset` of the apertures.
+
+    See Also
+    --------
+    megaradrp.processing.traceshift.measure_trace_shift: measure of the shift
+    """
+    master_bias = reqs.MasterBiasRequirement()
+    master_dark = reqs.MasterDarkRequirement()
+    master_bpm = reqs.MasterBPMRequirement()
+    offset_degree = Parameter(1, 'Degree of the polynomial of the offset')
+    ncolumns = Parameter(7, 'Number of columns where the offset is measured')
+    max_shift = Parameter(10, 'Maximum offset searched (pixels)')
+
+    reduced_image = Result(ProcessedImage)
+
+    def shift_apertures(self, rinput, apertures):
+        """Reduce the images and return the shifted apertures"""
+        obresult = rinput.obresult
+        obresult_meta = obresult.metadata_with(self.datamodel)
+
+        self.logger.info('start basic reduction')
+        flow = self.init_filters(rinput, obresult.configuration)
+        reduced = basic_processing_with_combination(rinput, flow, method=combine.median)
+        self.set_base_headers(reduced[0].header)
+        self.logger.info('end basic reduction')
+        self.save_intermediate_img(reduced, 'reduced_image.fits')
+
+        data = reduced[0].data
+        columns = default_columns(data.shape[1], ncolumns=rinput.ncolumns)
+        self.logger.info('measure offset of %s in columns %s', apertures.uuid, columns.tolist())
+        shift = measure_trace_shift(data, apertures, columns=columns,
+                                    deg=rinput.offset_degree,
+                                    max_shift=rinput.max_shift)
+        self.logger.info('offset is %s', shift.coef.tolist())
+
+        final = shifted_apertures(apertures, shift)
+        final.update_metadata(self)
+        final.update_metadata_origin(obresult_meta)
+        self.logger.info('global offset is %s', final.global_offset.coef.tolist())
+        return reduced, final
+
+
+class TraceShiftRecipe(BaseShiftRecipe):
+    """Updates the offset of a TraceMap using continuum flat images.
+
+    The traces of `master_traces` are not recomputed, only their
+    `global_offset` is updated to match the flat images.
+
+    See Also
+    --------
+    megaradrp.recipes.calibration.trace.TraceMapRecipe: computation of the traces
+    """
+    master_traces = reqs.MasterTraceMapRequirement()
+
+    shifted_traces = Result(TraceMap)
+
+    def run(self, rinput):
+        self.logger.info('start trace shift recipe')
+        reduced, final = self.shift_apertures(rinput, rinput.master_traces)
+        self.logger.info('end trace shift recipe')
+        return self.create_result(reduced_image=reduced, shifted_traces=final)
+
+
+class ModelMapShiftRecipe(BaseShiftRecipe):
+    """Updates the offset of a ModelMap using continuum flat images.
+
+    The profiles of `master_model` are not recomputed, only their
+    `global_offset` is updated to match the flat images.
+
+    See Also
+    --------
+    megaradrp.recipes.calibration.modelmap.ModelMapRecipe: computation of the profiles
+    """
+    master_model = reqs.MasterModelMapRequirement()
+
+    shifted_model = Result(ModelMap)
+
+    def run(self, rinput):
+        self.logger.info('start model map shift recipe')
+        reduced, final = self.shift_apertures(rinput, rinput.master_model)
+        self.logger.info('end model map shift recipe')
+        return self.create_result(reduced_image=reduced, shifted_model=final)
@@ -127,14 +127,16 @@ class TwilightFiberFlatRecipe(MegaraBaseRecipe):
     def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, offset=None):
         # 1D, extraction, Wl calibration, Flat fielding
         correctors = []
-        correctors.append(ApertureExtractor(tracemap, self.datamodel, offset=offset))
+        calibrator_aper = ApertureExtractor(tracemap, self.datamodel, offset=offset)
+        correctors.append(calibrator_aper)
         correctors.append(FlipLR())
         correctors.append(WavelengthCalibrator(wlcalib, self.datamodel))
         correctors.append(FiberFlatCorrector(fiberflat.open(), self.datamodel))
 
         flow_1d = SerialFlow(correctors)
 
-        reduced_rss =  flow_1d(img)
+        with calibrator_aper:
+            reduced_rss = flow_1d(img)
         return reduced_rss
 
     def run(self, rinput):
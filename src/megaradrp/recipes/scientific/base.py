@@ -90,7 +90,8 @@ class ImageRecipe(MegaraBaseRecipe):
     def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, twflat=None, offset=None):
         # 1D, extraction, Wl calibration, Flat fielding
         correctors = []
-        correctors.append(ApertureExtractor(tracemap, self.datamodel, offset=offset))
+        calibrator_aper = ApertureExtractor(tracemap, self.datamodel, offset=offset)
+        correctors.append(calibrator_aper)
         correctors.append(FlipLR())
         correctors.append(WavelengthCalibrator(wlcalib, self.datamodel))
         correctors.append(FiberFlatCorrector(fiberflat.open(), self.datamodel))
@@ -100,7 +101,8 @@ class ImageRecipe(MegaraBaseRecipe):
 
         flow2 = SerialFlow(correctors)
 
-        reduced_rss = flow2(img)
+        with calibrator_aper:
+            reduced_rss = flow2(img)
         return reduced_rss
 
     def compute_dar(self, img):
@@ -1,5 +1,5 @@
 #
-# Copyright 2011-2017 Universidad Complutense de Madrid
+# Copyright 2011-2021 Universidad Complutense de Madrid
 #
 # This file is part of Megara DRP
 #
@@ -9,12 +9,14 @@
 
 """LCB Fast Mapping Recipe for Megara"""
 
+import os
+import tempfile
 
 from numina.core import Product, ObservationResult
 
 from megaradrp.ntypes import ProcessedMultiRSS
 from megaradrp.core.recipe import MegaraBaseRecipe
-from megaradrp.processing.multirss import generate_multi_rss
+from megaradrp.processing.multirss import write_multi_rss
 
 
 class LCBFastMappingRecipe(MegaraBaseRecipe):
@@ -32,7 +34,11 @@ class LCBFastMappingRecipe(MegaraBaseRecipe):
     Notes
     -----
     Images previously obtained in **LCB image** and reduced
-    are stacked together in multi RSS format.
+    are stacked together in multi RSS format. The images are
+    written one at a time in a temporary file of the working
+    directory, the result is read from it memory-mapped. The file
+    is removed once opened, its data remains available through
+    the memory map.
 
     """
     final_multirss = Product(ProcessedMultiRSS)
@@ -40,9 +46,17 @@ class LCBFastMappingRecipe(MegaraBaseRecipe):
     def run(self, rinput):
         self.logger.info('start FastMappingRecipe')
         obresult = rinput.obresult
-        imgs = [frame.open() for frame in obresult.frames]
-
-        result = generate_multi_rss(imgs)
+        self.logger.debug('stack %d images', len(obresult.frames))
+        fd, filename = tempfile.mkstemp(prefix='multirss-', suffix='.fits', dir='.')
+        os.close(fd)
+        try:
+            multirss = write_multi_rss(obresult.frames, filename)
+        finally:
+            try:
+                os.remove(filename)
+            except OSError as error:
+                self.logger.warning('unable to remove %s, %s', filename, error)
+        result = multirss.hdulist
         self.logger.info('end FastMappingRecipe')
 
         return self.create_result(final_multirss=result)
@@ -84,6 +84,15 @@ class MasterTraceMapRequirement(Requirement):
         )
 
 
+class MasterModelMapRequirement(Requirement):
+    def __init__(self):
+        super(MasterModelMapRequirement, self).__init__(
+            megaradrp.products.modelmap.ModelMap,
+            'Model of the profiles of the Apertures',
+            validation=True
+        )
+
+
 class MasterAperturesRequirement(Requirement):
     def __init__(self, alias=None):
         super(MasterAperturesRequirement, self).__init__(MultiType(
@@ -35,6 +35,8 @@ expected_tags = {
     "MegaraArcCalibration": {'insmode', 'speclamp', 'vph'},
     "MegaraSlitFlat": set(), "MegaraTraceMap": set(),
     "MegaraModelMap": {'insmode', 'vph'},
+    "MegaraTraceShift": {'insmode', 'vph'},
+    "MegaraModelMapShift": {'insmode', 'vph'},
     "MegaraFiberFlatImage": {'insmode', 'vph'},
     "MegaraTwilightFlatImage": {'confid', 'insmode', 'vph'},
     "MegaraFocusSpectrograph": {'insmode', 'vph'},
@@ -68,6 +70,8 @@ results1 = {
     'MegaraSlitFlat': {'master_bpm': 205, 'master_bias': 105},
     'MegaraTraceMap': {'master_bias': 105, 'master_bpm': 205},
     'MegaraModelMap': {'master_bpm': 205, 'master_bias': 105, 'master_slitflat': 1, 'master_traces': 11},
+    'MegaraTraceShift': {'master_bias': 105, 'master_bpm': 205, 'master_traces': 11},
+    'MegaraModelMapShift': {'master_bias': 105, 'master_bpm': 205, 'master_model': 31},
     'MegaraFiberFlatImage': {'master_bias': 105, 'master_bpm': 205, 'master_slitflat': 1, 'master_apertures': 11, 'master_wlcalib': 21},
     'MegaraTwilightFlatImage': {'master_bias': 105, 'master_bpm': 205, 'master_slitflat': 1, 'master_apertures': 11, 'master_wlcalib': 21, 'master_fiberflat': 49},
     'MegaraFocusSpectrograph': {'master_bias': 105, 'master_bpm': 205, 'master_apertures': 11, 'master_wlcalib': 21},
@@ -93,6 +97,8 @@ results2 = {
     'MegaraSlitFlat': {'master_bpm': 205, 'master_bias': 105},
     'MegaraTraceMap': {'master_bias': 105, 'master_bpm': 205},
     'MegaraModelMap': {'master_bpm': 205, 'master_bias': 105, 'master_slitflat': 2, 'master_traces': 12},
+    'MegaraTraceShift': {'master_bias': 105, 'master_bpm': 205, 'master_traces': 12},
+    'MegaraModelMapShift': {'master_bias': 105, 'master_bpm': 205, 'master_model': 32},
     'MegaraFiberFlatImage': {'master_bias': 105, 'master_bpm': 205, 'master_slitflat': 2, 'master_apertures': 12, 'master_wlcalib': 22},
     'MegaraTwilightFlatImage': {'master_bias': 105, 'master_bpm': 205, 'master_slitflat': 2, 'master_apertures': 12, 'master_wlcalib': 22, 'master_fiberflat': 42},
     'MegaraFocusSpectrograph': {'master_bias': 105, 'master_bpm': 205, 'master_apertures': 12, 'master_wlcalib': 22},
@@ -146,6 +152,11 @@ def test_recipes_extract_tags(current_drp, ob_repo, results):
             {'id': 11, 'tags': {'vph': 'HR-I', 'insmode': 'MOS'}},
             {'id': 12, 'tags': {'vph': 'HR-I', 'insmode': 'LCB'}}
         ],
+        'master_model': [
+            {'id': 35, 'tags': {'vph': 'LR-I', 'insmode': 'MOS'}},
+            {'id': 31, 'tags': {'vph': 'HR-I', 'insmode': 'MOS'}},
+            {'id': 32, 'tags': {'vph': 'HR-I', 'insmode': 'LCB'}}
+        ],
         'master_wlcalib': [
             {'id': 25, 'tags': {'vph': 'LR-I', 'insmode': 'MOS'}},
             {'id': 21, 'tags': {'vph': 'HR-I', 'insmode': 'MOS'}},
@@ -307,7 +307,8 @@ class FlatImageChecker(ExtChecker):
             "type": "object",
             "properties": {
                 "OBSMODE": {"enum": [
-                    "MegaraFiberFlatImage", "MegaraTraceMap", "MegaraModelMap", "MegaraSuccess"]
+                    "MegaraFiberFlatImage", "MegaraTraceMap", "MegaraModelMap",
+                    "MegaraTraceShift", "MegaraModelMapShift", "MegaraSuccess"]
                 },
                 "IMAGETYP": {"const": "IMAGE_FLAT"},
             }
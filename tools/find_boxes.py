@@ -9,11 +9,13 @@ import matplotlib.pyplot as plt
 from numina.array.display.ximshow import ximshow
 from numina.array.display.pause_debugplot import pause_debugplot
 from numina.array.display.ximplotxy import ximplotxy
-from numina.array.wavecalib.crosscorrelation import cosinebell
 from numina.drps import get_system_drps
 
+from megaradrp.processing.boxes import filtered_cross_section, comb_offset
+from megaradrp.processing.boxes import refine_boxes
 
-def find_boxes(fitsfile, channels, nsearch, debugplot):
+
+def find_boxes(fitsfile, channels, nsearch, debugplot, max_offset=0):
     """Refine boxes search around previous locations.
 
     Parameters
@@ -37,6 +39,9 @@ def find_boxes(fitsfile, channels, nsearch, debugplot):
         12 : debug, plots with pauses
         21 : debug, additional plots without pauses
         22 : debug, additional plots with pauses
+    max_offset : int
+        If larger than 0, a global offset of the boxes, up to
+        max_offset pixels, is searched before refining each box.
 
     Returns
     -------
@@ -79,37 +84,28 @@ def find_boxes(fitsfile, channels, nsearch, debugplot):
                   xlabel='y axis', ylabel='number of counts',
                   title=fitsfile + " [" + str(nc1) + "," + str(nc2) + "]")
 
-    # initial manipulation
-    ycut -= np.median(ycut)  # subtract median
-    ycut /= np.max(ycut)  # normalise values
-    ycut *= -1  # invert signal to convert minima in maxima
-    mask = cosinebell(n=ycut.size, fraction=0.10)
-    ycut *= mask
-    if debugplot in (21, 22):
-        ximplotxy(xcut, ycut, debugplot=debugplot,
-                  xlabel='y axis', ylabel='reversed scale')
-
-    # Fourier filtering
-    xf = np.fft.fftfreq(xcut.size)
-    yf = np.fft.fftpack.fft(ycut)
-    cut = (np.abs(xf) > 0.10)
-    yf_trimmed = np.copy(yf)
-    yf_trimmed[cut] = 0.0
-    ycut_filt = np.fft.ifft(yf_trimmed).real
+    # initial manipulation and Fourier filtering
+    ycut_filt = filtered_cross_section(ycut, cut_frec=0.10, cos_cut=0.10)
     if debugplot in (21, 22):
-        ax = ximplotxy(xf, yf.real, plottype='semilogy',
-                       xlim=(0., 0.51), show=False,
-                       label='original', linestyle='dotted')
-        ax.plot(xf, yf_trimmed.real, label='trimmed')
-        ax.legend()
-        plt.show(block=False)
-        plt.pause(0.001)
-        pause_debugplot(debugplot)
-
-    refined_boxes = np.zeros(previous_boxes.size, dtype=int)
-    for ibox, box in enumerate(previous_boxes):
-        iargmax = ycut_filt[box - nsearch:box + nsearch + 1].argmax()
-        refined_boxes[ibox] = xcut[iargmax + box - nsearch]
+        ximplotxy(xcut, ycut_filt, debugplot=debugplot,
+                  xlabel='y axis', ylabel='reversed scale, filtered')
+
+    # global offset
+    if max_offset > 0:
+        offset, xcorr, ycorr = comb_offset(ycut_filt, previous_boxes,
+                                           max_offset=max_offset)
+        ioffset = int(xcorr[ycorr.argmax()])
+        print('>>> Global offset (pixels):', offset)
+        if debugplot in (21, 22):
+            ximplotxy(xcorr, ycorr, debugplot=debugplot,
+                      xlabel='offset', ylabel='cross-correlation')
+    else:
+        ioffset = 0
+
+    refined_boxes = np.array(
+        refine_boxes(ycut_filt, previous_boxes, nsearch=nsearch, offset=ioffset)
+    )
+    refined_boxes = xcut[refined_boxes]
 
     offsets = np.copy(refined_boxes)
     offsets -= previous_boxes
@@ -162,6 +158,10 @@ def main(args=None):
     parser.add_argument("--nsearch",
                         help="Semi-width of the search window",
                         default=20, type=int)
+    parser.add_argument("--max_offset",
+                        help="Maximum global offset of the boxes, "
+                             "0 to disable its search",
+                        default=0, type=int)
     parser.add_argument("--debugplot",
                         help="integer indicating plotting/debugging" +
                              " (default=10)",
@@ -171,7 +171,7 @@ def main(args=None):
     args = parser.parse_args(args=args)
 
     find_boxes(args.fitsfile.name, args.channels, args.nsearch,
-               args.debugplot)
+               args.debugplot, max_offset=args.max_offset)
 
 
 if __name__ == "__main__":